@@ -17,20 +17,33 @@
 
 MIN_MAX_WAIT=90
 
+# The functions below use the Cloud Foundry REST API (cf. CloudFoundaryService in ccs.py) through the shared
+# ccs.py batch process rather than scraping the output of the cf CLI. The summary of the apps of the space 
+# (names, states and routes) is read in a single call and reused by subsequent calls.
+
 # Return list of names of existing versions
 # Usage: groupList
 function groupList() {
   PATTERN=$(echo $NAME | rev | cut -d_ -f2- | rev)  
-  cf apps | grep "^${PATTERN}_[0-9]*[[:space:]]" | cut -d' ' -f1
-  ## TODO error checking on result of cf apps call
+  # read afresh (other processes may have changed the apps); the output of ccsRequest is captured in $(...), as 
+  # elsewhere, then filtered (ccsRequest itself cannot be a command of a pipeline: bash closes the coprocess there)
+  local __apps=$(ccsRequest cf_apps refresh#=true field=name timeout#=30)
+  tr ' ' '\n' <<< "${__apps}" | grep "^${PATTERN}_[0-9]*$"
 }
 
 
 # Delete a group
 # Usage groupDelete name
 function groupDelete() {
-  cf delete ${1} -f
-  ## TODO error checking on result of cf delete call
+  groupsDelete "${1}"
+}
+
+
+# Delete several groups concurrently (at most $MAX_PARALLEL_DELETES at a time; default 4)
+# Usage groupsDelete name...
+function groupsDelete() {
+  if (( 0 == $# )); then return 0; fi
+  ccsRequest cf_delete_apps max_parallel#="${MAX_PARALLEL_DELETES:-4}" timeout#=90 names[] "$@" > /dev/null
 }
 
 
@@ -41,8 +54,7 @@ function mapRoute() {
   local __domain="${2}"
   local __host="${3}"
   
-  cf map-route ${__name} ${__domain} -n ${__host} && rc=$? || rc=$?
-  return ${rc}
+  ccsRequest cf_map name="${__name}" domain="${__domain}" hostname="${__host}" timeout#=30 > /dev/null
 }
 
 
@@ -52,27 +64,49 @@ function scaleGroup() {
   local __name="${1}"
   local __size=${2}
   
-  cf scale ${__name} -i ${__size} && rc=$? || rc=$?
+  ccsRequest cf_scale name="${__name}" size#="${__size}" timeout#=30 > /dev/null
+}
+
+
+# Scale a group and map a route to it
+# Usage: convergeGroup name size domain host
+function convergeGroup() {
+  local __name="${1}"
+  local __size=${2}
+  local __domain="${3}"
+  local __host="${4}"
+
+  scaleGroup ${__name} ${__size} && mapRoute ${__name} ${__domain} ${__host} && rc=$? || rc=$?
   return ${rc}
 }
 
+
 # Get the routes mapped to a group
 # Usage: getRoutes name
 function getRoutes() {
   local __name="${1}"
 
-  IFS=',' read -a routes <<< $(cf app ${__name} | grep "^urls: " | sed 's/urls: //' | sed 's/ //g')
-  echo "${routes[@]}"
+  ccsRequest cf_app name="${__name}" field=routes timeout#=30
+}
+
+
+# Get the apps (among a list of candidates) to which a route is mapped
+# Usage: getRoutedGroups route name...
+function getRoutedGroups() {
+  local __route="${1}"; shift
+
+  ccsRequest cf_routed route="${__route}" timeout#=30 names[] "$@"
 }
 
 
+
 # Stop a group
 # Usage: stopGroup name
 function stopGroup() {
   local __name="${1}"
 
   echo "Stopping group ${__name}"
-  cf stop "${__name}"
+  ccsRequest cf_stop name="${__name}" timeout#=30 > /dev/null
 }
 
 # Determine if a group is in the stopped state
@@ -80,9 +114,9 @@ function stopGroup() {
 function isStopped() {
   local __name="${1}"
 
-  local __state=$(cf app "${__name}" | grep "requested state: " | sed -e 's/requested state: //')
+  local __state=$(ccsRequest cf_app name="${__name}" field=state timeout#=30)
   >&2 echo "${__name} is ${__state}"
-  if [[ "stopped" == "${__state}" ]]; then
+  if [[ "STOPPED" == "${__state}" ]]; then
     echo "true"
   else
     echo "false"
@@ -22,95 +22,79 @@ MIN_MAX_WAIT=300
 # Return list of names of existing versions
 # Usage: groupList
 function groupList() {
-python - <<CODE
-import ccs
-import os
-import sys
-s = ccs.ContainerCloudService(cfapi= ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL')),
-                              base_url='https://{}/v3/containers'.format(os.getenv('CCS_API_HOST')))
-groups = s.list_groups(timeout=30)
-#sys.write.stderr('{}\n'.format(groups))
-names = [g.get('Name', '') for g in groups]
-print('{}'.format(' '.join(names)))
-CODE
+  PATTERN=$(echo $NAME | rev | cut -d_ -f2- | rev)
+  # the output of ccsRequest is captured in $(...), as elsewhere, then filtered (ccsRequest itself cannot be a 
+  # command of a pipeline: bash closes the coprocess there)
+  local __groups=$(ccsRequest list prefix="${PATTERN}_" field=Name timeout#=30)
+  tr ' ' '\n' <<< "${__groups}" | grep "^${PATTERN}_[0-9]*$"
 }
 
 
 # Delete a group
 # Usage groupDelete name
 function groupDelete() {
-__name="${1}" python - <<CODE
-import ccs
-import os
-import sys
-s = ccs.ContainerCloudService(cfapi= ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL')),
-                              base_url='https://{}/v3/containers'.format(os.getenv('CCS_API_HOST')))
-name = os.getenv('__name')
-deleted, group, reason = s.forced_delete_group(name, timeout=90)
-if not deleted:
-  sys.stderr.write('Delete failed: {}\n'.format(reason))
-sys.exit(0 if deleted else 1)
-CODE
+  local __name="${1}"
+
+  ccsRequest delete name="${__name}" timeout#=90 > /dev/null
+}
+
+
+# Delete several groups concurrently (at most $MAX_PARALLEL_DELETES at a time; default 4)
+# Usage groupsDelete name...
+function groupsDelete() {
+  if (( 0 == $# )); then return 0; fi
+  ccsRequest delete_groups max_parallel#="${MAX_PARALLEL_DELETES:-4}" timeout#=90 names[] "$@" > /dev/null
 }
 
 
 # Map a route to a group
 # Usage: mapRoute name domain host
 function mapRoute() {
-__name="${1}" __domain="${2}" __host="${3}" python - <<CODE
-import ccs
-import os
-import sys
-s = ccs.ContainerCloudService(cfapi= ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL')),
-                              base_url='https://{}/v3/containers'.format(os.getenv('CCS_API_HOST')))
-name = os.getenv('__name')
-domain = os.getenv('__domain')
-hostname = os.getenv('__host')
-mapped, group, reason = s.map(hostname, domain, name, timeout=90)
-if not mapped:
-  sys.stderr.write('Map of route to group failed: {}\n'.format(reason))
-sys.exit(0 if mapped else 1)
-CODE
+  local __name="${1}"
+  local __domain="${2}"
+  local __host="${3}"
+
+  ccsRequest map name="${__name}" domain="${__domain}" hostname="${__host}" timeout#=90 > /dev/null
 }
 
 
 # Change number of instances in a group
 # Usage: scaleGroup name size
 function scaleGroup() {
-__name="${1}" __size="${2}" python - <<CODE
-import ccs
-import os
-import sys
-s = ccs.ContainerCloudService(cfapi= ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL')),
-                              base_url='https://{}/v3/containers'.format(os.getenv('CCS_API_HOST')))
-name = os.getenv('__name')
-size = os.getenv('__size')
-scaled, group, reason = s.resize(name, size, timeout=90)
-if not scaled:
-  sys.stderr.write('Group resize failed: {}\n'.format(reason))
-sys.exit(0 if scaled else 1)
-CODE
+  local __name="${1}"
+  local __size="${2}"
+
+  ccsRequest resize name="${__name}" size#="${__size}" timeout#=90 > /dev/null
+}
+
+
+# Scale a group and map a route to it, waiting for both changes together
+# Usage: convergeGroup name size domain host
+function convergeGroup() {
+  local __name="${1}"
+  local __size="${2}"
+  local __domain="${3}"
+  local __host="${4}"
+
+  ccsRequest converge name="${__name}" size#="${__size}" timeout#=90 routes[] "${__host}.${__domain}" > /dev/null
 }
 
 
 # Get the routes mapped to a group
 # Usage: getRoutes name
 function getRoutes() {
-__name="${1}" python - <<CODE
-import ccs
-import os
-import sys
-s = ccs.ContainerCloudService(cfapi= ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL')),
-                              base_url='https://{}/v3/containers'.format(os.getenv('CCS_API_HOST')))
-name = os.getenv('__name')
-group, reason = s.inspect_group(name, timeout=30)
-if group is None:
-  sys.stderr.write("Can't read group: {}\n".format(reason))
-  sys.exit(1)
-else:
-  routes = group.get('Routes', [])
-  print('{}'.format(' '.join(routes)))
-CODE
+  local __name="${1}"
+
+  ccsRequest inspect name="${__name}" field=Routes timeout#=30
+}
+
+
+# Get the groups (among a list of candidates) to which a route is mapped
+# Usage: getRoutedGroups route name...
+function getRoutedGroups() {
+  local __route="${1}"; shift
+
+  ccsRequest routed route="${__route}" timeout#=30 names[] "$@"
 }
 
 
@@ -22,6 +22,90 @@ function debugme() {
 }
 
 
+# Start a long-lived ccs.py batch process (as a coprocess) shared by the platform specific functions
+# (Container.sh, CloudFoundry.sh).
+# Without it, each function call starts its own python process (and its services).
+# Should be called from the main shell (not a subshell) once the environment is set.
+# Usage: ccsStart
+function ccsStart() {
+  if [[ -n ${CCS_PID} ]] && kill -0 ${CCS_PID} 2>/dev/null; then return 0; fi
+  coproc CCS { python ${SCRIPTDIR}/ccs.py serve --format shell; }
+}
+
+
+# Stop the batch process started by ccsStart
+# Usage: ccsStop
+function ccsStop() {
+  if [[ -n ${CCS_PID} ]]; then
+    eval "exec ${CCS[1]}>&-"
+    wait ${CCS_PID} 2>/dev/null
+  fi
+}
+
+
+# Send a (JSON) command to the ccs.py batch process; echo the text of the result.
+# If no batch process has been started, a process is started for this command only.
+# Usage: ccsCall command
+function ccsCall() {
+  local __command="${1}"
+  local __rc __out
+
+  if [[ -n ${CCS_PID} ]] && kill -0 ${CCS_PID} 2>/dev/null; then
+    echo "${__command}" >&${CCS[1]}
+    read -r __rc __out <&${CCS[0]}
+  else
+    read -r __rc __out <<< "$(echo "${__command}" | python ${SCRIPTDIR}/ccs.py serve --format shell)"
+  fi
+  if [[ -n "${__out}" ]]; then echo "${__out}"; fi
+  return ${__rc:-1}
+}
+
+
+# Echo a string as a JSON string: backslashes, double quotes, newlines, carriage returns and tabs are escaped
+# Usage: json_quote string
+function json_quote() {
+  local __s="${1//\\/\\\\}"
+  __s="${__s//\"/\\\"}"
+  __s="${__s//$'\n'/\\n}"
+  __s="${__s//$'\r'/\\r}"
+  __s="${__s//$'\t'/\\t}"
+  printf '"%s"' "${__s}"
+}
+
+
+# Send a command to the ccs.py batch process (cf. ccsCall), building its JSON from the operation and fields.
+# Each field is name=value, where the value is a string; if name ends with '#' the value must be a number or
+# boolean. A field name ending with '[]' (and no value) must be last: the remaining arguments are its list of strings.
+# Usage: ccsRequest op [name=value]... [name[] value...]
+function ccsRequest() {
+  local __json="{\"op\": $(json_quote "${1}")"; shift
+  local __field __name __value __items
+
+  while (( $# > 0 )); do
+    __field="${1}"; shift
+    __name="${__field%%=*}"
+    __value=""
+    if [[ "${__field}" == *=* ]]; then __value="${__field#*=}"; fi
+    case "${__name}" in
+      *'[]')
+        __items=""
+        for __value in "$@"; do __items="${__items}, $(json_quote "${__value}")"; done
+        __json="${__json}, $(json_quote "${__name%'[]'}"): [${__items:2}]"
+        break;;
+      *'#')
+        if [[ ! "${__value}" =~ ^(-?[0-9]+(\.[0-9]+)?|true|false)$ ]]; then
+          >&2 echo "ERROR: ${__name%'#'} must be a number or boolean, not '${__value}'"
+          return 1
+        fi
+        __json="${__json}, $(json_quote "${__name%'#'}"): ${__value}";;
+      *)
+        __json="${__json}, $(json_quote "${__name}"): $(json_quote "${__value}")";;
+    esac
+  done
+  ccsCall "${__json}}"
+}
+
+
 # Default value; should be sert in target platform specific files (CloudFoundry.sh, Container.sh, etc)
 if [[ -z ${MIN_MAX_WAIT} ]]; then MIN_MAX_WAIT=90; fi
 
@@ -89,32 +173,37 @@ function active_deploy() {
 
 
 # Execute a function up to $WITH_RETRIES_MAX_RETRIES (default 3) times.
-# Retries are done in only certain circumstances (cf. computation of ${retry}).
-# Currently, the only reason is a failure to contact the database.
-# A short sleep of $WITH_RETRIES_SLEEP seconds (default 2s) is exectued between attempts.
+# Retries are done in only certain circumstances: when the command fails and its output matches
+# $WITH_RETRIES_PATTERN (an extended regular expression). By default these are a failure to contact
+# the database (BXNAD0315) and timeouts or unavailability of the service.
+# Between attempts it sleeps $WITH_RETRIES_SLEEP seconds (default 2s), doubled after each attempt, plus a random jitter.
 function with_retry() {
   if [[ -z ${WITH_RETRIES_SLEEP} ]]; then WITH_RETRIES_SLEEP=2; fi
   if [[ -z ${WITH_RETRIES_MAX_RETRIES} ]]; then WITH_RETRIES_MAX_RETRIES=3; fi
+  local __pattern="${WITH_RETRIES_PATTERN:-BXNAD0315|[Tt]imed? ?out|503 Service Unavailable|502 Bad Gateway|504 Gateway}"
+  local __sleep=${WITH_RETRIES_SLEEP}
+  local __out
 
   attempt=0
   retry=true
   while [[ -n ${retry} ]] && (( ${attempt} < ${WITH_RETRIES_MAX_RETRIES} )); do
     if [[ -n ${DEBUG} ]]; then >&2 echo "Attempt ${attempt}"; fi
     let attempt=attempt+1
-    $* > /tmp/$$ && rc=$? || rc=$?
+    __out="$("$@")" && rc=$? || rc=$?
     if (( ${rc} )); then
       # "BXNAD0315" is "Error contacting the database."
-      retry=$(grep -e "BXNAD0315" /tmp/$$)
+      retry=$(echo "${__out}" | grep -E -e "${__pattern}")
       if [[ -n ${retry} ]] && (( ${attempt} < ${WITH_RETRIES_MAX_RETRIES} )); then
         >&2 echo "with_retry() call FAILED: ${retry}"
-        if [[ -n ${DEBUG} ]]; then >&2 echo "Retrying in ${WITH_RETRIES_SLEEP} seconds"; fi
-        sleep ${WITH_RETRIES_SLEEP}
+        local __delay=$(( __sleep + RANDOM % (__sleep / 2 + 1) ))
+        if [[ -n ${DEBUG} ]]; then >&2 echo "Retrying in ${__delay} seconds"; fi
+        sleep ${__delay}
+        let __sleep=__sleep*2
       fi
     else retry=
     fi
   done
-  cat /tmp/$$
-  rm -f /tmp/$$
+  if [[ -n ${__out} ]]; then echo "${__out}"; fi
   return ${rc}
 }
 
@@ -124,10 +213,17 @@ function with_retry() {
 function find_inprogress_update() {
   local __name="${1}"
 
-  local match=$(with_retry active_deploy list | \
-                 grep "[[:space:]]${__name}[[:space:]]" | \
-                 grep -e "[[:space:]]in_progress[[:space:]]" | \
-                 awk '{print $2}')
+  # The updates are listed (as JSON) and filtered by a single python process; cf. ActiveDeployService.list_updates()
+  local match
+  if [[ -z "${ad_server_url:-${AD_ENDPOINT}}" ]]; then
+    # Without a known endpoint, fall back to the listing of the cf plugin (which uses its default endpoint)
+    match=$(with_retry active_deploy list | \
+                   grep "[[:space:]]${__name}[[:space:]]" | \
+                   grep -e "[[:space:]]in_progress[[:space:]]" | \
+                   awk '{print $2}')
+  else
+    match=$(python ${SCRIPTDIR}/ccs.py updates --group "${__name}" --status in_progress --ad-url "${ad_server_url:-${AD_ENDPOINT}}")
+  fi
   echo ${match}
 }
 
@@ -137,12 +233,17 @@ function find_inprogress_update() {
 function find_active_update() {
   local __name="${1}"
 
-  match=$(with_retry active_deploy list | \
-                 grep "[[:space:]]${__name}[[:space:]]" | \
-                 grep -e "[[:space:]]in_progress[[:space:]]" \
-                      -e "[[:space:]]rolling back[[:space:]]" \
-                      -e "[[:space:]]paused[[:space:]]" | \
-                 awk '{print $2}')
+  if [[ -z "${ad_server_url:-${AD_ENDPOINT}}" ]]; then
+    # Without a known endpoint, fall back to the listing of the cf plugin (which uses its default endpoint)
+    match=$(with_retry active_deploy list | \
+                   grep "[[:space:]]${__name}[[:space:]]" | \
+                   grep -e "[[:space:]]in_progress[[:space:]]" \
+                        -e "[[:space:]]rolling back[[:space:]]" \
+                        -e "[[:space:]]paused[[:space:]]" | \
+                   awk '{print $2}')
+  else
+    match=$(python ${SCRIPTDIR}/ccs.py updates --group "${__name}" --active --ad-url "${ad_server_url:-${AD_ENDPOINT}}")
+  fi
   echo ${match}
 }
 
@@ -173,7 +274,7 @@ function advance() {
 
   active_deploy advance ${__update_id} && rc=$? || rc=$?
   if [[ $rc -eq 0 ]]; then
-  	wait_phase_completion ${__update_id} && rc=$? || rc=$?	
+  	wait_phase_completion ${__update_id} started && rc=$? || rc=$?	
   fi
     
   >&2 echo "Return code for advance is ${rc}"
@@ -219,31 +320,10 @@ function delete() {
   # active_deploy delete ${__update_id} --force
 }
 
-# Convert expression of the form HhMmSs to an integer representing seconds
-function to_seconds() {
-  local __time="${1}"
-  local __orig_time=${__time}
-
-  if [[ $__time != *h* ]]; then
-    __time="0h${__time}"
-  fi
-  if [[ $__time != *m* ]]; then
-    # already has an 'h'
-    __time=$(echo $__time | sed 's/h/h0m/')
-  fi
-  if [[ $__time != *s ]]; then
-    __time="${__time}0s"
-  fi
-
-  IFS=' ' read -r -a times <<< $(echo $__time | sed 's/h/ /' | sed 's/m/ /' | sed 's/s//')
-  # >&2 echo "${__orig_time} ${__time} ${times[@]}"
-
-  seconds=$(printf %0.f $(expr ${times[0]}*3600+${times[1]}*60+${times[2]} | bc))
-  echo ${seconds}
-}
-
 # Wait for current phase to complete
-# Usage: wait_phase_completion update_id max_wait
+# Usage: wait_phase_completion update_id [started]
+#   If 'started' is passed, the phase has just started (the update was just created or advanced);
+#   only then is the time waited recorded as the duration of the phase (cf. history.py)
 # Response codes:
 #    0 - the is at the end of the current phase
 #    1 - the update has a status of 'completed' (or the phase is the 'completed' phase)
@@ -253,103 +333,31 @@ function to_seconds() {
 #    9 - waited 3x phase duration and it wasn't finished
 function wait_phase_completion() {
   local __update_id="${1}"
-  # Small default value to get us into the loop where we will compute it
-  local __max_wait=10
-  local __expected_duration=0
+  local __started="${2}"
 
   if [[ -z ${__update_id} ]]; then
     >&2 echo "ERROR: Expected update identifier to be passed into wait_phase_completion" 
     return 1
   fi
 
-  local start_time=$(date +%s)
-  
-  >&2 echo "Update ${__update_id} called wait at ${start_time}"
-  
-  local end_time=$(expr ${start_time} + ${__max_wait}) # initial end_time; will be udpated below	
-  while (( $(date +%s) < ${end_time} )); do
-    IFS=$'\n' properties=($(with_retry active_deploy show ${__update_id} | grep ':'))
-
-    update_phase=$(get_property 'phase' ${properties[@]})
-    update_status=$(get_property 'status' ${properties[@]})
-
-    #check environment for V2, skip if V1
-    if (( ${TOOLCHAIN_AVAILABLE} )); then
-      #send update to broker
-      curl -s -X PATCH --data "{\"update_id\": \"${__update_id}\", \"ad_status\": \"$update_status\"}" -H "Authorization: ${TOOLCHAIN_TOKEN}" -H "Content-Type: application/json" "$AD_API_URL/register_deploy/$SERVICE_ID"
-    fi
-
-    case "${update_status}" in
-      completed) # whole update is completed
-      return 0
-      ;;
-      rolled\ back)
-      return 2
-      ;;
-      failed)
-      return 3
-      ;;
-      paused)
-      # attempt to resume
-      >&2 echo "Update ${__update_id} is paused; attempting to resume"
-      active_deploy resume ${__update_id}
-      # TODO deal with failures
-      ;;
-      in_progress|rolling\ back)
-      ;;
-      *)
-      >&2 echo "ERROR: Unknown status: ${update_status}"
-      >&2 echo "${properties[@]}"
-      return 5
-      ;;
-    esac
-
-	# the status is 'in_progress' or 'rolling back'
-    case "${update_phase}" in
-      initial)
-      # should only happen if status is rolled back -- which happens when we finish rolling back
-      return 2
-      ;;
-      completed)
-      # should only happen if status is completed -- so should never get here
-      return 1
-      ;;
-      rampup|test|rampdown)
-      ;;
-      *)
-      >&2 echo "ERROR: Unknown phase: ${update_phase}"
-      return 5
-    esac
+  if [[ -z "${ad_server_url:-${AD_ENDPOINT}}" ]]; then
+    >&2 echo "ERROR: No Active Deploy service endpoint known (cf. AD_ENDPOINT); unable to wait for update ${__update_id}"
+    return 5
+  fi
 
-    >&2 echo "Update ${__update_id} is ${update_status} in phase ${update_phase}"
+  >&2 echo "Update ${__update_id} called wait at $(date +%s)"
 
-    if [[ "in_progress" == "${update_status}" ]]; then
-      phase_progress=$(get_property "${update_phase} duration" ${properties[@]})
-      if [[ "${phase_progress}" =~ completed* ]]; then
-        # The phase is completed
-        if (( ${TOOLCHAIN_AVAILABLE} )); then
-          #send update to broker
-          curl -s -X PATCH --data "{\"update_id\": \"${__update_id}\", \"ad_status\": \"completed\"}" -H "Authorization: ${TOOLCHAIN_TOKEN}" -H "Content-Type: application/json" "$AD_API_URL/register_deploy/$SERVICE_ID"
-        fi
-        >&2 echo "Phase ${update_phase} is complete"
-        return 0
-      else
-        >&2 echo "Phase ${update_phase} progress is: ${phase_progress}"
-      fi
-    fi # if [[ "in_progress" == "${update_status}" ]]
-    # determine the expected time if haven't done so already; update end_time
-    if [[ "0" = "${__expected_duration}" ]]; then
-      __expected_duration=$(to_seconds $(echo ${phase_progress} | sed 's/.* of \(.*\)/\1/'))
-      __max_wait=$(expr ${__expected_duration}*3 | bc)
-      if (( ${__max_wait} < ${MIN_MAX_WAIT} )); then __max_wait=${MIN_MAX_WAIT}; fi
-      end_time=$(expr ${start_time} + ${__max_wait})
-      >&2 echo "Phase ${update_phase} has an expected duration of ${__expected_duration}s; will wait ${__max_wait}s ending at ${end_time}"
-    fi
+  # Poll the update record (as JSON) from a single python process; cf. ActiveDeployService.wait_phase()
+  python ${SCRIPTDIR}/ccs.py wait_phase ${__update_id} --ad-url "${ad_server_url:-${AD_ENDPOINT}}" --min-max-wait ${MIN_MAX_WAIT} ${__started:+--from-start} && rc=$? || rc=$?
+  return ${rc}
+}
 
-    sleep 3
-  done
-  
-  return 9 # took too long
+# Report the status of an update to the toolchain (only if TOOLCHAIN_AVAILABLE is 1)
+# Usage: report_status update_id status
+# Statuses already reported by wait_phase_completion (cf. ccs.StatusReporter) need not be reported again
+function report_status() {
+  (( ${TOOLCHAIN_AVAILABLE:-0} )) || return 0
+  python ${SCRIPTDIR}/ccs.py report_status "${1}" "${2}"
 }
 
 function wait_comment() {
@@ -390,71 +398,12 @@ function wait_comment() {
 # Usage: clean
 #   Required environment variable NAME - the name of the current deployed group
 #                                 CONCURRENT_VERSIONS - the number of concurrent versions to keep
+#   Optional environment variable CLEAN_DRY_RUN - if set, only print which groups would be deleted
 function clean() {
-  # Identify list of build numbers to keep
-  PATTERN=$(echo $NAME | rev | cut -d_ -f2- | rev)
-  VERSION=$(echo $NAME | rev | cut -d_ -f1 | rev)
-
-  candidates=($(groupList))
-  debugme echo "clean(): Found ${#candidates[@]} versions: ${candidates[@]}"
-
-  VERSIONS=()
-  for c in "${candidates[@]}"; do
-    v=$(echo ${c} | rev | cut -d_ -f1 | rev)
-    VERSIONS+=(${v})
-  done
-
-  SORTED_VERSIONS=($(for i in ${VERSIONS[@]}; do echo $i; done | sort -n))
-  debugme echo "clean(): Found sorted ${#SORTED_VERSIONS[@]} versions: ${SORTED_VERSIONS[@]}"
-
-  # Iterate in reverse (most recent to oldest)
-  CURRENT_VERSION=
-  MOST_RECENT=
-  KEPT=()
-  for (( idx=${#SORTED_VERSIONS[@]}-1; idx>=0; idx-- )); do
-    candidate="${PATTERN}_${SORTED_VERSIONS[$idx]}"
-    debugme echo "clean(): Considering candidate ${candidate}"
-
-    # Keep most recent with a route
-    if [[ -z ${CURRENT_VERSION} ]] && [[ -n $(getRoutes "${candidate}") ]]; then
-      # The current version is the first version with a route that we find (recall: reverse order)
-      CURRENT_VERSION="${candidate}"
-      KEPT+=(${candidate})
-      echo "clean(): Identified current version: ${CURRENT_VERSION}; keeping"
-
-    # Delete groups with versions greater than the version of the group just deployed (VERSION)
-    # This represents a group deployed using a previous (or another!) pipeline.
-    # Eventually, the existence of the group will become an issue (name conflict) so delete it now.
-    elif (( ${SORTED_VERSIONS[$idx]} > ${VERSION} )); then
-      echo "clean(): Deleting group ${candidate} from previous pipeline"
-      groupDelete "${candidate}"
-
-    # Keep the most recent without a route IF the current version has has not been found
-    # This is the most recent deploy but it failed (was rolled back)
-    elif [[ -z ${CURRENT_VERSION} ]] &&  [[ -z ${MOST_RECENT} ]]; then
-      MOST_RECENT="${candidate}"
-      # Don't record this in the list of those that were KEPT; it is extra
-      echo "clean(): Current deployment (${MOST_RECENT}) failed; keeping for debug purposes"
-
-    # Delete any (older) stopped groups -- they were failed deploys
-    elif [[ "true" == "$(isStopped ${candidate})" ]]; then
-      echo "clean(): Deleting group ${candidate} (group is in stopped state)"
-      groupDelete "${candidate}"
-
-    # If we've kept enough, delete the group
-    elif (( ${#KEPT[@]} >= ${CONCURRENT_VERSIONS} )); then
-      echo "clean(): Deleting group ${candidate} (already identified sufficient versions to keep)"
-      groupDelete "${candidate}"
-
-    # Otherwise keep the group
-    else
-      KEPT+=(${candidate})
-      echo "clean(): Keeping group ${candidate}"
-    fi
-
-  done
-
-  echo "clean(): Summary: keeping ${KEPT[@]} ${MOST_RECENT}"
+  # Read all versions once, plan which to keep and delete (same rules as above), then delete concurrently.
+  # Set CLEAN_DRY_RUN to print the plan without deleting anything.
+  python ${SCRIPTDIR}/clean.py "${NAME}" --concurrent-versions ${CONCURRENT_VERSIONS} --platform ${TARGET_PLATFORM:-CloudFoundry} \
+    --max-parallel ${MAX_PARALLEL_DELETES:-4} ${CLEAN_DRY_RUN:+--dry-run}
 }
 
 
@@ -467,18 +416,9 @@ function getRouted() {
   >&2 echo "Looking for application with route ${__route} among ${__apps[@]}"
 
   local __routed_apps=()
-  for app in "${__apps[@]}"; do
-    # >&2 echo "Considering app: $app"
-    app_routes=($(getRoutes ${app}))
-    # >&2 echo "Routes for $app are: ${app_routes[@]}"
-    for rt in ${app_routes[@]}; do
-      if [[ "${rt}" == "${__route}" ]]; then
-        # >&2 echo "FOUND app: ${app}"
-        __routed_apps+=(${app})
-        break
-      fi
-    done
-  done
+  if (( ${#__apps[@]} )); then
+    __routed_apps=($(getRoutedGroups "${__route}" "${__apps[@]}"))
+  fi
 
   >&2 echo "${__route} is routed to ${__routed_apps[@]}"
   echo "${__routed_apps[@]}"
@@ -486,26 +426,13 @@ function getRouted() {
 
 
 # Utility function to validate that $AD_ENDPOINT supports $CF_TARGET as a backend. Returns 0 if so, non-zero otherwise.
+# Uses the (cached) preflight probe of the endpoint (cf. preflight.py)
 # Usage: supports_target active_deploy_endpoint target_environment_endpoint
 function supports_target() {
-__ad_url="${1}" __cf_url="${2}" python - <<CODE
-import json
-import os
-import requests
-import sys
-ad_url = os.getenv("__ad_url")
-cf_url = os.getenv("__cf_url")
-try:
-  r = requests.get('{}/v1/info/'.format(ad_url), timeout=10)
-  info = json.loads(r.text)
-  for backend in info.get("cloud_backends", []):
-    print backend
-    if backend == cf_url:
-      sys.exit(0)
-  sys.exit(1)
-except Exception, e:
-  print e
-  sys.exit(2)
-CODE
+  (
+    eval "$(python ${SCRIPTDIR}/preflight.py --ad-url "${1}" --cf-url "${2}")"
+    echo "${AD_BACKENDS}"
+    (( ${AD_SUPPORTS_TARGET} ))
+  )
 }
 
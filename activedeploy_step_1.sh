@@ -72,6 +72,7 @@ function delete_update() {
   if (( ${delete_rc} )); then
     echo "WARN: Unable to delete update record ${__update}"
   fi
+  python ${SCRIPTDIR}/checkpoint.py clear --name "${NAME}"
 }
 
 # Delete older updates and update record
@@ -95,44 +96,57 @@ function rollback_and_cleanup() {
 # cd to target so can read ccs.py when needed (for route detection)
 cd ${SCRIPTDIR}
 
-originals=($(groupList))
-#originals=($(cf apps | cut -d' ' -f1))
+# Share a single ccs.py process across all calls to the target platform
+ccsStart
+trap ccsStop EXIT
 
 successor="${NAME}"
 
 # export version of this build
 export UPDATE_ID=${BUILD_NUMBER}
 
-# Determine which original groups has the desired route --> the current original
 route="${ROUTE_HOSTNAME}.${ROUTE_DOMAIN}" 
-ROUTED=($(getRouted "${route}" "${originals[@]}"))
-echo ${#ROUTED[@]} of original groups routed to ${route}: ${ROUTED[@]}
 
-# If more than one routed app, select only the oldest
-if (( 1 < ${#ROUTED[@]} )); then
-  echo "WARNING: More than one app routed to ${route}; updating the oldest"
+# If an earlier run of this step created an update for this group (and it is still in progress), resume it
+# rather than rediscovering the original group (cf. checkpoint.py)
+eval "$(python ${SCRIPTDIR}/checkpoint.py resume --name "${NAME}" --ad-url "${ad_server_url}")"
+if [[ "in_progress" != "${CHECKPOINT_STATUS}" ]] || [[ "${route}" != "${CHECKPOINT_ROUTE}" ]]; then
+  CHECKPOINT_UPDATE_ID=
 fi
 
-if (( 0 < ${#ROUTED[@]} )); then
-  original_grp=${ROUTED[0]}
-  #original_grp=${ROUTED[$(expr ${#ROUTED[@]} - 1)]}
+if [[ -n "${CHECKPOINT_UPDATE_ID}" ]]; then
+  echo "INFO: Resuming update ${CHECKPOINT_UPDATE_ID} (phase ${CHECKPOINT_PHASE}) from checkpoint"
+  original_grp="${CHECKPOINT_ORIGINAL}"
   original_grp_id=${original_grp#_*}
+  originals=("${original_grp}" "${successor}")
+else
+  originals=($(groupList))
+  #originals=($(cf apps | cut -d' ' -f1))
+
+  # Determine which original groups has the desired route --> the current original
+  ROUTED=($(getRouted "${route}" "${originals[@]}"))
+  echo ${#ROUTED[@]} of original groups routed to ${route}: ${ROUTED[@]}
+
+  # If more than one routed app, select only the oldest
+  if (( 1 < ${#ROUTED[@]} )); then
+    echo "WARNING: More than one app routed to ${route}; updating the oldest"
+  fi
+
+  if (( 0 < ${#ROUTED[@]} )); then
+    original_grp=${ROUTED[0]}
+    #original_grp=${ROUTED[$(expr ${#ROUTED[@]} - 1)]}
+    original_grp_id=${original_grp#_*}
+  fi
 fi
 
 # At this point if original_grp is not set, we didn't find any routed apps; ie, is initial deploy
 
 # map/scale original deployment if necessary
 if [[ 1 = ${#originals[@]} ]] || [[ -z $original_grp ]]; then
-  echo "INFO: Initial version, scaling"
-  scaleGroup ${successor} ${GROUP_SIZE} && rc=$? || rc=$?
-  if (( ${rc} )); then
-    echo "ERROR: Failed to scale ${successor} to ${GROUP_SIZE} instances"
-    exit ${rc}
-  fi
-  echo "INFO: Initial version, mapping route"
-  mapRoute ${successor} ${ROUTE_DOMAIN} ${ROUTE_HOSTNAME} && rc=$? || rc=$?
+  echo "INFO: Initial version, scaling and mapping route"
+  convergeGroup ${successor} ${GROUP_SIZE} ${ROUTE_DOMAIN} ${ROUTE_HOSTNAME} && rc=$? || rc=$?
   if (( ${rc} )); then
-    echo "ERROR: Failed to map the route ${ROUTE_DOMAIN}.${ROUTE_HOSTNAME} to ${successor}"
+    echo "ERROR: Failed to scale ${successor} to ${GROUP_SIZE} instances and map the route ${ROUTE_HOSTNAME}.${ROUTE_DOMAIN}"
     exit ${rc}
   fi
   exit 0
@@ -166,27 +180,35 @@ if [[ -n "${original_grp}" ]]; then
   if [[ -n "${RAMPDOWN_DURATION}" ]]; then create_args="${create_args} --rampdown ${RAMPDOWN_DURATION}"; fi
   create_args="${create_args} --test 1s";
   
-  active=$(find_active_update ${original_grp})
-  if [[ -n ${active} ]]; then
-    echo "Original group ${original_grp} already engaged in an active update; rolling it back"
-    rollback ${active}
-    # Check if it worked
+  if [[ -n "${CHECKPOINT_UPDATE_ID}" ]]; then
+    update="${CHECKPOINT_UPDATE_ID}"
+  else
     active=$(find_active_update ${original_grp})
     if [[ -n ${active} ]]; then
-      echo -e "${red}ERROR: Original group ${original_grp} still engaged in an active update; rollback did not work. Exiting.${no_color}"
-      with_retry active_deploy show ${active}
-      exit 1
+      echo "Original group ${original_grp} already engaged in an active update; rolling it back"
+      rollback ${active}
+      # Check if it worked
+      active=$(find_active_update ${original_grp})
+      if [[ -n ${active} ]]; then
+        echo -e "${red}ERROR: Original group ${original_grp} still engaged in an active update; rollback did not work. Exiting.${no_color}"
+        with_retry active_deploy show ${active}
+        exit 1
+      fi
     fi
-  fi
 
-  # Now attempt to call the update
-  update=$(create ${create_args}) && create_rc=$? || create_rc=$?
+    # Now attempt to call the update
+    update=$(create ${create_args}) && create_rc=$? || create_rc=$?
 
-  # Unable to create update
-  if (( ${create_rc} )); then
-    echo -e "${red}ERROR: failed to create update; ${update}${no_color}"
-    with_retry active_deploy list | grep "[[:space:]]${original_grp}[[:space:]]"
-    exit ${create_rc}
+    # Unable to create update
+    if (( ${create_rc} )); then
+      echo -e "${red}ERROR: failed to create update; ${update}${no_color}"
+      with_retry active_deploy list | grep "[[:space:]]${original_grp}[[:space:]]"
+      exit ${create_rc}
+    fi
+
+    # Record the update so that step 2 (and a rerun of this step) need not rediscover it
+    python ${SCRIPTDIR}/checkpoint.py save --name "${successor_grp}" --update-id "${update}" --original "${original_grp}" \
+      --route "${route}" --ad-url "${ad_server_url}" --gui-url "${update_gui_url}"
   fi
 
   echo "Initiated update: ${update}"
@@ -201,20 +223,19 @@ if [[ -n "${original_grp}" ]]; then
   export PY_UPDATE_ID=$update
   if (( ${TOOLCHAIN_AVAILABLE} )); then
     echo "PIPELINE_TOOLCHAIN_ID=${PIPELINE_TOOLCHAIN_ID}"
-    export TC_API_RES="$(curl -s -k -H "Authorization: ${TOOLCHAIN_TOKEN}" https://otc-api.stage1.ng.bluemix.net/api/v1/toolchains/${PIPELINE_TOOLCHAIN_ID}\?include\=everything)"
-   #echo "***** TC_API_RES:"
-   #echo ${TC_API_RES}
+    tc_json="$(mktemp)"
+    curl -s -k -H "Authorization: ${TOOLCHAIN_TOKEN}" https://otc-api.stage1.ng.bluemix.net/api/v1/toolchains/${PIPELINE_TOOLCHAIN_ID}\?include\=everything -o "${tc_json}"
 
-    echo ${TC_API_RES} | grep "invalid"
+    grep "invalid" "${tc_json}"
     if [ $? -eq 0 ]; then
       #error, invalid API token
       echo "WARNING: Invalid toolchain token."
       # Invalid toolchain token is not a reason to fail
     else
       #proceed normally
-      export SERVICE_ID="$(python processJSON.py sid)"
-      export AD_API_URL="$(python processJSON.py ad-url)"
-      export PIPELINE_NAME="$(python processJSON.py $PIPELINE_ID)"
+      # extract SERVICE_ID, AD_API_URL and PIPELINE_NAME in a single pass over the toolchain
+      eval "$(python processJSON.py --file "${tc_json}" --pipeline-id "${PIPELINE_ID}")"
+      export SERVICE_ID AD_API_URL PIPELINE_NAME
       
       # echo "SERVICE_ID=${SERVICE_ID}"
       # echo "AD_API_URL=${AD_API_URL}"
@@ -227,17 +248,25 @@ if [[ -n "${original_grp}" ]]; then
         # Inability to record an update is not a reason to fail
       fi
     fi
+    rm -f "${tc_json}"
   else
     echo "INFO: Running in V1 environment, no broker available."
   fi
   
-  # Wait for completion of rampup phase
-  wait_phase_completion $update && rc=$? || rc=$?
+  # A resumed update may already have been advanced to test (by the earlier run of this step)
+  if [[ -n "${CHECKPOINT_UPDATE_ID}" ]] && [[ "test" == "${CHECKPOINT_PHASE}" ]]; then
+    exit_with_link 0 "${successor_grp} already advanced to test phase"
+  fi
+
+  # Wait for completion of rampup phase (which has just started unless the update was resumed)
+  if [[ -z "${CHECKPOINT_UPDATE_ID}" ]]; then started=started; fi
+  wait_phase_completion $update ${started} && rc=$? || rc=$?
   echo "wait result is $rc"
   case "$rc" in
     0) # phase done
     # continue (advance to test)
     echo "Phase done, advance to test"
+    python ${SCRIPTDIR}/checkpoint.py mark --name "${successor_grp}" --phase rampup
     advance $update && advance_rc=$? || advance_rc=$?
     if (( ${advance_rc} )); then
       case "${advance_rc}" in
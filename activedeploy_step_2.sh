@@ -33,13 +33,27 @@ echo "CCS_API_HOST = $CCS_API_HOST"
 # cd to target so can read ccs.py when needed (for group deletion)
 cd ${SCRIPTDIR}
 
-# Initial deploy case
-originals=($(groupList))
+# Share a single ccs.py process across all calls to the target platform
+ccsStart
+trap ccsStop EXIT
+
+# Resume from the checkpoint written by step 1 (cf. checkpoint.py); a single read of the update validates it.
+# Without a checkpoint (or if its update is no longer in progress), the update is discovered.
+eval "$(python ${SCRIPTDIR}/checkpoint.py resume --name "${NAME}" --ad-url "${ad_server_url}")"
+if [[ "in_progress" == "${CHECKPOINT_STATUS}" ]]; then
+  update_id="${CHECKPOINT_UPDATE_ID}"
+  update_status="${CHECKPOINT_STATUS}"
+fi
+
+if [[ -z "${update_id}" ]]; then
+  # Initial deploy case
+  originals=($(groupList))
 
-# Nothing to do in initial deploy scenario
-if [[ 1 = ${#originals[@]} ]]; then
-  echo "INFO: Initial version (single version deployed); exiting"
-  exit 0
+  # Nothing to do in initial deploy scenario
+  if [[ 1 = ${#originals[@]} ]]; then
+    echo "INFO: Initial version (single version deployed); exiting"
+    exit 0
+  fi
 fi
 
 # If a problem was found with $AD_ENDPOINT, fail now
@@ -48,15 +62,25 @@ if [[ -n ${MUSTFAIL_ACTIVEDEPLOY} ]]; then
   exit 128
 fi
 
-# Identify the active deploy in progress. We do so by looking for a deploy 
-# involving the add / container named "${NAME}"
-in_prog=$(with_retry active_deploy list | grep "${NAME}" | grep "in_progress")
-read -a array <<< "$in_prog"
-update_id=${array[0]}
 if [[ -z "${update_id}" ]]; then
-  echo "INFO: Initial version (no update containing ${NAME}); exiting"
-  with_retry active_deploy list
-  exit 0
+  # Identify the active deploy in progress. We do so by looking for a deploy 
+  # involving the add / container named "${NAME}"
+  in_prog=$(find_inprogress_update "${NAME}")
+  read -a array <<< "$in_prog"
+  update_id=${array[0]}
+  if [[ -z "${update_id}" ]]; then
+    echo "INFO: Initial version (no update containing ${NAME}); exiting"
+    with_retry active_deploy list
+    exit 0
+  fi
+
+  echo "INFO: Not initial version (part of update ${update_id})"
+  with_retry active_deploy show ${update_id}
+
+  IFS=$'\n' properties=($(with_retry active_deploy show ${update_id} | grep ':'))
+  update_status=$(get_property 'status' ${properties[@]})
+else
+  echo "INFO: Not initial version (part of update ${update_id}, from checkpoint; phase ${CHECKPOINT_PHASE})"
 fi
 
 # Identify URL for visualization of update. To do this:
@@ -65,18 +89,13 @@ show_link "Deployment URL" \
           "${update_gui_url}/deployments/${update_id}?ace_config={%22spaceGuid%22:%22${CF_SPACE_ID}%22}" \
           ${green}
 
-echo "INFO: Not initial version (part of update ${update_id})"
-with_retry active_deploy show ${update_id}
-
-IFS=$'\n' properties=($(with_retry active_deploy show ${update_id} | grep ':'))
-update_status=$(get_property 'status' ${properties[@]})
-
 # TODO handle other statuses better: could be rolled back, rolling back, paused, failed, ...
 # Insufficient to leave it and let the wait_phase_completion deal with it; the call to advance/rollback could fail
 if [[ "${update_status}" != 'in_progress' ]]; then
   echo "Deployment in unexpected status: ${update_status}"
   rollback ${update_id}
   delete ${update_id}
+  python ${SCRIPTDIR}/checkpoint.py clear --name "${NAME}"
   exit 1
 fi
 
@@ -89,6 +108,8 @@ if [[ -z ${TEST_RESULT_FOR_AD} ]]; then
 fi
 
 # Either rampdown and complete (on test success) or rollback (on test failure)
+python ${SCRIPTDIR}/checkpoint.py mark --name "${NAME}" --phase test
+
 if [[ ${TEST_RESULT_FOR_AD} -eq 0 ]]; then
   echo "Test success -- completing update ${update_id}"
   # First advance to rampdown phase
@@ -115,6 +136,14 @@ else
   rc=2
 fi
 
+# Record the outcome in the deploy history (if $AD_HISTORY_DB is set; cf. history.py)
+case ${rc} in
+  0) outcome=completed ;;
+  2) outcome=rolled_back ;;
+  *) outcome=failed ;;
+esac
+python ${SCRIPTDIR}/history.py record --name "${NAME}" --kind deploy --activity update --outcome ${outcome}
+
 # Cleanup - delete older updates
 clean && clean_rc=$? || clean_rc=$?
 if (( $clean_rc )); then
@@ -128,5 +157,6 @@ delete ${update_id} && delete_rc=$? || delete_rc=$?
 if (( $delete_rc )); then
   echo "WARN: Unable to delete update record ${update_id}"
 fi
+python ${SCRIPTDIR}/checkpoint.py clear --name "${NAME}"
 
 exit $rc
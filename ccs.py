@@ -13,11 +13,21 @@
 #   See the License for the specific language governing permissions and
 #********************************************************************************
 
+import atexit
+import collections
+from email.utils import mktime_tz, parsedate_tz
+import heapq
+import history
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import random
 import requests
+import SocketServer
+import subprocess
 import sys
+import threading
 import time
 
 __author__ = 'Michael Kalantar'
@@ -53,35 +63,1284 @@ def sanitize_message(message):
     return message
     
 
+# Maximum number of characters of a response traced; 0 for no limit (cf. configure_logging())
+TRACE_MAX_BODY = 0
+
+_logging_configured = False
+
+def configure_logging(level=None, max_body=None, stream=None):
+    ''' Configure logging for the process. Only the first call has an effect so that, however many 
+    services are created, each message is logged once. 
+    
+    Parameters
+        @param level int: logging level; defaults to $CCS_LOG_LEVEL, or DEBUG if $DEBUG is set (and not 0), or INFO
+        @param max_body int: maximum number of characters of a response to trace; defaults to $CCS_TRACE_MAX_BODY, or 0 (no limit)
+        @param stream file: where messages are written; defaults to sys.stderr
+    '''
+    global _logging_configured, TRACE_MAX_BODY
+    if _logging_configured:
+        return
+    _logging_configured = True
+    
+    if level is None:
+        level = os.getenv('CCS_LOG_LEVEL') or ('DEBUG' if os.getenv('DEBUG', '0') not in ['', '0'] else 'INFO')
+    if not isinstance(level, int):
+        level = logging.getLevelName(level.upper())
+    TRACE_MAX_BODY = int(max_body if max_body is not None else os.getenv('CCS_TRACE_MAX_BODY', 0))
+    
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    handler = logging.StreamHandler(stream if stream else sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+
+def _curl(method, url, headers, body=None):
+    headers = ' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()])
+    data = " --data '{0}'".format(body.replace('\'', '\\\'')) if body else ''
+    return "curl {headers} -X {method} '{url}'{data}".format(headers=headers, method=method, url=url, data=data)
+
+def trace_request(method, url, headers, body=None, timeout=None):
+    ''' Log (at DEBUG level) the curl equivalent of a REST call. Nothing is formatted unless DEBUG is enabled.
+    
+    Parameters
+        @param method string: HTTP method
+        @param url string: URL called
+        @param headers dict: request headers (sensitive values are hidden)
+        @param body string: request body, if any
+        @param timeout int: timeout of the call
+    '''
+    logger = logging.getLogger(__name__)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('[%s] %s', timeout, _curl(method, url, headers, body))
+
+def trace_response(method, url, headers, response):
+    ''' Log (at DEBUG level) a response indicating an error (400 or 5xx). The response text is truncated 
+    to TRACE_MAX_BODY characters. Nothing is formatted unless DEBUG is enabled.
+    
+    Parameters
+        @param method string: HTTP method
+        @param url string: URL called
+        @param headers dict: request headers (sensitive values are hidden)
+        @param response requests.Response: the response
+    '''
+    logger = logging.getLogger(__name__)
+    if (response.status_code == 400 or response.status_code >= 500) and logger.isEnabledFor(logging.DEBUG):
+        text = sanitize_message(response.text)
+        if TRACE_MAX_BODY and len(text) > TRACE_MAX_BODY:
+            text = '{0}... [{1} characters truncated]'.format(text[:TRACE_MAX_BODY], len(text) - TRACE_MAX_BODY)
+        logger.debug('%s returned %s: %s %s', _curl(method, url, headers), response.status_code, response.headers, text)
+
+def describe_group(group):
+    ''' Short description of a group (for logging): its name, status, size and routes.
+    
+    Parameters
+        @param group dict: JSON group as returned by CCS
+    Returns
+        @rtype string
+    '''
+    if not group:
+        return '{}'.format(group)
+    instances = group.get('NumberInstances') or {}
+    return "{name} {status} size={current}/{desired} routes={routes}".format(name=group.get('Name'), 
+                                                                            status=group.get('Status'),
+                                                                            current=instances.get('CurrentSize'),
+                                                                            desired=instances.get('Desired'),
+                                                                            routes=group.get('Routes'))
+    
+
+# Fields of a listed group used by the services (cf. GroupRecord)
+GROUP_FIELDS = ('Name', 'Id', 'Status', 'NumberInstances', 'Routes')
+
+
+class GroupRecord(object):
+    ''' Compact record of a listed group: only the fields in GROUP_FIELDS are kept, in slots rather than in a
+    dict. Supports the read-only dict operations used on JSON groups (group['Name'], group.get('Routes'), 
+    'Routes' in group) so that records and JSON groups can be used interchangeably. A field is present only 
+    if it was both listed and projected.
+    '''
+    __slots__ = GROUP_FIELDS
+    
+    def __init__(self, group, fields=GROUP_FIELDS):
+        ''' Class initializer
+        
+        Parameters
+            @param group dict: JSON group as returned by CCS
+            @param fields tuple: fields (a subset of GROUP_FIELDS) to keep
+        '''
+        for field in fields:
+            if field in group:
+                setattr(self, field, group[field])
+    
+    def __contains__(self, field):
+        return field in GROUP_FIELDS and hasattr(self, field)
+    
+    def __getitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        return getattr(self, field)
+    
+    def get(self, field, default=None):
+        return getattr(self, field, default) if field in GROUP_FIELDS else default
+    
+    def to_dict(self):
+        ''' Returns
+            @rtype dict: the fields present (as a JSON group)
+        '''
+        return dict([(field, getattr(self, field)) for field in GROUP_FIELDS if hasattr(self, field)])
+    
+    def __repr__(self):
+        return 'GroupRecord({})'.format(self.to_dict())
+
+
+def iter_json_array(chunks):
+    ''' Parse a JSON array incrementally, yielding each element as soon as it has been read. Only the
+    element being parsed (and the unparsed remainder of the current chunk) is held in memory.
+    
+    Parameters
+        @param chunks iterable: successive pieces of the serialized array (e.g. response.iter_content())
+    Returns
+        @rtype generator: the elements of the array
+    Raises
+        ValueError: if the text is not a JSON array
+    '''
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    started = False
+    exhausted = False
+    while True:
+        buffer = buffer.lstrip()
+        if not started and buffer:
+            if '[' != buffer[0]:
+                raise ValueError('Not a JSON array: {}'.format(buffer[:80]))
+            buffer, started = buffer[1:], True
+            continue
+        if started and buffer[:1] in [',', ']']:
+            if ']' == buffer[0]:
+                return
+            buffer = buffer[1:]
+            continue
+        if started and buffer:
+            try:
+                element, end = decoder.raw_decode(buffer)
+                # a number is only complete once it is followed by a delimiter (it may continue in the next chunk)
+                if exhausted or not isinstance(element, (int, long, float)) or buffer[end:end + 1] in [',', ']', ' ', '\t', '\r', '\n']:
+                    yield element
+                    buffer = buffer[end:]
+                    continue
+            except ValueError:
+                if exhausted:
+                    raise
+        if exhausted:
+            raise ValueError('Truncated JSON array')
+        try:
+            buffer += next(chunks)
+        except StopIteration:
+            exhausted = True
+
+
+def http_session(pool_connections=4, pool_maxsize=10, pool_block=False):
+    ''' Create an HTTP session that keeps connections alive and reuses them across requests.
+    A single session can be shared by several service objects (cf. ContainerCloudService and ActiveDeployService).
+    
+    Parameters
+        @param pool_connections int: number of hosts for which a connection pool is kept
+        @param pool_maxsize int: maximum number of connections kept open to any one host
+        @param pool_block boolean: if True, block when pool_maxsize connections to a host are in use rather 
+            than opening (and then discarding) an extra connection
+    Returns
+        @rtype requests.Session
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def ccs_url_from_env():
+    ''' Returns
+        @rtype string: URL of the container service, derived from $CCS_API_HOST (which may or may not include the scheme)
+    '''
+    ccs_api_host = os.getenv('CCS_API_HOST', '')
+    return '{}/v3/containers'.format(ccs_api_host if '://' in ccs_api_host else 'https://{}'.format(ccs_api_host))
+
+
+def to_seconds(duration):
+    ''' Convert a duration of the form HhMmSs (any part may be omitted) to a number of seconds.
+    
+    Parameters
+        @param duration: string of the form HhMmSs or a number of seconds
+    Returns
+        @rtype int: number of seconds; 0 if the duration cannot be parsed
+    '''
+    if isinstance(duration, (int, long, float)):
+        return int(duration)
+    seconds = 0
+    number = ''
+    for c in (duration or '').strip().lower():
+        if c.isdigit() or '.' == c:
+            number += c
+        elif c in 'hms' and number:
+            seconds += float(number) * {'h': 3600, 'm': 60, 's': 1}[c]
+            number = ''
+        else:
+            return 0
+    if number:
+        seconds += float(number)
+    return int(round(seconds))
+
+
+class PollingStrategy:
+    ''' Determines how long to sleep between successive polls of the state of an asynchronous operation.
+    This base strategy polls at a fixed interval.
+    '''
+    
+    def __init__(self, interval=5):
+        self._interval = interval
+    
+    def interval(self, attempt):
+        ''' Nominal time to sleep after poll number attempt (counting from 0). '''
+        return self._interval
+    
+    def delay(self, attempt, elapsed, max_wait):
+        ''' Time to sleep after poll number attempt; never sleeps past the deadline.
+        
+        Parameters
+            @param attempt int: number of the poll just made (counting from 0)
+            @param elapsed float: time (seconds) since polling started
+            @param max_wait float: maximum time (seconds) to poll
+        Returns
+            @rtype float: number of seconds to sleep before polling again; None if no time remains
+        '''
+        remaining = max_wait - elapsed
+        if remaining <= 0:
+            return None
+        return min(self.interval(attempt), remaining)
+
+
+class BackoffPollingStrategy(PollingStrategy):
+    ''' Polls quickly at first, then backs off exponentially (with random jitter) up to a maximum interval. '''
+    
+    def __init__(self, initial=1, factor=2, max_interval=15, jitter=0.2):
+        ''' Class initializer
+        
+        Parameters
+            @param initial float: time to sleep after the first poll
+            @param factor float: factor by which the interval grows after each poll
+            @param max_interval float: maximum time to sleep between polls
+            @param jitter float: fraction by which each interval is randomly varied
+        '''
+        self._initial = initial
+        self._factor = factor
+        self._max_interval = max_interval
+        self._jitter = jitter
+    
+    def interval(self, attempt):
+        interval = min(self._max_interval, self._initial * (self._factor ** attempt))
+        return min(self._max_interval, interval * random.uniform(1 - self._jitter, 1 + self._jitter))
+
+
+class DelayedPollingStrategy(PollingStrategy):
+    ''' Does not poll again until some time has passed (e.g. the time before which an operation rarely completes;
+    cf. history.History.first_poll()), then polls as another strategy does.
+    '''
+    
+    def __init__(self, first, strategy):
+        ''' Class initializer
+        
+        Parameters
+            @param first float: time (seconds since polling started) before which no poll is made
+            @param strategy PollingStrategy: strategy used once that time has passed
+        '''
+        self._first = first
+        self._strategy = strategy
+    
+    def interval(self, attempt):
+        return self._strategy.interval(attempt)
+    
+    def delay(self, attempt, elapsed, max_wait):
+        if elapsed >= self._first:
+            return self._strategy.delay(attempt, elapsed, max_wait)
+        remaining = max_wait - elapsed
+        if remaining <= 0:
+            return None
+        return min(self._first - elapsed, remaining)
+
+
+# Strategy used when an operation does not specify one (cf. the polling option of ContainerCloudService methods)
+DEFAULT_POLLING = BackoffPollingStrategy()
+
+# Minimum time (seconds) allowed for a container group operation when the deadline is taken from the history
+MIN_HISTORY_WAIT = 60
+
+
+class CircuitBreaker:
+    ''' Fails calls to an endpoint fast once it is clearly down. After failure_threshold consecutive 
+    failures the circuit opens and calls are refused; after reset_timeout seconds a single trial call is 
+    allowed (half open): if it succeeds the circuit closes again, otherwise it stays open. Thread safe.
+    '''
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+    
+    def allow(self):
+        ''' Returns
+            @rtype boolean: True if a call may be made now
+        '''
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial and time.time() - self._opened_at >= self._reset_timeout:
+                self._trial = True
+                return True
+            return False
+    
+    def record(self, success):
+        ''' Record the outcome of a call. 
+        
+        Parameters
+            @param success boolean: False if the call failed in a way that suggests the endpoint is down
+        '''
+        with self._lock:
+            if success:
+                self._failures, self._opened_at = 0, None
+            else:
+                self._failures += 1
+                if self._trial or self._failures >= self._failure_threshold:
+                    if self._opened_at is None or self._trial:
+                        logging.getLogger(__name__).warning('Endpoint failed {} times in a row; failing calls for {}s'.format(self._failures, self._reset_timeout))
+                    self._opened_at = time.time()
+            self._trial = False
+    
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def circuit_breaker(url):
+    ''' Returns
+        @rtype CircuitBreaker: the breaker shared by all services calling the endpoint at url
+    '''
+    with _circuit_breakers_lock:
+        return _circuit_breakers.setdefault(url, CircuitBreaker())
+
+
+class RetryPolicy:
+    ''' Determines whether, and after how long, a failed REST call is retried.
+    
+    Responses are classified by status code: those in exit_statuses are accepted; 408, 429 and 5xx 
+    are retried; any other status (such as a 400 or 403) is permanent and returned at once. Exceptions 
+    raised by requests (timeouts, connection errors, broken responses) are retried, except those of an 
+    invalid URL; any other exception is a programming error and is raised. The delay between attempts grows 
+    exponentially (with jitter) unless the response includes a Retry-After header. The time spent 
+    sleeping between the attempts of one call is limited to budget seconds.
+    '''
+    
+    RETRY_STATUSES = [408, 429]
+    
+    # exceptions raised by requests that no retry can overcome
+    PERMANENT_EXCEPTIONS = (requests.exceptions.URLRequired, requests.exceptions.MissingSchema, 
+                            requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL)
+    
+    def __init__(self, max_attempts=3, initial_delay=1, factor=2, max_delay=30, jitter=0.2, budget=60):
+        ''' Class initializer
+        
+        Parameters
+            @param max_attempts int: default maximum number of attempts of a call
+            @param initial_delay float: time to sleep after the first failure
+            @param factor float: factor by which the delay grows after each failure
+            @param max_delay float: maximum time to sleep between attempts (including any Retry-After)
+            @param jitter float: fraction by which each delay is randomly varied
+            @param budget float: maximum total time (seconds) to sleep between the attempts of a single call
+        '''
+        self.max_attempts = max_attempts
+        self._backoff = BackoffPollingStrategy(initial=initial_delay, factor=factor, max_interval=max_delay, jitter=jitter)
+        self._max_delay = max_delay
+        self._budget = budget
+    
+    def retryable(self, response=None, exception=None):
+        ''' Returns
+            @rtype boolean: True if a call that returned response (or raised exception) should be retried
+        '''
+        if exception is not None:
+            return isinstance(exception, requests.exceptions.RequestException) and not isinstance(exception, self.PERMANENT_EXCEPTIONS)
+        return response.status_code in self.RETRY_STATUSES or response.status_code >= 500
+    
+    def delay(self, attempt, response=None):
+        ''' Time to sleep after failed attempt number attempt (counting from 0). '''
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(self._max_delay, max(0, float(retry_after)))
+            except ValueError:
+                date = parsedate_tz(retry_after)
+                if date:
+                    return min(self._max_delay, max(0, mktime_tz(date) - time.time()))
+        return self._backoff.interval(attempt)
+    
+    def call(self, rest, args, kwargs, exit_statuses, max_attempts=None, timeout=None, timeout_factor=1, 
+             breaker=None, metrics=None, service='rest'):
+        ''' Call rest(*args, **kwargs) until it returns an acceptable response, fails permanently, or 
+        the attempts (or the retry budget) are exhausted.
+        
+        Parameters
+            @param rest function: REST function to call; returns a requests.Response
+            @param args list: positional arguments of rest
+            @param kwargs dict: keyword arguments of rest
+            @param exit_statuses list: acceptable status codes
+            @param max_attempts int: maximum number of attempts; defaults to that of the policy
+            @param timeout float: if set, passed to rest as timeout (multiplied by timeout_factor after each failure)
+            @param timeout_factor float: factor by which the timeout grows after each failed attempt
+            @param breaker CircuitBreaker: if set, the calls are refused while the circuit is open
+            @param metrics Metrics: where the calls are recorded
+            @param service string: label of the service called (for metrics)
+        Returns
+            @rtype (boolean, requests.Response): (success, last response; None if there was none)
+        Raises
+            any exception raised by rest other than those of requests
+        '''
+        max_attempts = max_attempts if max_attempts else self.max_attempts
+        operation = rest.__name__.lstrip('_')
+        slept = 0
+        r = None
+        for attempt in range(max_attempts):
+            if breaker and not breaker.allow():
+                logging.getLogger(__name__).warning('Not calling {}: {} appears to be down'.format(operation, service))
+                if metrics:
+                    metrics.observe_request(service, operation, 'circuit_open', 0, retry=attempt > 0)
+                return False, r
+            if timeout is not None:
+                kwargs['timeout'] = timeout
+            outcome = 'exception'
+            exception = None
+            start_time = time.time()
+            try:
+                r = rest(*args, **kwargs)
+                outcome = r.status_code
+            except requests.exceptions.Timeout as e:
+                outcome, exception = 'timeout', e
+                logging.getLogger(__name__).debug('Timeout exception executing {}'.format(rest.__name__))
+            except requests.exceptions.RequestException as e:
+                exception = e
+                logging.getLogger(__name__).debug('Exception occurred executing {}'.format(rest.__name__), exc_info=True)
+            finally:
+                if metrics:
+                    metrics.observe_request(service, operation, outcome, time.time() - start_time, retry=attempt > 0)
+            
+            if exception is None and r.status_code in exit_statuses:
+                if breaker:
+                    breaker.record(True)
+                return True, r
+            retry = self.retryable(response=r if exception is None else None, exception=exception)
+            if breaker and (exception is None or retry):
+                # a permanent error response is still evidence that the endpoint is up (an invalid URL is evidence of nothing)
+                breaker.record(not retry)
+            if not retry:
+                logging.getLogger(__name__).debug('{} failed permanently ({})'.format(rest.__name__, outcome))
+                return False, r if exception is None else None
+            
+            if attempt + 1 < max_attempts:
+                delay = self.delay(attempt, r if exception is None else None)
+                if slept + delay > self._budget:
+                    logging.getLogger(__name__).debug('Retry budget of {}s for {} exhausted'.format(self._budget, rest.__name__))
+                    break
+                time.sleep(delay)
+                slept += delay
+                if timeout is not None:
+                    timeout = timeout * timeout_factor
+        return False, r
+
+
+# Policy used by services not given their own (cf. the retry_policy option of ContainerCloudService and ActiveDeployService)
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class GroupCache:
+    ''' Cache of the results of group inspections (cf. ContainerCloudService.inspect_group()).
+    Entries expire after ttl seconds; the least recently used entry is evicted when max_size entries are cached.
+    Counts hits and misses so the number of round trips saved can be reported.
+    '''
+    
+    def __init__(self, ttl=10, max_size=256):
+        ''' Class initializer
+        
+        Parameters
+            @param ttl float: number of seconds for which an entry is valid
+            @param max_size int: maximum number of entries
+        '''
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, name):
+        ''' Look up the cached inspection of a group.
+        
+        Parameters
+            @param name string: name of group
+        Returns
+            @rtype (JSON group, explanation string) as returned by inspect_group(); None if not cached (or expired)
+        '''
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None or time.time() - entry[0] > self._ttl:
+                self.misses += 1
+                return None
+            # reinsert to mark as most recently used
+            self._entries[name] = entry
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, name, value):
+        ''' Cache the inspection of a group. '''
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = (time.time(), value)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, name):
+        ''' Remove any cached inspection of a group. '''
+        with self._lock:
+            self._entries.pop(name, None)
+    
+    def stats(self):
+        ''' Returns
+            @rtype dict: number of hits, misses and current entries
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+class Metrics:
+    ''' Thread safe collection of request, retry and wait statistics for ContainerCloudService and ActiveDeployService.
+    Can be exported in the Prometheus text format (for example, for a node exporter textfile collector) or as JSON.
+    Waits of a named group are also recorded in the deploy history, if there is one (cf. history.History).
+    '''
+    
+    # upper bounds (seconds) of the buckets of the request latency histograms
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+    
+    def __init__(self, history=None):
+        ''' Class initializer
+        
+        Parameters
+            @param history history.History: if set, where individual waits are recorded
+        '''
+        self.history = history
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self._requests = {}   # (service, operation, status) -> [count, sum, bucket counts]
+            self._retries = {}    # (service, operation) -> count
+            self._waits = {}      # (activity, outcome) -> [count, iterations, seconds]
+    
+    def observe_request(self, service, operation, status, seconds, retry=False):
+        ''' Record a REST call.
+        
+        Parameters
+            @param service string: service called (e.g. 'ccs' or 'active_deploy')
+            @param operation string: operation (e.g. 'inspect_group')
+            @param status: HTTP status code or one of 'timeout' or 'exception'
+            @param seconds float: time taken by the call
+            @param retry boolean: True if the call was a retry of a previous (failed) call
+        '''
+        with self._lock:
+            entry = self._requests.setdefault((service, operation, '{}'.format(status)), [0, 0.0, [0] * len(self.BUCKETS)])
+            entry[0] += 1
+            entry[1] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    entry[2][i] += 1
+            if retry:
+                self._retries[(service, operation)] = self._retries.get((service, operation), 0) + 1
+    
+    def observe_wait(self, activity, iterations, seconds, outcome, name=None, phase=None):
+        ''' Record a wait (polling) loop.
+        
+        Parameters
+            @param activity string: what was waited for (e.g. 'resized')
+            @param iterations int: number of polls made
+            @param seconds float: time spent waiting
+            @param outcome: result of the wait (e.g. True/False or a return code)
+            @param name string: if set, name of the group waited for (the wait is then recorded in the history)
+            @param phase string: if set, the phase of an update waited for
+        '''
+        with self._lock:
+            entry = self._waits.setdefault((activity, '{}'.format(outcome)), [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += iterations
+            entry[2] += seconds
+        if self.history and name:
+            self.history.record('phase' if phase else 'ccs', phase or activity, seconds, name=name, polls=iterations, outcome=outcome)
+    
+    def record_retries(self):
+        ''' Record the number of retries of each operation in the history (if there is one). '''
+        if not self.history:
+            return
+        with self._lock:
+            retries = sorted(self._retries.iteritems())
+        for (service, operation), count in retries:
+            self.history.record('retries', '{}.{}'.format(service, operation), retries=count)
+    
+    def to_json(self):
+        ''' Returns
+            @rtype dict: JSON serializable representation of the metrics
+        '''
+        with self._lock:
+            return {
+                'requests': [{'service': service, 'operation': operation, 'status': status, 'count': count, 'seconds': total,
+                              'buckets': dict([('{}'.format(bound), n) for bound, n in zip(self.BUCKETS, buckets)])}
+                             for (service, operation, status), (count, total, buckets) in sorted(self._requests.iteritems())],
+                'retries': [{'service': service, 'operation': operation, 'count': count}
+                            for (service, operation), count in sorted(self._retries.iteritems())],
+                'waits': [{'activity': activity, 'outcome': outcome, 'count': count, 'iterations': iterations, 'seconds': total}
+                          for (activity, outcome), (count, iterations, total) in sorted(self._waits.iteritems())]
+            }
+    
+    def to_prometheus(self):
+        ''' Returns
+            @rtype string: the metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            lines.append('# TYPE ccs_request_duration_seconds histogram')
+            for (service, operation, status), (count, total, buckets) in sorted(self._requests.iteritems()):
+                labels = 'service="{}",operation="{}",status="{}"'.format(service, operation, status)
+                for bound, n in zip(self.BUCKETS, buckets):
+                    lines.append('ccs_request_duration_seconds_bucket{{{labels},le="{le}"}} {n}'.format(labels=labels, le='+Inf' if bound == float('inf') else bound, n=n))
+                lines.append('ccs_request_duration_seconds_sum{{{labels}}} {total}'.format(labels=labels, total=total))
+                lines.append('ccs_request_duration_seconds_count{{{labels}}} {count}'.format(labels=labels, count=count))
+            lines.append('# TYPE ccs_retries_total counter')
+            for (service, operation), count in sorted(self._retries.iteritems()):
+                lines.append('ccs_retries_total{{service="{}",operation="{}"}} {}'.format(service, operation, count))
+            lines.append('# TYPE ccs_waits_total counter')
+            lines.append('# TYPE ccs_wait_iterations_total counter')
+            lines.append('# TYPE ccs_wait_seconds_total counter')
+            for (activity, outcome), (count, iterations, total) in sorted(self._waits.iteritems()):
+                labels = 'activity="{}",outcome="{}"'.format(activity, outcome)
+                lines.append('ccs_waits_total{{{}}} {}'.format(labels, count))
+                lines.append('ccs_wait_iterations_total{{{}}} {}'.format(labels, iterations))
+                lines.append('ccs_wait_seconds_total{{{}}} {}'.format(labels, total))
+        return '\n'.join(lines) + '\n'
+    
+    def write(self, path):
+        ''' Write the metrics to a file: JSON if the path ends with '.json', the Prometheus text format otherwise.
+        Any '{pid}' in the path is replaced by the process id (so several processes can export to one directory).
+        '''
+        path = path.replace('{pid}', '{}'.format(os.getpid()))
+        text = json.dumps(self.to_json(), indent=2) if path.endswith('.json') else self.to_prometheus()
+        # write then rename so a collector never reads a partial file
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.rename(path + '.tmp', path)
+
+
+# Metrics of all services not given their own Metrics object (recorded in the history at $AD_HISTORY_DB, if set)
+METRICS = Metrics(history=history.from_env())
+
+
+def _export_metrics():
+    try:
+        METRICS.write(os.getenv('CCS_METRICS_FILE'))
+    except:
+        logging.getLogger(__name__).debug('Unable to export metrics', exc_info=True)
+
+# Export the metrics at process exit if $CCS_METRICS_FILE is set
+if os.getenv('CCS_METRICS_FILE'):
+    atexit.register(_export_metrics)
+
+# Record the retries of this process in the history at exit
+if METRICS.history:
+    atexit.register(METRICS.record_retries)
+
+
+class CFConfig:
+    ''' Cached contents of the cf CLI configuration file (~/.cf/config.json). The file is parsed again only 
+    when it changes (its modification time or size differs from when it was last read), so a token refreshed
+    by the cf CLI is picked up without recreating the services that use it. Thread safe.
+    '''
+    
+    def __init__(self, path=None):
+        ''' Class initializer
+        
+        Parameters
+            @param path string: path of the configuration file; defaults to $HOME/.cf/config.json
+        '''
+        self.path = path if path else os.path.join(os.getenv('HOME', '~'), '.cf', 'config.json')
+        self._lock = threading.Lock()
+        self._signature = None
+        self._config = None
+    
+    def get(self):
+        ''' Returns
+            @rtype dict: the configuration, (re)read if the file has changed since it was last read
+        '''
+        st = os.stat(self.path)
+        signature = (st.st_mtime, st.st_size, st.st_ino)
+        with self._lock:
+            if signature != self._signature:
+                logging.getLogger(__name__).debug('Reading {}'.format(self.path))
+                with open(self.path) as f:
+                    self._config = json.loads(f.read())
+                self._signature = signature
+            return self._config
+    
+    def space_guid(self):
+        return self.get()['SpaceFields']['Guid']
+    
+    def auth_token(self):
+        return self.get()['AccessToken']
+    
+    def target(self):
+        return self.get().get('Target')
+    
+    def refresh_token(self):
+        ''' Obtain a new token, after one has been rejected. If the file has not already been updated 
+        (by another process) with a new token, 'cf oauth-token' is used to refresh it.
+        
+        Returns
+            @rtype boolean: True if a different token is now available
+        '''
+        old = self._config['AccessToken'] if self._config else None
+        if self.auth_token() != old:
+            return True
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['cf', 'oauth-token'], stdout=devnull, stderr=devnull)
+        except:
+            logging.getLogger(__name__).debug('Unable to refresh token', exc_info=True)
+            return False
+        return self.auth_token() != old
+
+
+_cf_configs = {}
+_cf_configs_lock = threading.Lock()
+
+def cf_config(path=None):
+    ''' Returns
+        @rtype CFConfig: the configuration shared by all services reading the file at path (default $HOME/.cf/config.json)
+    '''
+    config = CFConfig(path)
+    with _cf_configs_lock:
+        return _cf_configs.setdefault(config.path, config)
+
+
 class CloudFoundaryService:
+    ''' Client of the Cloud Foundry (v2) REST API of the targeted space. List resources are read page by page;
+    the summary of the applications of the space (names, states, instances and routes) is read in a single
+    call and cached for summary_ttl seconds (changes made through this object invalidate it).
+    '''
     
-    def __init__(self, base_url = 'https://api.ng.bluemix.net'):
-        self._config = json.loads(open(os.path.join(os.getenv('HOME', '~'), '.cf', 'config.json')).read())
+    def __init__(self, base_url = 'https://api.ng.bluemix.net', config = None, session = None, metrics = None, retry_policy = None, summary_ttl = 5):
+        ''' Class initializer
+        
+        Parameters
+            @param base_url string: URL of CF API; defaults to the target of the cf CLI
+            @param config CFConfig: cf CLI configuration; defaults to the shared cf_config()
+            @param session requests.Session: HTTP session (connection pool) to use; cf. http_session()
+            @param metrics Metrics: where request statistics are recorded; defaults to METRICS
+            @param retry_policy RetryPolicy: determines how failed calls are retried; defaults to DEFAULT_RETRY_POLICY
+            @param summary_ttl float: number of seconds for which the summary of the space is cached
+        '''
+        self._config = config if config else cf_config()
+        self._base_url = base_url
+        self._session = session
+        self.metrics = metrics if metrics else METRICS
+        self.retry_policy = retry_policy if retry_policy else DEFAULT_RETRY_POLICY
+        self._summary_ttl = summary_ttl
+        self._summary = None    # (time read, list of app summaries)
+        self._lock = threading.Lock()
     
     def space_guid(self):
-        return self._config['SpaceFields']['Guid']
+        return self._config.space_guid()
     
     def auth_token(self):
-        return self._config['AccessToken']
+        return self._config.auth_token()
+    
+    def refresh_token(self):
+        ''' Obtain a new token after the current one was rejected (cf. CFConfig.refresh_token()).
+        
+        Returns
+            @rtype boolean: True if a different token is now available
+        '''
+        return self._config.refresh_token()
+    
+    def base_url(self):
+        ''' Returns
+            @rtype string: URL of CF API (the target of the cf CLI if none was given)
+        '''
+        if not self._base_url:
+            self._base_url = self._config.target() or 'https://api.ng.bluemix.net'
+        return self._base_url.rstrip('/')
+    
+    @property
+    def session(self):
+        with self._lock:
+            if not self._session:
+                self._session = http_session()
+            return self._session
+    
+    #
+    # Methods to do basic (REST) operations on the CF API. These methods log the request and response (in case of error)
+    #
+    def _request(self, method, url, body=None, params=None, timeout=10):
+        ''' Wrapper for calls to the CF API.
+        
+        Parameters
+            @param method string: HTTP method
+            @param url string: URL of resource; relative to the API (starting with /v2/) or absolute
+            @param body dict: if set, body to send (serialized as JSON)
+            @param params dict: if set, query parameters
+            @param timeout int: number of seconds to wait for call to return
+        Returns
+            @rtype requests.Response
+        '''
+        url = url if '://' in url else '{base_url}{resource}'.format(base_url=self.base_url(), resource=url)
+        headers = {
+            'Authorization': self.auth_token(),
+            'Accept': 'application/json'
+        }
+        data = None
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            data = json.dumps(body)
+        trace_request(method, url, headers, data, timeout=timeout)
+        retval = self.session.request(method, url, headers=headers, data=data, params=params, timeout=timeout)
+        if 401 == retval.status_code and self.refresh_token():
+            logging.getLogger(__name__).info('Token rejected; retrying with a refreshed token')
+            headers['Authorization'] = self.auth_token()
+            retval = self.session.request(method, url, headers=headers, data=data, params=params, timeout=timeout)
+        trace_response(method, url, headers, retval)
+        return retval
+    
+    def _get(self, url, params=None, timeout=10):
+        return self._request('GET', url, params=params, timeout=timeout)
+    
+    def _put(self, url, body=None, params=None, timeout=10):
+        return self._request('PUT', url, body, params=params, timeout=timeout)
+    
+    def _post(self, url, body, timeout=10):
+        return self._request('POST', url, body, timeout=timeout)
+    
+    def _delete(self, url, params=None, timeout=10):
+        return self._request('DELETE', url, params=params, timeout=timeout)
+    
+    def _with_retries(self, rest, *args, **kwargs):
+        ''' Execute a REST call until it is successful (response code is acceptable), fails permanently
+        or the retry policy gives up (cf. RetryPolicy).
+        
+        Parameters
+            @param rest function: REST function to be applied 
+        Options (kwargs may contain)
+            max_attempts - maximum number of attempts to try REST call; defaults to that of the retry policy
+            exit_statuses - list of valid exit statuses on which to terminate; defaults to [200, 201]
+        Returns
+            tuple: boolean, requests.Response
+        '''
+        max_attempts = kwargs.pop('max_attempts', None)
+        exit_statuses = kwargs.pop('exit_statuses', [200, 201])
+        return self.retry_policy.call(rest, args, kwargs, exit_statuses, max_attempts=max_attempts,
+                                      breaker=circuit_breaker(self.base_url()), metrics=self.metrics, service='cloud_foundry')
+    
+    def _invalidate(self):
+        with self._lock:
+            self._summary = None
+    
+    def resources(self, url, params=None, **options):
+        ''' Read all resources of a (paged) list, following the next_url of each page.
+        
+        Parameters
+            @param url string: relative URL of the list (e.g. /v2/routes)
+            @param params dict: query parameters of the first page; a list value (e.g. of 'q') is repeated
+        Returns
+            @rtype list: the resources (each with 'metadata' and 'entity'); None if a page could not be read
+        '''
+        resources = []
+        params = dict(params) if params else {}
+        params.setdefault('results-per-page', 100)
+        while url:
+            success, r = self._with_retries(self._get, url, params=params, **options)
+            if not success:
+                return None
+            page = r.json()
+            resources.extend(page.get('resources', []))
+            # next_url includes the query parameters
+            url, params = page.get('next_url'), None
+        return resources
+    
+    #
+    # Methods that do basic CF actions
+    #
+    def apps(self, refresh=False, **options):
+        ''' Summarize the applications of the space with a single call (GET /v2/spaces/<guid>/summary).
+        
+        Parameters
+            @param refresh boolean: if True, the cached summary is not used
+        Returns
+            @rtype list: dicts with the name, guid, state ('STARTED' or 'STOPPED'), instances and routes 
+                (list of host.domain[/path]) of each app; None if the summary could not be read
+        '''
+        with self._lock:
+            if not refresh and self._summary and time.time() - self._summary[0] < self._summary_ttl:
+                return self._summary[1]
+        success, r = self._with_retries(self._get, '/v2/spaces/{space}/summary'.format(space=self.space_guid()), **options)
+        if not success:
+            return None
+        try:
+            apps = [{
+                'name': app.get('name'),
+                'guid': app.get('guid'),
+                'state': app.get('state'),
+                'instances': app.get('instances'),
+                'routes': [route_url(route) for route in app.get('routes') or []]
+            } for app in r.json().get('apps', [])]
+        except:
+            logging.getLogger(__name__).debug("Invalid JSON response returned: {}".format(r.text))
+            return None
+        with self._lock:
+            self._summary = (time.time(), apps)
+        return apps
+    
+    def app(self, name, **options):
+        ''' Returns
+            @rtype dict: summary of the named app (cf. apps()); None if there is no such app
+        '''
+        return dict([(app['name'], app) for app in self.apps(**options) or []]).get(name)
+    
+    def routes_by_app(self, names, **options):
+        ''' Returns
+            @rtype dict: app name -> list of routes (None if there is no such app)
+        '''
+        apps = dict([(app['name'], app) for app in self.apps(**options) or []])
+        return dict([(name, apps[name]['routes'] if name in apps else None) for name in names])
+    
+    def scale(self, name, instances, **options):
+        ''' Change the number of instances of an app.
+        
+        Returns
+            @rtype (boolean, string): success and explanation
+        '''
+        return self._update(name, {'instances': instances}, **options)
+    
+    def stop(self, name, **options):
+        ''' Stop an app.
+        
+        Returns
+            @rtype (boolean, string): success and explanation
+        '''
+        return self._update(name, {'state': 'STOPPED'}, **options)
+    
+    def _update(self, name, body, **options):
+        app = self.app(name, **options)
+        if not app:
+            return False, "App '{name}' does not exist".format(name=name)
+        success, r = self._with_retries(self._put, '/v2/apps/{guid}'.format(guid=app['guid']), body, **options)
+        self._invalidate()
+        if not success:
+            return False, "Unable to update app '{name}'".format(name=name)
+        return True, ""
+    
+    def delete(self, name, **options):
+        ''' Delete an app (and its service bindings).
+        
+        Returns
+            @rtype (boolean, string): success and explanation; deleting an app that does not exist succeeds
+        '''
+        result = self._delete_app(name, self.app(name, **options), **options)
+        self._invalidate()
+        return result
+    
+    def _delete_app(self, name, app, **options):
+        if not app:
+            return True, ""
+        success, r = self._with_retries(self._delete, '/v2/apps/{guid}'.format(guid=app['guid']), params={'recursive': 'true'},
+                                        exit_statuses=[200, 202, 204, 404], **options)
+        if not success:
+            return False, "Unable to delete app '{name}'".format(name=name)
+        return True, ""
+    
+    def delete_apps(self, names, max_parallel=4, **options):
+        ''' Delete several apps concurrently, using at most max_parallel concurrent requests. The apps are 
+        identified from a single read of the space summary (which is read again only once all are deleted).
+        
+        Returns
+            @rtype dict: app name -> (boolean, explanation) as returned by delete()
+        '''
+        names = list(names)
+        if not names:
+            return {}
+        apps = self.apps(**options)
+        if apps is None:
+            return dict([(name, (False, 'Unable to list apps')) for name in names])
+        apps = dict([(app['name'], app) for app in apps])
+        pool = ThreadPool(max(1, min(max_parallel, len(names))))
+        try:
+            results = pool.map(lambda name: self._delete_app(name, apps.get(name), **options), names)
+        finally:
+            pool.close()
+            self._invalidate()
+        return dict(zip(names, results))
+    
+    def _domain_guid(self, domain, **options):
+        for kind in ['shared_domains', 'private_domains']:
+            domains = self.resources('/v2/{kind}'.format(kind=kind), params={'q': 'name:{}'.format(domain)}, **options)
+            if domains:
+                return domains[0]['metadata']['guid']
+        return None
+    
+    def map_route(self, name, domain, host, **options):
+        ''' Map the route host.domain to an app, creating the route if it does not exist.
+        
+        Returns
+            @rtype (boolean, string): success and explanation
+        '''
+        app = self.app(name, **options)
+        if not app:
+            return False, "App '{name}' does not exist".format(name=name)
+        domain_guid = self._domain_guid(domain, **options)
+        if not domain_guid:
+            return False, "Domain '{domain}' does not exist".format(domain=domain)
+        routes = self.resources('/v2/routes', params={'q': ['host:{}'.format(host), 'domain_guid:{}'.format(domain_guid)]}, **options)
+        if routes is None:
+            return False, "Unable to read route '{host}.{domain}'".format(host=host, domain=domain)
+        if routes:
+            route_guid = routes[0]['metadata']['guid']
+        else:
+            success, r = self._with_retries(self._post, '/v2/routes', {'host': host, 'domain_guid': domain_guid, 'space_guid': self.space_guid()}, **options)
+            if not success:
+                return False, "Unable to create route '{host}.{domain}'".format(host=host, domain=domain)
+            route_guid = r.json()['metadata']['guid']
+        success, r = self._with_retries(self._put, '/v2/routes/{route}/apps/{app}'.format(route=route_guid, app=app['guid']), **options)
+        self._invalidate()
+        if not success:
+            return False, "Unable to map route '{host}.{domain}' to '{name}'".format(host=host, domain=domain, name=name)
+        return True, ""
+
+
+def route_url(route):
+    ''' Returns
+        @rtype string: URL (host.domain[/path]) of a route of a CF space summary
+    '''
+    domain = (route.get('domain') or {}).get('name', '')
+    url = '{host}.{domain}'.format(host=route['host'], domain=domain) if route.get('host') else domain
+    return url + (route.get('path') or '')
+
+
+        
+class StatusReporter:
+    ''' Reports the status of updates to the toolchain broker (PATCH {url}/register_deploy/{service_id}).
+    Only changes of status are sent; they are sent from a background thread so that callers (such as a 
+    wait loop) are not delayed, and when several changes of the status of an update are queued only the 
+    latest is sent. Failed reports are retried a bounded number of times; a status whose report failed is 
+    sent again if it is reported again. Call flush() or close() before the process exits.
+    '''
+    
+    def __init__(self, url, service_id, token, session=None, max_attempts=3, retry_delay=2, timeout=10):
+        ''' Class initializer
+        
+        Parameters
+            @param url string: URL of the toolchain broker (cf. $AD_API_URL)
+            @param service_id string: identifier of the active deploy service instance (cf. $SERVICE_ID)
+            @param token string: toolchain token (cf. $TOOLCHAIN_TOKEN)
+            @param session requests.Session: HTTP session to use; cf. http_session()
+            @param max_attempts int: maximum number of times a report is attempted
+            @param retry_delay float: time (seconds) before the first retry; doubled for each further retry
+            @param timeout int: number of seconds to wait for each call to return
+        '''
+        self._url = '{url}/register_deploy/{sid}'.format(url=url, sid=service_id)
+        self._headers = {'Authorization': token, 'Content-Type': 'application/json'}
+        self._session = session if session else http_session(pool_connections=1, pool_maxsize=1)
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._timeout = timeout
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()   # update_id -> status not yet sent
+        self._reported = {}                         # update_id -> last status sent successfully
+        self._failed = {}                           # update_id -> status whose report failed (and was not since sent)
+        self._sending = None                        # (update_id, status) being sent
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='status-reporter')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    @staticmethod
+    def from_env(session=None):
+        ''' Returns
+            @rtype StatusReporter: reporter configured from $AD_API_URL, $SERVICE_ID and $TOOLCHAIN_TOKEN; 
+                None if no toolchain is available ($TOOLCHAIN_AVAILABLE is not 1)
+        '''
+        if '1' != os.getenv('TOOLCHAIN_AVAILABLE') or not os.getenv('AD_API_URL') or not os.getenv('SERVICE_ID'):
+            return None
+        return StatusReporter(os.getenv('AD_API_URL'), os.getenv('SERVICE_ID'), os.getenv('TOOLCHAIN_TOKEN'), session=session)
+    
+    def report(self, update_id, status):
+        ''' Queue a report of the status of an update; ignored if it is the status last reported. Does not block.
+        
+        Parameters
+            @param update_id string: identifier of the update
+            @param status string: status (e.g. 'in_progress' or 'completed')
+        '''
+        with self._condition:
+            self._pending.pop(update_id, None)
+            if self._reported.get(update_id) != status and self._sending != (update_id, status):
+                self._pending[update_id] = status
+                self._condition.notify_all()
+    
+    def flush(self, timeout=30):
+        ''' Wait for all queued reports to be sent (or to fail).
+        
+        Parameters
+            @param timeout float: maximum time (seconds) to wait
+        Returns
+            @rtype boolean: True if nothing remains to be sent and the latest report of each update was sent successfully
+        '''
+        deadline = time.time() + timeout
+        with self._condition:
+            while (self._pending or self._sending) and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+            return not (self._pending or self._sending or self._failed)
+    
+    def close(self, timeout=30):
+        ''' Flush queued reports and stop the background thread.
+        
+        Returns
+            @rtype boolean: True if all reports were sent (cf. flush())
+        '''
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            done = not (self._pending or self._sending)
+        if done:
+            self._thread.join()
+        return flushed
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                update_id, status = self._pending.popitem(last=False)
+                self._sending = (update_id, status)
+            sent = False
+            try:
+                sent = self._send(update_id, status)
+            finally:
+                with self._condition:
+                    if sent:
+                        self._reported[update_id] = status
+                        self._failed.pop(update_id, None)
+                    else:
+                        self._failed[update_id] = status
+                    self._sending = None
+                    self._condition.notify_all()
+    
+    def _send(self, update_id, status):
+        body = json.dumps({'update_id': update_id, 'ad_status': status.replace('_', ' ') if 'in_progress' != status else status})
+        delay = self._retry_delay
+        for attempt in range(self._max_attempts):
+            try:
+                r = self._session.patch(self._url, body, headers=self._headers, timeout=self._timeout)
+                if r.status_code < 300:
+                    return True
+                logging.getLogger(__name__).debug('Reporting status of update {id} returned {code}'.format(id=update_id, code=r.status_code))
+                if 400 <= r.status_code < 500 and r.status_code not in [408, 429]:
+                    break
+            except:
+                logging.getLogger(__name__).debug('Unable to report status of update {}'.format(update_id), exc_info=True)
+            if attempt + 1 < self._max_attempts:
+                time.sleep(delay)
+                delay *= 2
+        logging.getLogger(__name__).warning("Unable to report status '{status}' of update {id} to the toolchain".format(status=status, id=update_id))
+        return False
+
 
+# An active deploy update, as listed by ActiveDeployService.list_updates()
+Update = collections.namedtuple('Update', ['id', 'current_group', 'new_group', 'status', 'phase'])
 
+# Statuses of an update that is still active (the groups involved may not be part of another update)
+ACTIVE_STATUSES = ['in_progress', 'rolling_back', 'paused']
+
+
+class UpdateIndex:
+    ''' Index of updates by the groups they involve and by status. '''
+    
+    def __init__(self, updates):
+        ''' Class initializer
         
+        Parameters
+            @param updates list: Update records
+        '''
+        self.updates = list(updates)
+        self._by_group = collections.defaultdict(list)
+        self._by_status = collections.defaultdict(list)
+        for update in self.updates:
+            for group in set([update.current_group, update.new_group]):
+                if group:
+                    self._by_group[group].append(update)
+            self._by_status[update.status].append(update)
+    
+    def find(self, group=None, statuses=None):
+        ''' Returns
+            @rtype list: the updates involving group (any if None) with one of statuses (any if None), in listed order
+        '''
+        if group is None and not statuses:
+            return list(self.updates)
+        if group is None:
+            ids = set([id(u) for status in statuses for u in self._by_status.get(status, [])])
+            return [u for u in self.updates if id(u) in ids]
+        return [u for u in self._by_group.get(group, []) if not statuses or u.status in statuses]
+
+
 class ActiveDeployService:
     
-    def __init__(self, base_url = 'https://activedeployapi.ng.bluemix.net', cf = None, ccs = None):
-        self._ccs = ccs if ccs else ContainerCloudService()
+    def __init__(self, base_url = 'https://activedeployapi.ng.bluemix.net', cf = None, ccs = None, session = None, metrics = None, reporter = None, retry_policy = None):
+        ''' Class initializer
+        
+        Parameters
+            @param base_url string: URL of active deploy service
+            @param cf CloudFoundaryService: object providing access to CF REST API; defaults to that of ccs
+            @param ccs ContainerCloudService: container service
+            @param session requests.Session: HTTP session (connection pool) to use; defaults to that of ccs
+            @param metrics Metrics: where request and wait statistics are recorded; defaults to METRICS
+            @param reporter StatusReporter: if set, the status of updates seen by wait_phase() is reported to the toolchain
+            @param retry_policy RetryPolicy: determines how failed calls are retried; defaults to DEFAULT_RETRY_POLICY
+        '''
+        self.reporter = reporter
+        self.retry_policy = retry_policy if retry_policy else DEFAULT_RETRY_POLICY
+        self._breaker = circuit_breaker(base_url)
+        self.metrics = metrics if metrics else METRICS
+        self._ccs = ccs if ccs else ContainerCloudService(session=session)
         self._cf = cf if cf else self._ccs._cfapi
         self._base_url = '{}/v1'.format(base_url)
+        self._session = session if session else self._ccs.session
         
     #
     # Methods to do basic (REST) operations on container service. These methods log the request and response (in case of error)
     #
-    def _get(self, url, timeout=10):
-        ''' Wrapper for GET call to CCS.
+    def _get(self, url, timeout=10, params=None):
+        ''' Wrapper for GET call to active deploy service.
         
         Parameters
             @param url string: relative URL of resource to query 
             @param timeout int: number of seconds to wait for call to return
+            @param params dict: if set, query parameters
         Returns
             @rtype requests.Response
         '''
@@ -90,16 +1349,9 @@ class ActiveDeployService:
             'Authorization': self.__token(),
             'Accept': 'application/json'
         }
-        logging.getLogger(__name__).debug("[{timeout}] curl {headers} -X GET '{url}'".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]), 
-                                                                          url=url,
-                                                                          timeout=timeout))
-        retval = requests.get(url, headers=headers, timeout=timeout)
-        if retval.status_code == 400 or retval.status_code >= 500: 
-            logging.getLogger(__name__).debug("curl {headers} '{url}' returned {code}: {response_headers} {text}".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]),
-                                                                                                       url=url,
-                                                                                                       response_headers=retval.headers,
-                                                                                                       code=retval.status_code,
-                                                                                                       text=sanitize_message(retval.text)))
+        trace_request('GET', url, headers, timeout=timeout)
+        retval = self._send('GET', url, headers, params=params, timeout=timeout)
+        trace_response('GET', url, headers, retval)
         return retval
 
     def _delete(self, url, timeout=10):
@@ -108,58 +1360,61 @@ class ActiveDeployService:
             'Authorization': self.__token(),
             'Accept': 'application/json'
         }
-        logging.getLogger(__name__).debug("[{timeout}] curl {headers} -X DELETE '{url}'".format(timeout=timeout, 
-                                                                                                url=url, 
-                                                                                                headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()])))
-        retval = requests.delete(url, headers=headers, timeout=timeout)
-        if retval.status_code == 400 or retval.status_code >= 500: 
-            logging.getLogger(__name__).debug("curl {headers} '{url}' returned {code}: {response_headers} {text}".format(
-                                                headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]),
-                                                url=url,
-                                                response_headers=retval.headers,
-                                                code=retval.status_code,
-                                                text=sanitize_message(retval.text)))
+        trace_request('DELETE', url, headers, timeout=timeout)
+        retval = self._send('DELETE', url, headers, timeout=timeout)
+        trace_response('DELETE', url, headers, retval)
+        return retval
+
+    def _post(self, url, body, timeout=10, method='POST'):
+        ''' Wrapper for POST (or PUT) call to active deploy service.
+        
+        Parameters
+            @param url string: relative URL of resource
+            @param body string: body to send - serialized JSON
+            @param timeout int: number of seconds to wait for call to return
+            @param method string: one of 'POST' or 'PUT'
+        Returns
+            @rtype requests.Response
+        '''
+        url = '{base_url}/{resource}'.format(base_url=self._base_url, resource=url)
+        headers = {
+            'Authorization': self.__token(),
+            'Accept': 'application/json',
+            'content-type': 'application/json'
+        }
+        trace_request(method, url, headers, body, timeout=timeout)
+        retval = self._send(method, url, headers, data=body, timeout=timeout)
+        trace_response(method, url, headers, retval)
+        return retval
+
+    def _put(self, url, body, timeout=10):
+        return self._post(url, body, timeout=timeout, method='PUT')
+
+    def _send(self, method, url, headers, **kwargs):
+        ''' Send a request; if the token is rejected (401), refresh it and retry once. '''
+        retval = self._session.request(method, url, headers=headers, **kwargs)
+        if 401 == retval.status_code and self._cf.refresh_token():
+            logging.getLogger(__name__).info('Token rejected; retrying with a refreshed token')
+            headers['Authorization'] = self.__token()
+            retval = self._session.request(method, url, headers=headers, **kwargs)
         return retval
 
     def _with_retries(self, rest, *args, **kwargs):
-        ''' Execute a 
+        ''' Execute a REST call until it is successful (response code is acceptable), fails permanently
+        or the retry policy gives up (cf. RetryPolicy).
+        
         Parameters
             @param rest function: REST function to be applied 
         Options (kwargs may contain)
-            max_attempts - maximum number of attempts to try REST call; defaults to 3
+            max_attempts - maximum number of attempts to try REST call; defaults to that of the retry policy
             exit_statuses - list of valid exit statuses on which to terminate; defaults to [200, 201]
         Returns
             tuple: boolean, requests.Response
         '''
-        # Set defaults; extract optional config values from kwargs
-        max_attempts=3
-        if 'max_attempts' in kwargs:
-            max_attempts = kwargs.get('max_attempts')
-            del kwargs['max_attempts']
-        exit_statuses = [200, 201]
-        if 'exit_statuses' in kwargs:
-            exit_statuses = kwargs.get('exit_statuses')
-            del kwargs['exit_statuses']
-        
-        # Try up to max_attempts times to successfully call rest()
-        # Retry in all failure cases:
-        #   (a) unacceptable status (not in exit_statuses)
-        #   (b) timeout waiting for response
-        #   (c) any other exception (in which case the exception is logged)
-        attempts = 0
-        while (attempts < max_attempts):
-            try:
-                r = rest(*args, **kwargs)
-                if r.status_code in exit_statuses:
-                    return True, r
-            except requests.exceptions.Timeout:
-                logging.getLogger(__name__).debug('Timeout exception executing {}'.format(rest.__name__))
-            except:
-                logging.getLogger(__name__).debug('Exception occurred executing {}'.format(rest.__name__), exc_info=True)
-            attempts += 1
-            time.sleep(5)      
-              
-        return False, None
+        max_attempts = kwargs.pop('max_attempts', None)
+        exit_statuses = kwargs.pop('exit_statuses', [200, 201])
+        return self.retry_policy.call(rest, args, kwargs, exit_statuses, max_attempts=max_attempts,
+                                      breaker=self._breaker, metrics=self.metrics, service='active_deploy')
         
     def _delete_update(self, name, **options):
         return self._delete('{space}/update/{name}/?force=true'.format(space=self._cf.space_guid(), name=name), **options)
@@ -193,45 +1448,290 @@ class ActiveDeployService:
             return json.loads(r.text), ""
         except:
             return None, "Invalid JSON response: {}".format(r.text)
+    
+    def update_record(self, name):
+        ''' Read the state of an update (with a single call to show()).
+        
+        Parameters
+            @param name string: identifier of the update
+        Returns
+            @rtype (Update, string): the record of the update (None if it could not be read) and an explanation
+        '''
+        update, reason = self.show(name)
+        if update is None:
+            return None, reason
+        update_status, phase, _, _ = self._progress(update)
+        return Update(update.get('id') or update.get('name') or name, update.get('current_group'), update.get('new_group'), update_status, phase), ""
+    
+    def _list_updates(self, params=None, **options):
+        return self._get('{space}/update/'.format(space=self._cf.space_guid()), params=params, **options)
+    
+    def list_updates(self, group=None, status=None):
+        ''' List updates (cf. cf active-deploy-list). The group and status are passed to the service as query
+        parameters, so a service that supports them returns fewer records; they are also applied to the result.
+        
+        Parameters
+            @param group string: if set, only updates from or to this group are listed
+            @param status string or list: if set, only updates with (one of) these statuses are listed
+        Returns
+            @rtype (list, string) where the elements have the following interpretation:
+                list of Update records, in the order returned by the service; None if they could not be read
+                explanation (when fails)
+        '''
+        statuses = [status] if isinstance(status, basestring) else status
+        params = {}
+        if group:
+            params['group'] = group
+        if statuses:
+            params['status'] = ','.join(statuses)
+        success, r = self._with_retries(self._list_updates, params=params or None, exit_statuses = [200], timeout=30)
+        if not success:
+            return None, 'Unable to list updates'
+        try:
+            updates = json.loads(r.text)
+        except:
+            return None, "Invalid JSON response: {}".format(r.text)
+        if isinstance(updates, dict):
+            updates = updates.get('updates') or updates.get('resources') or []
+        
+        records = []
+        for update in updates:
+            update_status, phase, _, _ = self._progress(update)
+            records.append(Update(update.get('id') or update.get('name'), update.get('current_group'), update.get('new_group'), update_status, phase))
+        return UpdateIndex(records).find(group, statuses), ""
+    
+    def _create(self, body, **options):
+        return self._post('{space}/update/'.format(space=self._cf.space_guid()), json.dumps(body), **options)
+    
+    def create(self, original, successor, rampup=None, test=None, rampdown=None, timeout='60s', manual=True):
+        ''' Create an update from group original to group successor (cf. cf active-deploy-create).
+        
+        Parameters
+            @param original string: name of the group (or app) currently routed
+            @param successor string: name of the group (or app) replacing it
+            @param rampup string: duration of the rampup phase (of the form HhMmSs); service default if None
+            @param test string: duration of the test phase; service default if None
+            @param rampdown string: duration of the rampdown phase; service default if None
+            @param timeout string: time to wait for the successor to be ready
+            @param manual boolean: if True, the update waits to be advanced at the end of each phase
+        Returns
+            @rtype (string, string): identifier of the new update (None on failure), explanation (when fails)
+        '''
+        body = {'current_group': original, 'new_group': successor, 'manual': manual, 'timeout': timeout}
+        for phase, duration in [('rampup', rampup), ('test', test), ('rampdown', rampdown)]:
+            if duration:
+                body[phase] = duration
+        success, r = self._with_retries(self._create, body, exit_statuses = [200, 201, 202, 409], timeout=60)
+        if not success:
+            return None, 'Unable to create update'
+        if 409 == r.status_code:
+            return None, 'Conflict: {}'.format(sanitize_message(r.text))
+        try:
+            update = json.loads(r.text)
+            return update.get('id') or update.get('name'), ""
+        except:
+            return None, "Invalid JSON response: {}".format(r.text)
+    
+    def _action(self, name, action, **options):
+        return self._put('{space}/update/{name}/'.format(space=self._cf.space_guid(), name=name), json.dumps({'action': action}), **options)
+    
+    def advance(self, name):
+        ''' Advance an update to its next phase (cf. cf active-deploy-advance).
+        
+        Returns
+            @rtype (boolean, string): indicator of success, explanation (when fails)
+        '''
+        success, r = self._with_retries(self._action, name, 'advance', exit_statuses = [200, 201, 202], timeout=30)
+        return success, "" if success else 'Unable to advance update'
+    
+    def rollback(self, name):
+        ''' Roll back an update (cf. cf active-deploy-rollback).
+        
+        Returns
+            @rtype (boolean, string): indicator of success, explanation (when fails)
+        '''
+        success, r = self._with_retries(self._action, name, 'rollback', exit_statuses = [200, 201, 202], timeout=30)
+        return success, "" if success else 'Unable to roll back update'
+    
+    def resume(self, name):
+        ''' Resume a paused update (cf. cf active-deploy-resume).
+        
+        Returns
+            @rtype (boolean, string): indicator of success, explanation (when fails)
+        '''
+        success, r = self._with_retries(self._action, name, 'resume', exit_statuses = [200, 201, 202], timeout=30)
+        return success, "" if success else 'Unable to resume update'
+    
+    def _progress(self, update):
+        ''' Extract the state of an update from its JSON representation (cf. show()).
+        The status and phase are read from the 'status' and 'phase' fields. The state of the current phase is read 
+        from the 'phases' field (either a list of objects with a 'name' field or an object keyed by phase name) 
+        whose entries have a 'duration' (seconds or a string of the form HhMmSs) and a 'status' or 'progress'.
+        
+        Parameters
+            @param update dict: JSON representation of an update
+        Returns
+            @rtype (string, string, boolean, int) where the elements have the following interpretation:
+                status of the update; one of 'in_progress', 'rolling_back', 'paused', 'completed', 'rolled_back', 'failed'
+                current phase; one of 'initial', 'rampup', 'test', 'rampdown', 'completed'
+                indicator that the current phase is complete
+                expected duration of the current phase in seconds (0 if unknown)
+        '''
+        status = (update.get('status') or '').lower().replace(' ', '_')
+        phase = (update.get('phase') or update.get('currentPhase') or '').lower()
+        
+        phases = update.get('phases') or {}
+        if isinstance(phases, list):
+            phases = dict([(p.get('name', '').lower(), p) for p in phases if isinstance(p, dict)])
+        current = phases.get(phase) or {}
+        
+        progress = '{}'.format(current.get('progress') or current.get('status') or '')
+        duration = current.get('duration') or update.get('{}_duration'.format(phase)) or ''
+        if isinstance(duration, basestring) and ' of ' in duration:
+            # of the form '2m of 5m' (as shown by cf active-deploy-show)
+            progress = progress or duration
+            duration = duration.split(' of ')[-1]
+        return status, phase, progress.startswith('completed'), to_seconds(duration)
+    
+    def wait_phase(self, update_id, min_max_wait=90, on_status=None, on_paused=None, from_start=False):
+        ''' Wait for the current phase of an update to complete.
+        Polls the update record, with a frequency adapted to the expected duration of the phase, for up to 
+        3 times that duration (but at least min_max_wait seconds). If the history is adaptive (cf. history.History), 
+        past durations of the phase (for the same app) determine instead how long to wait and when to poll first.
+        
+        Parameters
+            @param update_id string: identifier of the update
+            @param min_max_wait int: minimum time to wait for the phase to complete
+            @param on_status function: if set, called with (update_id, status) each time the update is read
+                and with (update_id, 'completed') when the phase completes; defaults to reporter.report (if a reporter is set)
+            @param on_paused function: if set, called with (update_id) to attempt to resume a paused update
+            @param from_start boolean: True if the phase has just started (the update was just created or advanced); 
+                only then is the time waited a duration of the phase (and recorded as such in the history)
+        Returns
+            @rtype int: one of
+                0 - the current phase (or the whole update) is complete
+                1 - the update is in the 'completed' phase
+                2 - the update has been rolled back (or is in the 'initial' phase)
+                3 - the update has failed
+                5 - the update has an unknown status or phase (or could not be read)
+                9 - the phase did not complete in the time allowed
+        '''
+        logging.getLogger(__name__).info('Update {} called wait'.format(update_id))
+        start_time = time.time()
+        if on_status is None and self.reporter:
+            on_status = self.reporter.report
+        state = {'polls': 0, 'group': None, 'phase': None, 'in_progress': False}
+        rc = self._wait_phase(update_id, start_time, state, min_max_wait, on_status, on_paused)
+        sample = from_start and state['in_progress']
+        self.metrics.observe_wait('phase', state['polls'], time.time() - start_time, rc, name=state['group'] if sample else None, phase=state['phase'])
+        return rc
+    
+    def _wait_phase(self, update_id, start_time, state, min_max_wait, on_status, on_paused):
+        max_wait = None
+        polling = DEFAULT_POLLING
+        attempt = 0
+        while True:
+            state['polls'] += 1
+            update, reason = self.show(update_id)
+            if update is None:
+                logging.getLogger(__name__).error('Unable to read update {id}: {reason}'.format(id=update_id, reason=reason))
+                return 5
+            status, phase, phase_completed, duration = self._progress(update)
+            if state['phase'] is None and phase in ['rampup', 'test', 'rampdown']:
+                # the phase waited for; the wait measures its duration only if it was in progress (not complete) when first read
+                state['group'], state['phase'] = update.get('new_group'), phase
+                state['in_progress'] = 1 == state['polls'] and 'in_progress' == status and not phase_completed
+            if on_status:
+                on_status(update_id, status)
+            
+            if 'completed' == status:
+                return 0
+            elif 'rolled_back' == status:
+                return 2
+            elif 'failed' == status:
+                return 3
+            elif 'paused' == status:
+                logging.getLogger(__name__).info('Update {} is paused; attempting to resume'.format(update_id))
+                if on_paused:
+                    on_paused(update_id)
+            elif status not in ['in_progress', 'rolling_back']:
+                logging.getLogger(__name__).error('Unknown status: {status} ({update})'.format(status=status, update=update))
+                return 5
+            
+            if 'initial' == phase:
+                # should only happen once a rollback is finished
+                return 2
+            elif 'completed' == phase:
+                return 1
+            elif phase not in ['rampup', 'test', 'rampdown']:
+                logging.getLogger(__name__).error('Unknown phase: {}'.format(phase))
+                return 5
+            
+            logging.getLogger(__name__).info('Update {id} is {status} in phase {phase}'.format(id=update_id, status=status, phase=phase))
+            if 'in_progress' == status and phase_completed:
+                if on_status:
+                    on_status(update_id, 'completed')
+                logging.getLogger(__name__).info('Phase {} is complete'.format(phase))
+                return 0
+            
+            # determine how long to wait (and how often to poll) from the expected duration of the phase
+            if max_wait is None:
+                max_wait = max(3 * duration, min_max_wait)
+                polling = BackoffPollingStrategy(initial=1, max_interval=max(3, min(15, duration / 10.0)))
+                if self.metrics.history:
+                    # the phase cannot complete before its declared duration
+                    max_wait = self.metrics.history.deadline('phase', phase, state['group'], max_wait, floor=max(duration, min_max_wait))
+                    first_poll = self.metrics.history.first_poll('phase', phase, state['group'])
+                    if first_poll:
+                        polling = DelayedPollingStrategy(first_poll, polling)
+                logging.getLogger(__name__).info('Phase {phase} has an expected duration of {duration}s; will wait {max_wait}s'.format(phase=phase, duration=duration, max_wait=max_wait))
+            
+            delay = polling.delay(attempt, time.time() - start_time, max_wait)
+            if delay is None:
+                return 9
+            time.sleep(delay)
+            attempt += 1
         
     def __token(self):
         t = self._cf.auth_token()
-        return 'bearer {}' if not t.lower().startswith('bearer ') else t
+        return 'bearer {}'.format(t) if not t.lower().startswith('bearer ') else t
 
 
 
 class ContainerCloudService:
     
-    def __init__(self, cfapi = None, base_url = 'https://containers-api.ng.bluemix.net/v3/containers'):
+    def __init__(self, cfapi = None, base_url = 'https://containers-api.ng.bluemix.net/v3/containers', session = None, cache = None, metrics = None, retry_policy = None):
         ''' Class initializer
         
         Parameters
             @param cfapi CloudFoundaryService: object providing access to CF REST API
             @param base_url string: URL of container service; should be in same Bluemix environment as cfapi
+            @param session requests.Session: HTTP session (connection pool) to use; cf. http_session()
+            @param cache GroupCache: if set, cache of group inspections; invalidated by any change to a group
+            @param metrics Metrics: where request and wait statistics are recorded; defaults to METRICS
+            @param retry_policy RetryPolicy: determines how failed calls are retried; defaults to DEFAULT_RETRY_POLICY
         '''
+        self.metrics = metrics if metrics else METRICS
+        self.retry_policy = retry_policy if retry_policy else DEFAULT_RETRY_POLICY
+        self._breaker = circuit_breaker(base_url)
         self._cfapi = cfapi if cfapi else CloudFoundaryService()
         self._base_url = base_url
-
-        logger = logging.getLogger()
-        logger.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-        handler1 = logging.StreamHandler(sys.stderr)
-        handler1.setLevel(logging.DEBUG)
-        handler1.setFormatter(formatter)
-        logger.addHandler(handler1)
-
+        self.session = session if session else http_session()
+        self.cache = cache
+        # if set (to a GroupWatcher), waits are served by the watcher rather than by polling the group
+        self.watcher = None
 
 
     #
     # Methods to do basic (REST) operations on container service. These methods log the request and response (in case of error)
     #
-    def get(self, url, timeout=10):
+    def get(self, url, timeout=10, stream=False):
         ''' Wrapper for GET call to CCS.
         
         Parameters
             @param url string: relative URL of resource to query 
             @param timeout int: number of seconds to wait for call to return
+            @param stream boolean: if True, the body is not read until it is accessed (cf. requests)
         Returns
             @rtype requests.Response
         '''
@@ -241,16 +1741,9 @@ class ContainerCloudService:
             'X-Auth-Token': self.__token(),
             'X-Auth-Project-Id': self._cfapi.space_guid()
         }
-        logging.getLogger(__name__).debug("[{timeout}] curl {headers} -X GET '{url}'".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]), 
-                                                                          url=url,
-                                                                          timeout=timeout))
-        retval = requests.get(url, headers=headers, timeout=timeout)
-        if retval.status_code == 400 or retval.status_code >= 500: 
-            logging.getLogger(__name__).debug("curl {headers} '{url}' returned {code}: {response_headers} {text}".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]),
-                                                                                                       url=url,
-                                                                                                       response_headers=retval.headers,
-                                                                                                       code=retval.status_code,
-                                                                                                       text=sanitize_message(retval.text)))
+        trace_request('GET', url, headers, timeout=timeout)
+        retval = self._send('GET', url, headers, timeout=timeout, stream=stream)
+        trace_response('GET', url, headers, retval)
         return retval
 
 
@@ -271,18 +1764,9 @@ class ContainerCloudService:
             'X-Auth-Token': self.__token(),
             'X-Auth-Project-Id': self._cfapi.space_guid()
         }
-        body_arg = " --data \'{0}\'".format(body.replace('\'', '\\\'')) if body else ''
-        logging.getLogger(__name__).debug("[{timeout}] curl {headers} -X POST '{url}' {body}".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]), 
-                                                                                     url=url, 
-                                                                                     body=body_arg,
-                                                                                     timeout=timeout))
-        retval = requests.post(url, body, headers=headers, timeout=timeout)
-        if retval.status_code == 400 or retval.status_code >= 500: 
-            logging.getLogger(__name__).debug("curl {headers} '{url}' returned {code}: {response_headers} {text}".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]),
-                                                                                                       url=url,
-                                                                                                       response_headers=retval.headers,
-                                                                                                       code=retval.status_code,
-                                                                                                       text=sanitize_message(retval.text)))
+        trace_request('POST', url, headers, body, timeout=timeout)
+        retval = self._send('POST', url, headers, data=body, timeout=timeout)
+        trace_response('POST', url, headers, retval)
         return retval
 
 
@@ -303,12 +1787,9 @@ class ContainerCloudService:
             'X-Auth-Token': self.__token(),
             'X-Auth-Project-Id': self._cfapi.space_guid()
         }
-        body_arg = " --data \'{0}\'".format(body.replace('\'', '\\\'')) if body else ''
-        logging.getLogger(__name__).debug("[{timeout}] curl {headers} -X PATCH '{url}' {body}".format(headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()]), 
-                                                                                      url=url, 
-                                                                                      body=body_arg,
-                                                                                      timeout=timeout))
-        retval = requests.patch(url, body, headers=headers, timeout=timeout)
+        trace_request('PATCH', url, headers, body, timeout=timeout)
+        retval = self._send('PATCH', url, headers, data=body, timeout=timeout)
+        trace_response('PATCH', url, headers, retval)
         return retval
 
 
@@ -326,10 +1807,18 @@ class ContainerCloudService:
             'X-Auth-Token': self.__token(),
             'X-Auth-Project-Id': self._cfapi.space_guid()
         }
-        logging.getLogger(__name__).debug("[{timeout}] curl {headers} -X DELETE '{url}'".format(timeout=timeout, 
-                                                                                                url=url, 
-                                                                                                headers=' '.join(["-H '{0}: {1}'".format(key, value) for key, value in sanitize_headers(headers).iteritems()])))
-        retval = requests.delete(url, headers=headers, timeout=timeout)
+        trace_request('DELETE', url, headers, timeout=timeout)
+        retval = self._send('DELETE', url, headers, timeout=timeout)
+        trace_response('DELETE', url, headers, retval)
+        return retval
+
+    def _send(self, method, url, headers, **kwargs):
+        ''' Send a request; if the token is rejected (401), refresh it and retry once. '''
+        retval = self.session.request(method, url, headers=headers, **kwargs)
+        if 401 == retval.status_code and self._cfapi.refresh_token():
+            logging.getLogger(__name__).info('Token rejected; retrying with a refreshed token')
+            headers['X-Auth-Token'] = self.__token()
+            retval = self.session.request(method, url, headers=headers, **kwargs)
         return retval
 
     def __token(self):
@@ -382,6 +1871,7 @@ class ContainerCloudService:
         if port:
             body['Port'] = port
         r = self.post('groups', json.dumps(body), **options)
+        self._invalidate(name)
         return r
     
     def _resize_group(self, name, desired, **options):
@@ -395,6 +1885,7 @@ class ContainerCloudService:
         '''
         body = {'NumberInstances': {'Desired': desired}}
         r = self.patch('groups/{name}'.format(name=name), json.dumps(body), **options)
+        self._invalidate(name)
         return r
     
     def _delete_group(self, name, **options):
@@ -406,6 +1897,7 @@ class ContainerCloudService:
             @rtype requests.Response: result of request to delete group
         '''
         r = self.delete('groups/{name}?force=true'.format(name=name), **options)
+        self._invalidate(name)
         return r
     
     def _inspect_group(self, name, **options):
@@ -419,6 +1911,11 @@ class ContainerCloudService:
         r = self.get('groups/{name}'.format(name=name), **options)
         return r
     
+    def _invalidate(self, name):
+        ''' Remove any cached inspection of a group (after a request to change it). '''
+        if self.cache:
+            self.cache.invalidate(name)
+    
     def _map(self, hostname, domain, name, **options):
         ''' Map a route to a container group
         
@@ -431,6 +1928,7 @@ class ContainerCloudService:
         '''
         r = self.post('groups/{name}/maproute'.format(name=name), 
                       json.dumps({'domain': domain, 'host':hostname}), **options)
+        self._invalidate(name)
         return r
     
     def _unmap(self, hostname, domain, name, **options):
@@ -445,6 +1943,7 @@ class ContainerCloudService:
         '''
         r = self.post('groups/{name}/unmaproute'.format(name=name), 
                       json.dumps({'domain': domain, 'host':hostname}), **options)
+        self._invalidate(name)
         return r
     
     
@@ -452,55 +1951,28 @@ class ContainerCloudService:
     # Utility methods that repeat actions and wait for successes
     #
     def _with_retries(self, rest, *args, **kwargs):
-        ''' Execute a REST call multiple times or until the call is successful (response code is acceptable).
-        Sleeps between attempts.
-        Doubles timeout if failure due to timeout exception. 
+        ''' Execute a REST call until it is successful (response code is acceptable), fails permanently
+        or the retry policy gives up (cf. RetryPolicy). Sleeps between attempts.
+        Doubles timeout after each failure. 
         
         Parameters
             @param rest function: REST function to be applied 
         Options (kwargs may contain)
-            max_attempts - maximum number of attempts to try REST call; defaults to 3
+            max_attempts - maximum number of attempts to try REST call; defaults to that of the retry policy
             exit_statuses - list of valid exit statuses on which to terminate; defaults to [200, 201]
             timeout - length of timeout for REST request
         Returns
             @rtype (boolean, requests.Response): (final success, response to REST call)
         '''
-        # Set defaults; extract optional config values from kwargs
-        max_attempts=3
-        if 'max_attempts' in kwargs:
-            max_attempts = kwargs.get('max_attempts')
-            del kwargs['max_attempts']
-        exit_statuses = [200, 201]
-        if 'exit_statuses' in kwargs:
-            exit_statuses = kwargs.get('exit_statuses')
-            del kwargs['exit_statuses']
-        timeout = 10
-        if 'timeout' in kwargs:
-            timeout = kwargs.get('timeout')
-            del kwargs['timeout']
-        
-        # Try up to max_attempts times to successfully call rest()
-        # Retry in all failure cases:
-        #   (a) unacceptable status (not in exit_statuses)
-        #   (b) timeout waiting for response
-        #   (c) any other exception (in which case the exception is logged)
-        attempts = 0
-        while (attempts < max_attempts):
-            try:
-                kwargs['timeout'] = timeout
-                r = rest(*args, **kwargs)
-                if r.status_code in exit_statuses:
-                    return True, r
-            except requests.exceptions.Timeout:
-                logging.getLogger(__name__).debug('Timeout exception executing {}'.format(rest.__name__))
-            except:
-                logging.getLogger(__name__).debug('Exception occurred executing {}'.format(rest.__name__), exc_info=True)
-            attempts += 1
-            timeout = 2 * timeout
-            time.sleep(5)      
-              
-        logging.getLogger(__name__).debug('Too many tries, returning')
-        return False, None
+        max_attempts = kwargs.pop('max_attempts', None)
+        exit_statuses = kwargs.pop('exit_statuses', [200, 201])
+        timeout = kwargs.pop('timeout', 10)
+        success, r = self.retry_policy.call(rest, args, kwargs, exit_statuses, max_attempts=max_attempts,
+                                            timeout=timeout, timeout_factor=2,
+                                            breaker=self._breaker, metrics=self.metrics, service='ccs')
+        if not success:
+            logging.getLogger(__name__).debug('{} did not succeed, returning'.format(rest.__name__))
+        return success, r
     
     def _wait_for(self, name, activity, evaluate, *args, **kwargs):
         ''' Repeatedly call a method to evaluate status of a group until some condition holds.
@@ -515,6 +1987,9 @@ class ContainerCloudService:
             Returns a tuple (string, string) defined as:
               action string - one of 'COMPLETE_SUCCESS', 'COMPLATE_FAIL' or 'CONTINUE'
               reason string - explanation of action
+        Options (kwargs may contain)
+            max_wait - maximum time to wait (seconds); defaults to 900 (cf. _plan_wait())
+            polling - PollingStrategy determining the time between polls; defaults to DEFAULT_POLLING
               
         Returns 
             @rtype (boolean, JSON group, string) where the elements have the following interpretation:
@@ -526,37 +2001,67 @@ class ContainerCloudService:
         if 'max_wait' in kwargs:
             max_wait = kwargs.get('max_wait')
             del kwargs['max_wait']
+        polling = kwargs.pop('polling', None) or DEFAULT_POLLING
+        max_wait, polling = self._plan_wait(name, evaluate, max_wait, polling)
+        if self.watcher:
+            return self.watcher.wait(name, activity, evaluate, args, kwargs, max_wait=max_wait)
 
-        logging.getLogger(__name__).debug("Waiting for group '{name}' {activity}".format(name=name, activity=activity))
+        logging.getLogger(__name__).debug("Waiting for group '%s' %s", name, activity)
         start_time = time.time()
-        elapsed_time = 0
-        while elapsed_time < max_wait:
+        attempt = 0
+        group = None
+        while True:
             try: 
                 # get state of group (use wrapper that calls multiple times if needed)
-                group, reason = self.inspect_group(name, timeout=30)
+                group, reason = self.inspect_group(name, timeout=30, use_cache=False)
+                elapsed_time = time.time() - start_time
                 # evaluate status (should take into account possibility that no group was returned)
-                logging.getLogger(__name__).debug('_wait_for discovered group {}'.format(group))
+                if logging.getLogger(__name__).isEnabledFor(logging.DEBUG):
+                    logging.getLogger(__name__).debug('_wait_for discovered group %s', describe_group(group))
                 action, action_reason = evaluate(group, reason, *args, **kwargs)
                 if action == 'COMPLETE_SUCCESS':
                     logging.getLogger(__name__).info("Group '{name}' {activity} completed successfully in {time}".format(name=name, activity=activity, time=elapsed_time))
+                    self.metrics.observe_wait(evaluate.__name__.lstrip('_'), attempt + 1, elapsed_time, True, name=name)
                     return True, group, ""
                 elif action == 'COMPLETE_FAIL':
                     logging.getLogger(__name__).info("Group '{name}' {activity} failed in {time} ({reason})".format(name=name, activity=activity, time=elapsed_time, reason=action_reason))
-                    logging.getLogger(__name__).debug("Group: {group}".format(group=group))
+                    logging.getLogger(__name__).debug("Group: %s", group)
+                    self.metrics.observe_wait(evaluate.__name__.lstrip('_'), attempt + 1, elapsed_time, False, name=name)
                     return False, group, action_reason
                 else: # action == CONTINUE
                     pass
 
             except:
                 logging.getLogger(__name__).debug('Exception', exc_info=True)
-            logging.getLogger(__name__).debug("Waiting for group '{name}' {activity}: sleeping 5s".format(name=name, activity=activity))
-            time.sleep(5)
-            elapsed_time = time.time() - start_time
+            delay = polling.delay(attempt, time.time() - start_time, max_wait)
+            if delay is None:
+                break
+            logging.getLogger(__name__).debug("Waiting for group '%s' %s: sleeping %.1fs", name, activity, delay)
+            time.sleep(delay)
+            attempt += 1
             
         too_long_msg = "Group '{name}' {activity} took too long ( > {time_allowed} s)".format(name=name, activity=activity, time_allowed=max_wait)
         logging.getLogger(__name__).debug(too_long_msg)
-        logging.getLogger(__name__).debug("Current group: {group}".format(group=group))
+        logging.getLogger(__name__).debug("Current group: %s", group)
+        self.metrics.observe_wait(evaluate.__name__.lstrip('_'), attempt + 1, time.time() - start_time, 'timeout', name=name)
         return False, group, too_long_msg
+    
+    def _plan_wait(self, name, evaluate, max_wait, polling):
+        ''' Adapt a wait for a group to past waits of the same kind (for the same app), if the history is adaptive: 
+        wait margin times the 95th percentile of their durations (at least MIN_HISTORY_WAIT seconds) and make no poll 
+        before their 10th percentile (cf. history.History).
+        
+        Returns
+            @rtype (float, PollingStrategy): maximum time to wait and polling strategy
+        '''
+        if not self.metrics.history:
+            return max_wait, polling
+        activity = evaluate.__name__.lstrip('_')
+        planned = self.metrics.history.deadline('ccs', activity, name, max_wait, floor=MIN_HISTORY_WAIT)
+        first_poll = self.metrics.history.first_poll('ccs', activity, name)
+        if planned != max_wait:
+            logging.getLogger(__name__).debug("Waiting for group '%s' %s: %ss allowed (from history)", name, activity, planned)
+        return planned, DelayedPollingStrategy(first_poll, polling) if first_poll else polling
         
     
     #
@@ -565,26 +2070,39 @@ class ContainerCloudService:
     #
     def inspect_group(self, name, *args, **kwargs):
         ''' Inspect a container group with retries.
+        When the service has a cache, a cached inspection is returned if available.
         
         Parameters
             @param name string: name of group
+        Options (kwargs may contain)
+            use_cache - if False, always query the group (refreshing the cache); defaults to True
         Returns
             @rtype (JSON group, explanation string) where the elements have the following interpretation:
                 JSON representation of group
                 explanation (when fails)
         '''
         logging.getLogger(__name__).debug('inspect_group called')
+        use_cache = kwargs.pop('use_cache', True)
+        if self.cache and use_cache:
+            cached = self.cache.get(name)
+            if cached:
+                return cached
+        
         success, r = self._with_retries(self._inspect_group, name, max_attempts = 5, exit_statuses = [200, 201, 404], *args, **kwargs)
         if not success:
             return None, "Unable to inspect group '{name}'".format(name=name)
         
         if 404 == r.status_code:
-            return None, "No such group as '{name}'".format(name=name)
+            result = None, "No such group as '{name}'".format(name=name)
+        else:
+            try:
+                result = json.loads(r.text), ""
+            except:
+                return None, "Invalid JSON response: {}".format(r.text)
         
-        try:
-            return json.loads(r.text), ""
-        except:
-            return None, "Invalid JSON response: {}".format(r.text)
+        if self.cache:
+            self.cache.put(name, result)
+        return result
 
     
     def _deleted(self, group, reason):
@@ -624,6 +2142,7 @@ class ContainerCloudService:
                 explanation (when fails)
         '''
         logging.getLogger(__name__).debug('delete_group called')
+        polling = kwargs.pop('polling', None)
         success, r = self._with_retries(self._delete_group, name=name, exit_statuses = [200, 201, 204, 404], *args, **kwargs)
         if not success:
             return False, None, 'Unable to initiate delete request'
@@ -632,7 +2151,7 @@ class ContainerCloudService:
             logging.getLogger(__name__).debug("Group '{name}' does not exist; exiting".format(name=name))
             return True, None, ''
         
-        return self._wait_for(name, 'deletion', self._deleted)
+        return self._wait_for(name, 'deletion', self._deleted, polling=polling)
         
             
     def forced_delete_group(self, name, *args, **kwargs):
@@ -658,10 +2177,89 @@ class ContainerCloudService:
             except:
                 logging.getLogger(__name__).debug('Exception', exc_info=True)
             attempts += 1
-            time.sleep(5)      
+            if attempts < max_attempts:
+                time.sleep(5)
               
         return False, None, "Unable to delete group '{name}' after {attempts} attempts".format(name=name, attempts=max_attempts)
 
+    def delete_groups(self, names, max_parallel=8, max_wait=900, *args, **kwargs):
+        ''' Delete several container groups concurrently with retries.
+        Delete requests are issued with at most max_parallel concurrent requests. The groups are then
+        watched together in a single polling loop until each is deleted, its deletion fails or max_wait 
+        seconds pass. Failed deletions are retried (as forced_delete_group() does).
+        
+        Parameters
+            @param names list: names of groups to delete
+            @param max_parallel int: maximum number of concurrent requests
+            @param max_wait int: maximum time to wait for the deletions (in each attempt)
+        Options (kwargs may contain)
+            polling - PollingStrategy used while waiting for the deletions; defaults to DEFAULT_POLLING
+        Returns
+            @rtype dict: group name -> (boolean, JSON group, explanation string) as returned by forced_delete_group()
+        '''
+        max_attempts = 3
+        polling = kwargs.pop('polling', None) or DEFAULT_POLLING
+        names = list(names)
+        results = {}
+        if not names:
+            return results
+        
+        pool = ThreadPool(max(1, min(max_parallel, len(names))))
+        try:
+            remaining = names
+            attempts = 0
+            while remaining and attempts < max_attempts:
+                logging.getLogger(__name__).debug('delete_groups attempt {} for {}'.format(attempts, remaining))
+                # issue all delete requests
+                responses = pool.map(lambda name: self._with_retries(self._delete_group, name=name, exit_statuses = [200, 201, 204, 404], *args, **kwargs), remaining)
+                pending = []
+                for name, (success, r) in zip(remaining, responses):
+                    if not success:
+                        results[name] = (False, None, 'Unable to initiate delete request')
+                    elif 404 == r.status_code:
+                        results[name] = (True, None, '')
+                    else:
+                        pending.append(name)
+                
+                # wait for all of the deletions in a single loop
+                start_time = time.time()
+                poll = 0
+                while pending:
+                    groups = pool.map(lambda name: self.inspect_group(name, timeout=30, use_cache=False), pending)
+                    waiting = []
+                    for name, (group, reason) in zip(pending, groups):
+                        action, action_reason = self._deleted(group, reason)
+                        if action == 'COMPLETE_SUCCESS':
+                            results[name] = (True, None, '')
+                        elif action == 'COMPLETE_FAIL':
+                            results[name] = (False, group, action_reason)
+                        else:
+                            waiting.append(name)
+                            continue
+                        if self.metrics.history:
+                            self.metrics.history.record('ccs', 'deleted', time.time() - start_time, name=name, polls=poll + 1, outcome=results[name][0])
+                    pending = waiting
+                    delay = polling.delay(poll, time.time() - start_time, max_wait)
+                    if not pending or delay is None:
+                        break
+                    logging.getLogger(__name__).debug('Waiting for deletion of %s: sleeping %.1fs', pending, delay)
+                    time.sleep(delay)
+                    poll += 1
+                self.metrics.observe_wait('deleted', poll + 1, time.time() - start_time, 'timeout' if pending else True)
+                for name in pending:
+                    results[name] = (False, None, "Group '{name}' deletion took too long ( > {time_allowed} s)".format(name=name, time_allowed=max_wait))
+                
+                remaining = [name for name in remaining if not results[name][0]]
+                attempts += 1
+                if remaining and attempts < max_attempts:
+                    time.sleep(5)
+        finally:
+            pool.close()
+        
+        for name in remaining:
+            results[name] = (False, None, "Unable to delete group '{name}' after {attempts} attempts".format(name=name, attempts=max_attempts))
+        return results
+
     
     def _created(self, group, reason):
         ''' Evaluation method for create_group() call to _wait_for() '''
@@ -698,6 +2296,7 @@ class ContainerCloudService:
                 JSON group
                 explanation (when fails)
         '''
+        polling = kwargs.pop('polling', None)
         logging.getLogger(__name__).debug("Checking if group '{name}' already exists".format(name=name))
         group, reason = self.inspect_group(name, timeout=30)
         if group:
@@ -715,13 +2314,13 @@ class ContainerCloudService:
             return False, None, "Unable to create group '{name}'".format(name=name)
         
         # wait for group to be created
-        created, group, reason = self._wait_for(name, 'creation', self._created)
+        created, group, reason = self._wait_for(name, 'creation', self._created, polling=polling, max_wait=max_wait)
         if created:
             return created, group, reason
         
         # if creation failed, delete the group if partially created
         if not created:
-            deleted, dgroup, reason = self.forced_delete_group(name)    
+            deleted, dgroup, reason = self.forced_delete_group(name, polling=polling)
         
         # if the deletion failed, we have a major issue
         if not deleted:
@@ -731,20 +2330,79 @@ class ContainerCloudService:
         logging.getLogger(__name__).debug("Deletion of group '{name}' complete; exiting".format(name=name))
         return False, None, "Unable to create group '{name}'".format(name=name)
     
-    def list_groups(self, *args, **kwargs):
-        ''' List container groups with retries.
+    def iter_groups(self, prefix=None, fields=GROUP_FIELDS, **kwargs):
+        ''' List container groups with retries. The response is parsed as it is read; only the groups whose
+        names start with prefix are kept, and only their projected fields.
+        
+        Parameters
+            @param prefix string: if set, only groups whose names start with prefix are returned
+            @param fields tuple: fields (a subset of GROUP_FIELDS) to keep
+        Returns
+            @rtype generator: GroupRecord of each group (to be iterated once); None if the groups could not be listed
+        Raises
+            ValueError: while iterating, if the response is not a (complete) JSON array; the groups were then not listed
+        '''
+        listed, response = self._with_retries(self._list_groups, stream=True, **kwargs)
+        if not listed:
+            return None
+        return self._records(response, prefix, fields)
+    
+    def _records(self, response, prefix, fields):
+        try:
+            for group in iter_json_array(response.iter_content(chunk_size=64 * 1024)):
+                if not prefix or (group.get('Name') or '').startswith(prefix):
+                    yield GroupRecord(group, fields)
+        except ValueError:
+            logging.getLogger(__name__).debug('Invalid JSON response returned', exc_info=True)
+            raise
+        finally:
+            response.close()
+    
+    def list_groups(self, prefix=None, fields=GROUP_FIELDS, **kwargs):
+        ''' List container groups with retries (cf. iter_groups()).
         
+        Parameters
+            @param prefix string: if set, only groups whose names start with prefix are returned
+            @param fields tuple: fields (a subset of GROUP_FIELDS) to keep
         Returns
-            @rtype list: list of JSON objects
+            @rtype list: GroupRecord of each group; None if the groups could not be listed
         '''
-        listed, response = self._with_retries(self._list_groups, *args, **kwargs)
+        groups = self.iter_groups(prefix, fields, **kwargs)
+        if groups is None:
+            return None
         try:
-            if listed:
-                return json.loads(response.text)
-        except:
-            logging.getLogger(__name__).debug("Invalid JSON response returned: {}".format(response.text))
-            pass
-        return []
+            return list(groups)
+        except ValueError:
+            return None
+    
+    def routes_by_group(self, names, max_parallel=8, *args, **kwargs):
+        ''' Identify the routes mapped to each of a set of container groups.
+        Uses a single list_groups() call when the listed groups include their routes. Otherwise, 
+        inspects the groups concurrently using at most max_parallel concurrent requests.
+        
+        Parameters
+            @param names list: names of groups
+            @param max_parallel int: maximum number of concurrent inspect requests
+        Returns
+            @rtype dict: group name -> list of routes (None if the group could not be read)
+        '''
+        names = list(names)
+        wanted = set(names)
+        listed = [g for g in self.list_groups(fields=('Name', 'Routes'), **kwargs) or [] if g.get('Name') in wanted]
+        if listed and all('Routes' in g for g in listed):
+            routes = dict([(name, None) for name in names])
+            routes.update([(g['Name'], g.get('Routes') or []) for g in listed])
+            return routes
+        
+        logging.getLogger(__name__).debug('Routes not listed; inspecting {} groups'.format(len(names)))
+        if not names:
+            return {}
+        pool = ThreadPool(max(1, min(max_parallel, len(names))))
+        try:
+            groups = pool.map(lambda name: self.inspect_group(name, *args, **kwargs)[0], names)
+        finally:
+            pool.close()
+        return dict([(name, (group.get('Routes') or []) if group else None) for name, group in zip(names, groups)])
     
         
     def _mapped(self, group, reason, route):
@@ -775,13 +2433,14 @@ class ContainerCloudService:
                 explanation (when fails)
         '''
         logging.getLogger(__name__).debug('map called')
+        polling = kwargs.pop('polling', None)
         accepted, response = self._with_retries(self._map, hostname, domain, name, *args, **kwargs)
         if not accepted:
             return False, None, "Unable to request routing change: {}".format(response.text if response else '')
         
         # wait until route appears in group inspect results
         route = '{host}.{domain}'.format(host=hostname, domain=domain)
-        return self._wait_for(name, 'map ({r})'.format(r=route), self._mapped, route)
+        return self._wait_for(name, 'map ({r})'.format(r=route), self._mapped, route, polling=polling)
 
     
     def _unmapped(self, group, reason, route):
@@ -813,13 +2472,14 @@ class ContainerCloudService:
         '''
         # issue API call 
         logging.getLogger(__name__).debug('unmap called')
+        polling = kwargs.pop('polling', None)
         accepted, response = self._with_retries(self._unmap, hostname, domain, name, *args, **kwargs)
         if not accepted:
             return False, response, "Unable to request routing change: {}".format(response.text if response else '')
         
         # wait until route no longer in inspect results
         route = '{host}.{domain}'.format(host=hostname, domain=domain)
-        return self._wait_for(name, 'unmap({r})'.format(r=route), self._unmapped, route)
+        return self._wait_for(name, 'unmap({r})'.format(r=route), self._unmapped, route, polling=polling)
     
     
     def _resized(self, group, reason):
@@ -855,6 +2515,7 @@ class ContainerCloudService:
                 explanation (when fails)
         '''
         logging.getLogger(__name__).debug('resize called with target size {size}'.format(size=desired))
+        polling = kwargs.pop('polling', None)
 
         # group should already exist, check first
         logging.getLogger(__name__).debug("Checking if group '{name}' already exists".format(name=name))
@@ -874,36 +2535,812 @@ class ContainerCloudService:
             return False, None, msg
         
         # wait for group to be resized
-        resized, group, reason = self._wait_for(name, 'resize', self._resized)
+        resized, group, reason = self._wait_for(name, 'resize', self._resized, polling=polling)
         logging.getLogger(__name__).info('After resize, {name} has {size} instances. Goal: {desired}'.format(name=name, size=group['NumberInstances']['CurrentSize'], desired=desired))
         if not resized:
             reason = "{reason}: {name} has {size} instances; wanted {desired}".format(reason=reason, name=name, size=group['NumberInstances']['CurrentSize'], desired=desired)
         return resized, group, reason
+    
+    
+    def _converged(self, group, reason, conditions, met):
+        ''' Evaluation method for converge() call to _wait_for(); evaluates each condition not yet met.
         
+        Parameters
+            @param conditions OrderedDict: label -> (evaluation method, additional arguments)
+            @param met dict: label -> explanation ('' if the condition was met); updated as conditions complete
+        '''
+        for label, (evaluate, args) in conditions.iteritems():
+            if label in met:
+                continue
+            action, action_reason = evaluate(group, reason, *args)
+            if action == 'COMPLETE_SUCCESS':
+                met[label] = ''
+            elif action == 'COMPLETE_FAIL':
+                met[label] = action_reason or '{} failed'.format(label)
+                return 'COMPLETE_FAIL', met[label]
+        if len(met) == len(conditions):
+            return 'COMPLETE_SUCCESS', ""
+        return 'CONTINUE', ""
     
-if __name__ == '__main__':
-    def timed_run(label, f, name, *args, **kwargs):
+    def converge(self, name, desired_size=None, routes=[], *args, **kwargs):
+        ''' Bring a group to a size and map routes to it. All of the changes are requested first; then a
+        single loop polls the group until every one of them has taken effect (cf. resize() and map()).
+        
+        Parameters
+            @param name string: name of group
+            @param desired_size int: if set, desired size of the group
+            @param routes list: routes to be mapped to the group; each of the form hostname.domain or a (hostname, domain) pair
+        Options (kwargs may contain)
+            polling - PollingStrategy used while waiting
+            max_wait - maximum time (seconds) to wait for all of the changes
+        Returns
+            @rtype (boolean, JSON group, OrderedDict) where the elements have the following interpretation:
+                indicator that every change took effect
+                JSON group
+                change ('resize' or 'map (route)') -> '' if it took effect, otherwise an explanation
+        '''
+        polling = kwargs.pop('polling', None)
+        max_wait = kwargs.pop('max_wait', 900)
+        
+        group, reason = self.inspect_group(name, timeout=30, use_cache=False)
+        if not group:
+            return False, None, collections.OrderedDict([('inspect', "No group named {name} exists. ({reason})".format(name=name, reason=reason))])
+        
+        # request all of the changes
+        conditions = collections.OrderedDict()
+        met = {}
+        if desired_size is not None:
+            label = 'resize'
+            conditions[label] = (self._resized, [])
+            if group.get('NumberInstances', {}).get('Desired') == desired_size and group.get('Status', '').endswith('_COMPLETE'):
+                met[label] = ''
+            else:
+                resized, response = self._with_retries(self._resize_group, name=name, desired=desired_size, exit_statuses = [200, 201, 204, 404], *args, **kwargs)
+                if not resized:
+                    met[label] = "Unable to resize group '{name}'".format(name=name)
+        for route in routes:
+            if isinstance(route, (list, tuple)):
+                hostname, domain = route
+                route = '{host}.{domain}'.format(host=hostname, domain=domain)
+            else:
+                hostname, _, domain = route.partition('.')
+            label = 'map ({r})'.format(r=route)
+            conditions[label] = (self._mapped, [route])
+            if not hostname or not domain:
+                met[label] = "Invalid route '{r}'; expected hostname.domain".format(r=route)
+                continue
+            if route in (group.get('Routes') or []):
+                met[label] = ''
+                continue
+            accepted, response = self._with_retries(self._map, hostname, domain, name, *args, **kwargs)
+            if not accepted:
+                met[label] = "Unable to request routing change: {}".format(response.text if response else '')
+        
+        # wait for all of them in a single loop
+        if len(met) < len(conditions) and all('' == explanation for explanation in met.values()):
+            success, group, reason = self._wait_for(name, 'converge', self._converged, conditions, met, polling=polling, max_wait=max_wait)
+        
+        outcome = collections.OrderedDict([(label, met.get(label, 'did not complete within {}s'.format(max_wait))) for label in conditions])
+        for label, explanation in outcome.iteritems():
+            logging.getLogger(__name__).info("Group '{name}' {label}: {result}".format(name=name, label=label, result=explanation or 'done'))
+        return all('' == explanation for explanation in outcome.values()), group, outcome
+        
+
+class AsyncResult:
+    ''' Result of an operation of AsyncContainerCloudService that may not yet be complete. '''
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._value = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+    
+    def set(self, value):
+        ''' Record the result of the operation and notify any waiters and callbacks. '''
+        with self._lock:
+            self._value = value
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(value)
+    
+    def done(self):
+        return self._event.is_set()
+    
+    def result(self, timeout=None):
+        ''' Wait (up to timeout seconds; forever if None) for the operation to complete.
+        
+        Returns
+            result of the operation; None if it is not complete
+        '''
+        self._event.wait(timeout)
+        return self._value
+    
+    def add_done_callback(self, callback):
+        ''' Call callback with the result of the operation once it is complete. '''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self._value)
+
+
+class GroupWatcher:
+    ''' Polls the state of all watched groups once per tick and dispatches changes to every waiter, so that 
+    the load of waiting on many groups does not grow with the number of groups. Each tick lists the groups 
+    (one call); if the list does not include the state needed by the waiters (the status and routes of each 
+    group) the watched groups are inspected instead, in parallel. A waiter's evaluation method (cf. 
+    ContainerCloudService._wait_for()) is called when the group is first seen and whenever it changes.
+    Set as the watcher of a ContainerCloudService to be used by its (and AsyncContainerCloudService's) waits.
+    '''
+    
+    def __init__(self, ccs, interval=2, max_parallel=8):
+        ''' Class initializer
+        
+        Parameters
+            @param ccs ContainerCloudService: service used to list (or inspect) groups
+            @param interval float: time (seconds) between polls
+            @param max_parallel int: maximum number of concurrent inspections when the list is insufficient
+        '''
+        self._ccs = ccs
+        self._interval = interval
+        self._max_parallel = max_parallel
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._closed = False
+        self.ticks = 0
+        self._thread = threading.Thread(target=self._run, name='group-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def close(self):
+        ''' Stop polling. Incomplete waits are abandoned. '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+    
+    def watch(self, name, activity, evaluate, args=[], kwargs={}, max_wait=900):
+        ''' Wait, without blocking, for evaluate to report completion.
+        
+        Parameters
+            @param name string: name of group
+            @param activity string: label for activity being waited for
+            @param evaluate function: evaluation method (cf. ContainerCloudService._wait_for())
+            @param args list: additional arguments to evaluate
+            @param kwargs dict: additional keyword arguments to evaluate
+            @param max_wait float: maximum time (seconds) to wait
+        Returns
+            @rtype AsyncResult: set to (boolean, JSON group, explanation string) as for ContainerCloudService._wait_for()
+        '''
+        result = AsyncResult()
+        waiter = {'name': name, 'activity': activity, 'evaluate': evaluate, 'args': args, 'kwargs': kwargs,
+                  'start_time': time.time(), 'deadline': time.time() + max_wait, 'max_wait': max_wait,
+                  'seen': None, 'polls': 0, 'group': None, 'result': result}
+        with self._condition:
+            self._waiters.append(waiter)
+            self._condition.notify_all()
+        return result
+    
+    def wait(self, name, activity, evaluate, args=[], kwargs={}, max_wait=900):
+        ''' Blocking equivalent of watch(). '''
+        return self.watch(name, activity, evaluate, args, kwargs, max_wait).result()
+    
+    def _snapshot(self, names):
+        ''' Read the state of the named groups.
+        
+        Returns
+            @rtype dict: name -> (JSON group, explanation) as returned by inspect_group(); None if the groups could not be read
+        '''
+        wanted = set(names)
+        groups = self._ccs.list_groups(timeout=30)
+        if groups is not None:
+            groups = dict([(g.get('Name'), g) for g in groups if g.get('Name') in wanted])
+        if groups is not None and all('Status' in g and 'Routes' in g for g in groups.itervalues()):
+            snapshot = dict([(name, (groups[name], "") if name in groups else (None, "No such group as '{name}'".format(name=name))) for name in names])
+            if self._ccs.cache:
+                for name, inspection in snapshot.iteritems():
+                    self._ccs.cache.put(name, inspection)
+            return snapshot
+        
+        logging.getLogger(__name__).debug('Group state not listed; inspecting %s groups', len(names))
+        pool = ThreadPool(max(1, min(self._max_parallel, len(names))))
+        try:
+            inspections = pool.map(lambda name: self._ccs.inspect_group(name, timeout=30, use_cache=False), names)
+        finally:
+            pool.close()
+        if all(group is None and not reason.startswith('No such group as') for group, reason in inspections):
+            return None
+        return dict(zip(names, inspections))
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._waiters and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                waiters = list(self._waiters)
+            
+            names = sorted(set([w['name'] for w in waiters]))
+            try:
+                snapshot = self._snapshot(names)
+            except:
+                logging.getLogger(__name__).debug('Exception polling groups', exc_info=True)
+                snapshot = None
+            self.ticks += 1
+            
+            now = time.time()
+            done = []
+            for waiter in waiters:
+                outcome = self._evaluate(waiter, snapshot.get(waiter['name']) if snapshot else None)
+                if outcome is None and now >= waiter['deadline']:
+                    outcome = False, waiter['group'], "Group '{name}' {activity} took too long ( > {time_allowed} s)".format(name=waiter['name'], activity=waiter['activity'], time_allowed=waiter['max_wait'])
+                    self._ccs.metrics.observe_wait(waiter['evaluate'].__name__.lstrip('_'), waiter['polls'], now - waiter['start_time'], 'timeout', name=waiter['name'])
+                if outcome is not None:
+                    done.append(waiter)
+                    waiter['result'].set(outcome)
+            
+            with self._condition:
+                for waiter in done:
+                    self._waiters.remove(waiter)
+                if self._waiters and not self._closed:
+                    # sleep until the next tick (or the earliest deadline)
+                    self._condition.wait(max(0, min([self._interval] + [w['deadline'] - time.time() for w in self._waiters])))
+    
+    def _evaluate(self, waiter, inspection):
+        ''' Evaluate the state of a waiter's group if it has changed since it was last evaluated.
+        
+        Returns
+            @rtype (boolean, JSON group, string): outcome if the wait is complete; None otherwise
+        '''
+        waiter['polls'] += 1
+        if inspection is None or inspection == waiter['seen']:
+            return None
+        waiter['seen'] = inspection
+        group, reason = inspection
+        waiter['group'] = group
+        try:
+            action, action_reason = waiter['evaluate'](group, reason, *waiter['args'], **waiter['kwargs'])
+        except:
+            logging.getLogger(__name__).debug('Exception', exc_info=True)
+            return None
+        if action not in ['COMPLETE_SUCCESS', 'COMPLETE_FAIL']:
+            return None
+        elapsed_time = time.time() - waiter['start_time']
+        success = 'COMPLETE_SUCCESS' == action
+        logging.getLogger(__name__).info("Group '{name}' {activity} {result} in {time}".format(name=waiter['name'], activity=waiter['activity'], 
+                                                                                            result='completed successfully' if success else 'failed', time=elapsed_time))
+        self._ccs.metrics.observe_wait(waiter['evaluate'].__name__.lstrip('_'), waiter['polls'], elapsed_time, success, name=waiter['name'])
+        return success, group, "" if success else action_reason
+
+
+class AsyncContainerCloudService:
+    ''' Non-blocking interface to a ContainerCloudService for orchestrating many groups from one process.
+    Operations return immediately with an AsyncResult. REST calls run on a bounded pool of worker threads while 
+    all waits (cf. ContainerCloudService._wait_for()) are driven by a single scheduler thread, so waiting on a 
+    group does not occupy a thread. Results have the same form as those of the ContainerCloudService methods. 
+    '''
+    
+    def __init__(self, ccs = None, max_parallel = 16):
+        ''' Class initializer
+        
+        Parameters
+            @param ccs ContainerCloudService: service used for REST calls and to evaluate group status
+            @param max_parallel int: maximum number of concurrent REST calls
+        '''
+        self._ccs = ccs if ccs else ContainerCloudService()
+        self._pool = ThreadPool(max_parallel)
+        self._timers = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._scheduler = threading.Thread(target=self._run, name='ccs-scheduler')
+        self._scheduler.daemon = True
+        self._scheduler.start()
+    
+    def close(self):
+        ''' Stop the scheduler and worker threads. Incomplete operations are abandoned. '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._pool.close()
+    
+    #
+    # Scheduling
+    #
+    def _run(self):
+        ''' Scheduler loop: run each timer once it is due. '''
+        while True:
+            with self._condition:
+                while not self._closed and (not self._timers or self._timers[0][0] > time.time()):
+                    self._condition.wait(self._timers[0][0] - time.time() if self._timers else None)
+                if self._closed:
+                    return
+                when, sequence, function = heapq.heappop(self._timers)
+            try:
+                function()
+            except:
+                logging.getLogger(__name__).debug('Exception in scheduled call', exc_info=True)
+    
+    def _call_later(self, delay, function):
+        ''' Schedule function to be called (on the scheduler thread) after delay seconds. '''
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._sequence, function))
+            self._condition.notify()
+    
+    def _submit(self, function, callback, errback):
+        ''' Run (blocking) function on a worker thread; pass its result to callback or its exception to errback. '''
+        def call():
+            try:
+                return True, function()
+            except:
+                logging.getLogger(__name__).debug('Exception executing {}'.format(function), exc_info=True)
+                return False, sys.exc_info()[1]
+        self._pool.apply_async(call, callback=lambda outcome: (callback if outcome[0] else errback)(outcome[1]))
+    
+    def _operation(self, initiate, result=None):
+        ''' Run initiate on a worker thread, setting result to its return value (or a failure on exception). '''
+        result = result if result else AsyncResult()
+        self._submit(initiate, result.set, lambda e: result.set((False, None, 'Exception: {}'.format(e))))
+        return result
+    
+    def _wait_for(self, name, activity, evaluate, args, result, polling=None, max_wait=900, finish=None):
+        ''' Asynchronous equivalent of ContainerCloudService._wait_for(); sets result once evaluate reports completion.
+        
+        Parameters
+            @param name string: name of group whose status is to be evaluated
+            @param activity string: label for activity being executed
+            @param evaluate function: evaluation method (cf. ContainerCloudService._wait_for())
+            @param args list: additional arguments to evaluate
+            @param result AsyncResult: result to set when the wait completes
+            @param polling PollingStrategy: determines the time between polls; defaults to DEFAULT_POLLING
+            @param max_wait int: maximum time to wait (seconds)
+            @param finish function: if set, applied to the (boolean, JSON group, string) outcome before it is set
+        '''
+        max_wait, polling = self._ccs._plan_wait(name, evaluate, max_wait, polling if polling else DEFAULT_POLLING)
+        if self._ccs.watcher:
+            self._ccs.watcher.watch(name, activity, evaluate, args, max_wait=max_wait).add_done_callback(
+                lambda outcome: result.set(finish(outcome) if finish else outcome))
+            return
         start_time = time.time()
-        success, group, reason = f(name, *args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        actual_size = group['NumberInstances']['CurrentSize'] if group else '-'
-
-        print('Timed {operation} {name} {size} ({actual}) {success} in {time}'.format(operation = label, 
-                                              name=name, 
-                                              size=5, 
-                                              actual=actual_size, 
-                                              success = success, 
-                                              time=execution_time))
-        sys.stdout.flush()
-
-        return success, group, reason
-
-    logger = logging.getLogger('')
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    handler1 = logging.StreamHandler(sys.stderr)
-    handler1.setLevel(logging.DEBUG)
-    handler1.setFormatter(formatter)
-    logger.addHandler(handler1)
+        state = {'attempt': 0, 'group': None}
+        
+        def complete(outcome, label=None):
+            self._ccs.metrics.observe_wait(evaluate.__name__.lstrip('_'), state['attempt'] + 1, time.time() - start_time, label or outcome[0], name=name)
+            result.set(finish(outcome) if finish else outcome)
+        
+        def poll():
+            self._submit(lambda: self._ccs.inspect_group(name, timeout=30, use_cache=False), evaluated, lambda e: next_poll())
+        
+        def evaluated(inspection):
+            group, reason = inspection
+            state['group'] = group
+            try:
+                action, action_reason = evaluate(group, reason, *args)
+            except:
+                action, action_reason = 'CONTINUE', ''
+            if action == 'COMPLETE_SUCCESS':
+                logging.getLogger(__name__).info("Group '{name}' {activity} completed successfully in {time}".format(name=name, activity=activity, time=time.time() - start_time))
+                complete((True, group, ""))
+            elif action == 'COMPLETE_FAIL':
+                logging.getLogger(__name__).info("Group '{name}' {activity} failed in {time} ({reason})".format(name=name, activity=activity, time=time.time() - start_time, reason=action_reason))
+                complete((False, group, action_reason))
+            else:
+                next_poll()
+        
+        def next_poll():
+            delay = polling.delay(state['attempt'], time.time() - start_time, max_wait)
+            if delay is None:
+                complete((False, state['group'], "Group '{name}' {activity} took too long ( > {time_allowed} s)".format(name=name, activity=activity, time_allowed=max_wait)), 'timeout')
+                return
+            state['attempt'] += 1
+            self._call_later(delay, poll)
+        
+        poll()
+    
+    def _initiate_and_wait(self, initiate, name, activity, evaluate, args=[], polling=None, max_wait=900, finish=None):
+        ''' Run initiate on a worker thread. If it returns an outcome, the operation is complete; 
+        if it returns None, wait (asynchronously) for the group to reach the state checked by evaluate.
+        '''
+        result = AsyncResult()
+        def initiated(outcome):
+            if outcome is not None:
+                result.set(outcome)
+            else:
+                self._wait_for(name, activity, evaluate, args, result, polling=polling, max_wait=max_wait, finish=finish)
+        self._submit(initiate, initiated, lambda e: result.set((False, None, 'Exception: {}'.format(e))))
+        return result
+    
+    #
+    # Operations; the results are those of the corresponding ContainerCloudService methods
+    #
+    def list_groups(self, *args, **kwargs):
+        return self._operation(lambda: self._ccs.list_groups(*args, **kwargs))
+    
+    def inspect_group(self, name, *args, **kwargs):
+        return self._operation(lambda: self._ccs.inspect_group(name, *args, **kwargs))
+    
+    def delete_group(self, name, polling=None, max_wait=900, *args, **kwargs):
+        def initiate():
+            success, r = self._ccs._with_retries(self._ccs._delete_group, name=name, exit_statuses = [200, 201, 204, 404], *args, **kwargs)
+            if not success:
+                return False, None, 'Unable to initiate delete request'
+            if 404 == r.status_code:
+                return True, None, ''
+        return self._initiate_and_wait(initiate, name, 'deletion', self._ccs._deleted, polling=polling, max_wait=max_wait)
+    
+    def map(self, hostname, domain, name, polling=None, max_wait=900, *args, **kwargs):
+        def initiate():
+            accepted, response = self._ccs._with_retries(self._ccs._map, hostname, domain, name, *args, **kwargs)
+            if not accepted:
+                return False, None, "Unable to request routing change: {}".format(response.text if response else '')
+        route = '{host}.{domain}'.format(host=hostname, domain=domain)
+        return self._initiate_and_wait(initiate, name, 'map ({r})'.format(r=route), self._ccs._mapped, [route], polling=polling, max_wait=max_wait)
+    
+    def unmap(self, hostname, domain, name, polling=None, max_wait=900, *args, **kwargs):
+        def initiate():
+            accepted, response = self._ccs._with_retries(self._ccs._unmap, hostname, domain, name, *args, **kwargs)
+            if not accepted:
+                return False, response, "Unable to request routing change: {}".format(response.text if response else '')
+        route = '{host}.{domain}'.format(host=hostname, domain=domain)
+        return self._initiate_and_wait(initiate, name, 'unmap({r})'.format(r=route), self._ccs._unmapped, [route], polling=polling, max_wait=max_wait)
+    
+    def resize(self, name, desired, polling=None, max_wait=900, *args, **kwargs):
+        def initiate():
+            group, reason = self._ccs.inspect_group(name, timeout=30)
+            if not group:
+                return False, None, "Cannot resize group, no group named {name} exists. ({reason})".format(name=name, reason=reason)
+            resized, response = self._ccs._with_retries(self._ccs._resize_group, name=name, desired=desired, exit_statuses = [200, 201, 204, 404], *args, **kwargs)
+            if not resized:
+                return False, None, "Unable resize group '{name}'; exiting".format(name=name)
+        def finish(outcome):
+            resized, group, reason = outcome
+            size = group['NumberInstances']['CurrentSize'] if group else '-'
+            if not resized:
+                reason = "{reason}: {name} has {size} instances; wanted {desired}".format(reason=reason, name=name, size=size, desired=desired)
+            return resized, group, reason
+        return self._initiate_and_wait(initiate, name, 'resize', self._ccs._resized, polling=polling, max_wait=max_wait, finish=finish)
+    
+    def create_group(self, name, image, polling=None, max_wait=600, *args, **kwargs):
+        def initiate():
+            group, reason = self._ccs.inspect_group(name, timeout=30)
+            if group:
+                return False, None, "Cannot create group, one with name '{name}' already exists.".format(name=name)
+            created, response = self._ccs._with_retries(self._ccs._create_group, name=name, image=image, *args, **kwargs)
+            if not created:
+                return False, None, "Unable to create group '{name}'".format(name=name)
+        result = AsyncResult()
+        def created(outcome):
+            if outcome[0]:
+                result.set(outcome)
+                return
+            # if creation failed, delete the group if partially created
+            def deleted(deletion):
+                if not deletion[0]:
+                    result.set((False, None, "{delete_reason} (took too long to provision)".format(delete_reason=deletion[2])))
+                else:
+                    result.set((False, None, "Unable to create group '{name}'".format(name=name)))
+            self._operation(lambda: self._ccs.forced_delete_group(name, polling=polling)).add_done_callback(deleted)
+        self._initiate_and_wait(initiate, name, 'creation', self._ccs._created, polling=polling, max_wait=max_wait).add_done_callback(created)
+        return result
+    
+    @staticmethod
+    def gather(results, timeout=None):
+        ''' Wait for several operations to complete.
+        
+        Parameters
+            @param results list: AsyncResult objects
+            @param timeout float: maximum time to wait for all of them (None to wait forever)
+        Returns
+            @rtype list: results of the operations (None for any not complete)
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        return [r.result(None if deadline is None else max(0, deadline - time.time())) for r in results]
+
+
+class BatchProcessor:
+    ''' Executes line-delimited JSON commands against a single, long-lived ContainerCloudService.
+    Avoids paying interpreter startup, configuration parsing and service construction on every call.
+    
+    Each command is a JSON object with an 'op' field and op specific arguments:
+        {"op": "list", "prefix": "app_"}
+        {"op": "inspect", "name": "group"}
+        {"op": "map", "name": "group", "hostname": "host", "domain": "domain"}
+        {"op": "resize", "name": "group", "size": 2}
+        {"op": "converge", "name": "group", "size": 2, "routes": ["host.domain", ...]}
+        {"op": "delete", "name": "group"}
+        {"op": "delete_groups", "names": ["group", ...], "max_parallel": 4}
+        {"op": "routes", "names": ["group", ...]}
+        {"op": "cache_stats"}
+        {"op": "metrics"}
+        {"op": "routed", "route": "host.domain", "names": ["group", ...]}
+    and, against the Cloud Foundry API of the space (cf. CloudFoundaryService):
+        {"op": "cf_apps", "refresh": true}
+        {"op": "cf_app", "name": "app"}
+        {"op": "cf_routes", "names": ["app", ...]}
+        {"op": "cf_routed", "route": "host.domain", "names": ["app", ...]}
+        {"op": "cf_scale", "name": "app", "size": 2}
+        {"op": "cf_stop", "name": "app"}
+        {"op": "cf_map", "name": "app", "hostname": "host", "domain": "domain"}
+        {"op": "cf_delete_apps", "names": ["app", ...], "max_parallel": 4}
+    Any command may also contain "timeout" (passed to the REST calls) and "field"; if present, only 
+    the named field of the result (of each element of the result when it is a list) is returned. 
+    Results are returned as JSON objects of the form {"ok": boolean, "result": ..., "reason": string}.
+    '''
+    
+    def __init__(self, ccs, cf=None):
+        ''' Class initializer
+        
+        Parameters
+            @param ccs ContainerCloudService: service against which commands are executed
+            @param cf CloudFoundaryService: service against which cf_ commands are executed; defaults to that of ccs
+        '''
+        self._ccs = ccs
+        self._cf = cf if cf else ccs._cfapi
+        self._ops = {
+            'list': self._list,
+            'inspect': self._inspect,
+            'map': self._map,
+            'resize': self._resize,
+            'converge': self._converge,
+            'delete': self._delete,
+            'routes': self._routes,
+            'routed': self._routed,
+            'delete_groups': self._delete_groups,
+            'cache_stats': self._cache_stats,
+            'metrics': self._metrics,
+            'cf_apps': self._cf_apps,
+            'cf_app': self._cf_app,
+            'cf_routes': self._cf_routes,
+            'cf_routed': self._cf_routed,
+            'cf_scale': self._cf_scale,
+            'cf_stop': self._cf_stop,
+            'cf_map': self._cf_map,
+            'cf_delete_apps': self._cf_delete_apps
+        }
+        
+    def _list(self, command, **options):
+        groups = self._ccs.list_groups(prefix=command.get('prefix'), **options)
+        return groups is not None, groups or [], "" if groups is not None else 'Unable to list groups'
+    
+    def _inspect(self, command, **options):
+        group, reason = self._ccs.inspect_group(command['name'], **options)
+        return group is not None, group, reason
+    
+    def _map(self, command, **options):
+        return self._ccs.map(command['hostname'], command['domain'], command['name'], **options)
+    
+    def _resize(self, command, **options):
+        return self._ccs.resize(command['name'], command['size'], **options)
+    
+    def _converge(self, command, **options):
+        success, group, outcome = self._ccs.converge(command['name'], command.get('size'), command.get('routes', []), **options)
+        return success, outcome, '; '.join(['{}: {}'.format(label, explanation) for label, explanation in outcome.iteritems() if explanation])
+    
+    def _delete(self, command, **options):
+        return self._ccs.forced_delete_group(command['name'], **options)
+    
+    def _delete_groups(self, command, **options):
+        if 'max_parallel' in command:
+            options['max_parallel'] = command['max_parallel']
+        results = self._ccs.delete_groups(command['names'], **options)
+        failed = [name for name in command['names'] if not results[name][0]]
+        reason = '; '.join([results[name][2] for name in failed])
+        return not failed, dict([(name, {'deleted': result[0], 'reason': result[2]}) for name, result in results.iteritems()]), reason
+    
+    def _cache_stats(self, command, **options):
+        if not self._ccs.cache:
+            return False, None, 'No cache configured'
+        return True, self._ccs.cache.stats(), ""
+    
+    def _metrics(self, command, **options):
+        return True, self._ccs.metrics.to_json(), ""
+    
+    def _routes(self, command, **options):
+        return True, self._ccs.routes_by_group(command['names'], **options), ""
+    
+    def _routed(self, command, **options):
+        routes = self._ccs.routes_by_group(command['names'], **options)
+        return True, [name for name in command['names'] if command['route'] in (routes.get(name) or [])], ""
+    
+    def _cf_apps(self, command, **options):
+        apps = self._cf.apps(refresh=command.get('refresh', False), **options)
+        return apps is not None, apps, '' if apps is not None else 'Unable to read apps'
+    
+    def _cf_app(self, command, **options):
+        app = self._cf.app(command['name'], **options)
+        return app is not None, app, '' if app is not None else "App '{}' does not exist".format(command['name'])
+    
+    def _cf_routes(self, command, **options):
+        return True, self._cf.routes_by_app(command['names'], **options), ""
+    
+    def _cf_routed(self, command, **options):
+        routes = self._cf.routes_by_app(command['names'], **options)
+        return True, [name for name in command['names'] if command['route'] in (routes.get(name) or [])], ""
+    
+    def _cf_scale(self, command, **options):
+        success, reason = self._cf.scale(command['name'], command['size'], **options)
+        return success, None, reason
+    
+    def _cf_stop(self, command, **options):
+        success, reason = self._cf.stop(command['name'], **options)
+        return success, None, reason
+    
+    def _cf_map(self, command, **options):
+        success, reason = self._cf.map_route(command['name'], command['domain'], command['hostname'], **options)
+        return success, None, reason
+    
+    def _cf_delete_apps(self, command, **options):
+        if 'max_parallel' in command:
+            options['max_parallel'] = command['max_parallel']
+        results = self._cf.delete_apps(command['names'], **options)
+        failed = [name for name in command['names'] if not results[name][0]]
+        return not failed, dict([(name, {'deleted': result[0], 'reason': result[1]}) for name, result in results.iteritems()]), '; '.join([results[name][1] for name in failed])
+    
+    def process(self, command):
+        ''' Execute a single command.
+        
+        Parameters
+            @param command dict: the command to execute
+        Returns
+            @rtype dict: {"ok": boolean, "result": result of operation, "reason": explanation (when fails)}
+        '''
+        op = self._ops.get(command.get('op'))
+        if not op:
+            return {'ok': False, 'result': None, 'reason': "Unknown operation '{}'".format(command.get('op'))}
+        options = {'timeout': command['timeout']} if 'timeout' in command else {}
+        try:
+            ok, result, reason = op(command, **options)
+        except:
+            logging.getLogger(__name__).debug('Exception processing {}'.format(command), exc_info=True)
+            return {'ok': False, 'result': None, 'reason': 'Exception processing command: {}'.format(sys.exc_info()[1])}
+        if isinstance(result, GroupRecord):
+            result = result.to_dict()
+        elif isinstance(result, list):
+            result = [r.to_dict() if isinstance(r, GroupRecord) else r for r in result]
+        field = command.get('field')
+        if field and isinstance(result, list):
+            result = [r.get(field) for r in result]
+        elif field and isinstance(result, dict):
+            result = result.get(field)
+        return {'ok': ok, 'result': result, 'reason': reason}
+    
+    def process_line(self, line):
+        ''' Parse and execute a single serialized command. '''
+        try:
+            command = json.loads(line)
+        except:
+            return {'ok': False, 'result': None, 'reason': 'Invalid JSON command: {}'.format(line.strip())}
+        return self.process(command)
+    
+    def serve(self, instream, outstream, format='json'):
+        ''' Read commands from instream, one per line, until end of file; write one response line per command.
+        
+        Parameters
+            @param instream file: stream from which commands are read
+            @param outstream file: stream to which responses are written
+            @param format string: 'json' to write JSON responses; 'shell' to write lines of the form
+                "<rc> <text>" where rc is 0 on success (1 otherwise) and text is a space separated rendering 
+                of the result. In 'shell' format, the reason for a failure is written to stderr.
+        '''
+        for line in iter(instream.readline, ''):
+            if not line.strip():
+                continue
+            response = self.process_line(line)
+            outstream.write(format_response(response, format) + '\n')
+            outstream.flush()
+    
+    def serve_socket(self, path, format='json'):
+        ''' Serve commands on a Unix domain socket. Each connection may send any number of commands. '''
+        processor = self
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                processor.serve(self.rfile, self.wfile, format)
+        if os.path.exists(path):
+            os.remove(path)
+        server = SocketServer.UnixStreamServer(path, Handler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+
+
+def format_response(response, format='json'):
+    ''' Serialize a response from BatchProcessor.process().
+    
+    Parameters
+        @param response dict: response to serialize
+        @param format string: one of 'json' or 'shell' (cf. BatchProcessor.serve())
+    Returns
+        @rtype string: single line serialization of the response
+    '''
+    if 'shell' != format:
+        return json.dumps(response)
+    if not response['ok'] and response['reason']:
+        sys.stderr.write('{}\n'.format(response['reason']))
+    result = response['result']
+    if isinstance(result, list):
+        text = ' '.join(['{}'.format(r) for r in result])
+    elif isinstance(result, dict):
+        text = json.dumps(result)
+    else:
+        text = '' if result is None else '{}'.format(result)
+    return '{rc} {text}'.format(rc=0 if response['ok'] else 1, text=text.replace('\n', ' '))
+
+    
+if __name__ == '__main__':
+    configure_logging()
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Container cloud service utilities')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='execute line-delimited JSON commands using a single service')
+    serve_parser.add_argument('--socket', help='path of Unix domain socket on which to listen; default is stdin/stdout')
+    serve_parser.add_argument('--format', choices=['json', 'shell'], default='json', help='format of responses')
+    serve_parser.add_argument('--cache-ttl', type=float, default=10, help='time (seconds) group inspections are cached; 0 to disable')
+    wait_parser = subparsers.add_parser('wait_phase', help='wait for the current phase of an update to complete; exit code as ActiveDeployService.wait_phase()')
+    wait_parser.add_argument('update_id', help='identifier of the update')
+    wait_parser.add_argument('--ad-url', default=os.getenv('AD_ENDPOINT'), help='URL of the active deploy service')
+    wait_parser.add_argument('--min-max-wait', type=int, default=90, help='minimum time (seconds) to wait for the phase')
+    wait_parser.add_argument('--from-start', action='store_true', help='the phase has just started (cf. ActiveDeployService.wait_phase())')
+    updates_parser = subparsers.add_parser('updates', help='list the identifiers of updates, one per line')
+    updates_parser.add_argument('--group', help='list only updates from or to this group')
+    updates_parser.add_argument('--status', action='append', help='list only updates with this status (may be repeated)')
+    updates_parser.add_argument('--active', action='store_true', help='list only active updates ({})'.format(', '.join(ACTIVE_STATUSES)))
+    updates_parser.add_argument('--format', choices=['id', 'json'], default='id', help='print identifiers or JSON records')
+    updates_parser.add_argument('--ad-url', default=os.getenv('AD_ENDPOINT'), help='URL of the active deploy service')
+    report_parser = subparsers.add_parser('report_status', help='report the status of an update to the toolchain (if $TOOLCHAIN_AVAILABLE is 1)')
+    report_parser.add_argument('update_id', help='identifier of the update')
+    report_parser.add_argument('status', help='status to report')
+    args = parser.parse_args()
+    
+    ccs_url = ccs_url_from_env()
+    
+    if 'serve' == args.command:
+        s = ContainerCloudService(cfapi=CloudFoundaryService(os.getenv('CF_TARGET_URL')), base_url=ccs_url,
+                                  cache=GroupCache(ttl=args.cache_ttl) if args.cache_ttl > 0 else None)
+        processor = BatchProcessor(s)
+        try:
+            if args.socket:
+                processor.serve_socket(args.socket, args.format)
+            else:
+                processor.serve(sys.stdin, sys.stdout, args.format)
+        finally:
+            if s.cache:
+                logging.getLogger(__name__).info('Group cache: {}'.format(s.cache.stats()))
+    
+    elif 'wait_phase' == args.command:
+        s = ContainerCloudService(cfapi=CloudFoundaryService(os.getenv('CF_TARGET_URL')), base_url=ccs_url)
+        reporter = StatusReporter.from_env()
+        ads = ActiveDeployService(args.ad_url, ccs=s, reporter=reporter)
+        
+        def resume(update_id):
+            resumed, reason = ads.resume(update_id)
+            if not resumed:
+                logging.getLogger(__name__).warning('Unable to resume update {id}: {reason}'.format(id=update_id, reason=reason))
+        
+        try:
+            rc = ads.wait_phase(args.update_id, min_max_wait=args.min_max_wait, on_paused=resume, from_start=args.from_start)
+        finally:
+            if reporter:
+                reporter.close()
+        sys.exit(rc)
+    
+    elif 'updates' == args.command:
+        s = ContainerCloudService(cfapi=CloudFoundaryService(os.getenv('CF_TARGET_URL')), base_url=ccs_url)
+        ads = ActiveDeployService(args.ad_url, ccs=s)
+        statuses = [status.lower().replace(' ', '_') for status in (args.status or [])] + (ACTIVE_STATUSES if args.active else [])
+        updates, reason = ads.list_updates(group=args.group, status=statuses or None)
+        if updates is None:
+            sys.stderr.write('{}\n'.format(reason))
+            sys.exit(1)
+        for update in updates:
+            print(json.dumps(update._asdict()) if 'json' == args.format else update.id)
+    
+    elif 'report_status' == args.command:
+        reporter = StatusReporter.from_env()
+        if reporter:
+            reporter.report(args.update_id, args.status)
+            sys.exit(0 if reporter.close() else 1)
@@ -57,19 +57,36 @@ if [[ -z ${NAME} ]]; then
   exit 1
 fi
 
+# Identify the active deploy api server (cf. service endpoint field of cf active-deploy-service-info)
+if [[ -n "${AD_ENDPOINT}" ]]; then
+  ad_server_url="${AD_ENDPOINT}"
+else
+  ad_server_url=$(active_deploy service-info | grep "service endpoint: " | sed 's/service endpoint: //')
+fi
+# The python utilities call the active deploy service directly; without its URL they cannot
+if [[ -z "${ad_server_url}" ]]; then
+  echo -e "${red}ERROR: Unable to identify the Active Deploy service endpoint (set AD_ENDPOINT); failing active deploy${no_color}"
+  export MUSTFAIL_ACTIVEDEPLOY=true
+fi
+
+# Probe (concurrently) the health and the info of the active deploy server and the availability of the toolchain.
+# Sets AD_HEALTHY, AD_SUPPORTS_TARGET, AD_BACKENDS, UPDATE_GUI_URL and TOOLCHAIN_AVAILABLE. The result is cached 
+# on disk for PREFLIGHT_TTL seconds (default 300) so later steps reuse it.
+# If the pipeline is in the context of a toolchain (queried from the toolchain broker), TOOLCHAIN_AVAILABLE is 1; otherwise 0
+eval "$(python ${SCRIPTDIR}/preflight.py --ad-url "${ad_server_url}" --cf-url "${CF_TARGET_URL}" \
+  --toolchain-url "https://otc-api.stage1.ng.bluemix.net/api/v1/toolchains/${PIPELINE_TOOLCHAIN_ID}?include=everything")"
+export AD_HEALTHY AD_SUPPORTS_TARGET AD_BACKENDS UPDATE_GUI_URL TOOLCHAIN_AVAILABLE
+
 # Verify that AD_ENDPOINT is available (otherwise set MUSTFAIL_ACTIVEDEPLOY)
 # If it is available, further validate that $AD_ENDPOINT supports $CF_TARGET as a backend
 if [[ -n "${AD_ENDPOINT}" ]]; then
-  up=$(timeout 10 curl -s ${AD_ENDPOINT}/health_check/ | grep status | grep up)
-  if [[ -z "${up}" ]]; then
+  if (( ! ${AD_HEALTHY:-0} )); then
     echo -e "${red}ERROR: Unable to validate availability of Active Deploy service ${AD_ENDPOINT}; failing active deploy${no_color}"
     export MUSTFAIL_ACTIVEDEPLOY=true
-  else
-    supports_target ${AD_ENDPOINT} ${CF_TARGET_URL} 
-    if (( $? )); then
-      echo -e "${red}ERROR: Selected Active Deploy service (${AD_ENDPOINT}) does not support target environment (${CF_TARGET_URL}); failing active deploy${no_color}"
-      export MUSTFAIL_ACTIVEDEPLOY=true
-    fi
+  elif (( ! ${AD_SUPPORTS_TARGET:-0} )); then
+    echo "${AD_BACKENDS}"
+    echo -e "${red}ERROR: Selected Active Deploy service (${AD_ENDPOINT}) does not support target environment (${CF_TARGET_URL}); failing active deploy${no_color}"
+    export MUSTFAIL_ACTIVEDEPLOY=true
   fi
 fi
 
@@ -86,12 +103,6 @@ fi
 # Set default (1) for CONCURRENT_VERSIONS
 if [[ -z ${CONCURRENT_VERSIONS} ]]; then export CONCURRENT_VERSIONS=2; fi
 
-# Check if the pipeline is in the context of a toolchain by querying the toolchain broker. 
-# If so, set TOOLCHAIN_AVAILABLE to 1; otherwise to 0
-curl -s --head -H "Authorization: ${TOOLCHAIN_TOKEN}" https://otc-api.stage1.ng.bluemix.net/api/v1/toolchains/${PIPELINE_TOOLCHAIN_ID}\?include\=everything | head -n 1 | grep "HTTP/1.[01] [23].." > /dev/null
-if (( $? )); then TOOLCHAIN_AVAILABLE=0; else TOOLCHAIN_AVAILABLE=1; fi
-export TOOLCHAIN_AVAILABLE
-
 
 ###################
 ################### Needed only for step_1
@@ -176,12 +187,9 @@ function show_link() {
 }
 
 
-# Identify URL for visualization of updates associated with this space. To do this:
-#   (a) look up the active deploy api server (cf. service endpoint field of cf active-deplpy-service-info)
-#   (b) look up the GUI server associated with the active deploy api server (cf. update_gui_url field of response to info REST call
-#   (c) Construct URL
-ad_server_url=$(active_deploy service-info | grep "service endpoint: " | sed 's/service endpoint: //')
-update_gui_url=$(curl -s ${ad_server_url}/v1/info/ | grep update_gui_url | awk '{print $2}' | sed 's/"//g' | sed 's/,//')
+# Identify URL for visualization of updates associated with this space: the GUI server associated with the 
+# active deploy api server (cf. update_gui_url field of response to info REST call, read by the preflight probe)
+update_gui_url="${UPDATE_GUI_URL}"
 
 show_link "Deployments for space ${CF_SPACE_ID}" "${update_gui_url}/deployments?ace_config={%22spaceGuid%22:%22${CF_SPACE_ID}%22}" ${green}
 
@@ -0,0 +1,201 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Checkpoint of the state of an active deploy, written by step 1 and read by step 2 (and by reruns of step 1).
+
+The checkpoint records the update, the original and successor groups, the route, the time each phase was
+seen to complete and the endpoints used. A checkpoint is resumed only after the update has been read (a
+single call) and found to still be the update of the successor; otherwise it is stale and is removed, and
+the caller falls back to discovering the update.
+
+    python checkpoint.py save --name NAME --update-id ID --original GROUP --route ROUTE [--ad-url URL] [--gui-url URL]
+    python checkpoint.py mark --name NAME --phase PHASE
+    eval "$(python checkpoint.py resume --name NAME [--ad-url URL])"
+    python checkpoint.py clear --name NAME
+
+resume sets CHECKPOINT_UPDATE_ID, CHECKPOINT_ORIGINAL, CHECKPOINT_ROUTE, CHECKPOINT_STATUS, CHECKPOINT_PHASE
+and CHECKPOINT_GUI_URL (all empty if there is no valid checkpoint).
+
+Checkpoints are kept in $AD_CHECKPOINT_DIR or, if it is not set, in the archive directory of the pipeline
+($ARCHIVE_DIR, which is carried from one job to the next) or else the working directory.
+'''
+
+import argparse
+import json
+import logging
+import os
+import pipes
+import re
+import sys
+import time
+
+import ccs
+
+# Version of the format of checkpoints; checkpoints of other versions are stale
+FORMAT = 1
+
+# Checkpoints older than this (seconds) are stale (cf. $AD_CHECKPOINT_MAX_AGE)
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+def checkpoint_dir():
+    ''' Returns
+        @rtype (string, boolean): directory of the checkpoints and whether it was configured to persist between jobs
+    '''
+    if os.getenv('AD_CHECKPOINT_DIR'):
+        return os.getenv('AD_CHECKPOINT_DIR'), True
+    base = os.getenv('ARCHIVE_DIR')
+    return os.path.join(base or os.getcwd(), '.activedeploy-checkpoint'), bool(base)
+
+
+def checkpoint_path(name, space=None, directory=None):
+    ''' Returns
+        @rtype string: path of the checkpoint of the deploy of group name to space
+    '''
+    directory = directory if directory else checkpoint_dir()[0]
+    return os.path.join(directory, re.sub('[^A-Za-z0-9_.-]', '_', '{}_{}'.format(space or 'space', name)) + '.json')
+
+
+def load(path):
+    ''' Returns
+        @rtype dict: the checkpoint stored at path; None if there is none (or it cannot be read)
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def store(path, state):
+    ''' Write a checkpoint (atomically). '''
+    state['updated'] = time.time()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0700)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+
+def clear(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def validate(state, name, ads, ad_url=None, max_age=DEFAULT_MAX_AGE):
+    ''' Decide whether a checkpoint can be resumed: it must be recent, for the same group and endpoint, and its
+    update must still exist with the group as its successor. The update is read with a single call.
+
+    Parameters
+        @param state dict: the checkpoint
+        @param name string: name of the successor group
+        @param ads ActiveDeployService: active deploy service (the endpoint of the checkpoint)
+        @param ad_url string: if set, URL of the active deploy service that must have been used
+        @param max_age float: number of seconds after which a checkpoint is stale
+    Returns
+        @rtype (Update, string, boolean): the current record of the update (None if the checkpoint cannot be resumed),
+            an explanation and whether the checkpoint is stale (False if the update could not be read, but might exist)
+    '''
+    if not state or FORMAT != state.get('format'):
+        return None, 'No checkpoint', True
+    if name != state.get('name'):
+        return None, 'Checkpoint is for {}'.format(state.get('name')), True
+    if ad_url and ad_url.rstrip('/') != (state.get('ad_url') or '').rstrip('/'):
+        return None, 'Checkpoint is for active deploy service {}'.format(state.get('ad_url')), True
+    if time.time() - state.get('updated', 0) > max_age:
+        return None, 'Checkpoint is older than {} seconds'.format(max_age), True
+    record, reason = ads.update_record(state.get('update_id'))
+    if record is None:
+        return None, 'Update {id} could not be read: {reason}'.format(id=state.get('update_id'), reason=reason), 'No such update' == reason
+    if record.new_group and name != record.new_group:
+        return None, 'Update {id} is of {group}'.format(id=record.id, group=record.new_group), True
+    return record, "", False
+
+
+def shell_assignments(state, record):
+    ''' Returns
+        @rtype string: the checkpoint (and the current state of its update) as shell variable assignments
+    '''
+    state = state if record else {}
+    values = [
+        ('CHECKPOINT_UPDATE_ID', state.get('update_id') or ''),
+        ('CHECKPOINT_ORIGINAL', state.get('original') or ''),
+        ('CHECKPOINT_ROUTE', state.get('route') or ''),
+        ('CHECKPOINT_STATUS', record.status if record else ''),
+        ('CHECKPOINT_PHASE', record.phase if record else ''),
+        ('CHECKPOINT_GUI_URL', state.get('gui_url') or '')
+    ]
+    return '\n'.join(['{0}={1}'.format(name, pipes.quote(u'{}'.format(value).encode('utf-8'))) for name, value in values])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save, update, resume or clear the checkpoint of an active deploy')
+    subparsers = parser.add_subparsers(dest='command')
+    save_parser = subparsers.add_parser('save', help='record a new update')
+    save_parser.add_argument('--update-id', required=True, help='identifier of the update')
+    save_parser.add_argument('--original', required=True, help='name of the original group')
+    save_parser.add_argument('--route', required=True, help='route (host.domain) being moved')
+    save_parser.add_argument('--gui-url', default='', help='URL of the active deploy GUI')
+    mark_parser = subparsers.add_parser('mark', help='record that a phase completed')
+    mark_parser.add_argument('--phase', required=True, help='phase that completed')
+    resume_parser = subparsers.add_parser('resume', help='validate the checkpoint; print shell assignments')
+    resume_parser.add_argument('--max-age', type=float, default=float(os.getenv('AD_CHECKPOINT_MAX_AGE', DEFAULT_MAX_AGE)),
+                               help='seconds after which a checkpoint is stale')
+    clear_parser = subparsers.add_parser('clear', help='remove the checkpoint')
+    for p in [save_parser, mark_parser, resume_parser, clear_parser]:
+        p.add_argument('--name', required=True, help='name of the successor group')
+        p.add_argument('--space', default=os.getenv('CF_SPACE_ID'), help='identifier of the space')
+    for p in [save_parser, resume_parser]:
+        p.add_argument('--ad-url', default=os.getenv('AD_ENDPOINT'), help='URL of the active deploy service')
+    args = parser.parse_args()
+
+    ccs.configure_logging()
+    path = checkpoint_path(args.name, args.space)
+
+    if 'save' == args.command:
+        if not checkpoint_dir()[1]:
+            logging.getLogger(__name__).warning('Neither AD_CHECKPOINT_DIR nor ARCHIVE_DIR is set; the checkpoint is written to {} '
+                                                'and is only resumed if the next job has the same working directory'.format(os.path.dirname(path)))
+        store(path, {'format': FORMAT, 'name': args.name, 'update_id': args.update_id, 'original': args.original,
+                     'route': args.route, 'ad_url': args.ad_url, 'gui_url': args.gui_url, 'space': args.space,
+                     'created': time.time(), 'phases': {}})
+
+    elif 'mark' == args.command:
+        state = load(path)
+        if not state:
+            sys.exit(0)
+        state.setdefault('phases', {})[args.phase] = time.time()
+        store(path, state)
+
+    elif 'resume' == args.command:
+        state = load(path)
+        record = None
+        if state:
+            ads = ccs.ActiveDeployService(args.ad_url or state.get('ad_url'),
+                                          ccs=ccs.ContainerCloudService(cfapi=ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL'))))
+            record, reason, stale = validate(state, args.name, ads, args.ad_url, args.max_age)
+            if record:
+                logging.getLogger(__name__).info('Resuming update {id} ({status}, {phase}) of {name} from checkpoint'.format(
+                    id=record.id, status=record.status, phase=record.phase, name=args.name))
+            else:
+                logging.getLogger(__name__).info('Ignoring checkpoint of {name}: {reason}'.format(name=args.name, reason=reason))
+            if stale:
+                clear(path)
+        print(shell_assignments(state, record))
+
+    elif 'clear' == args.command:
+        clear(path)
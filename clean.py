@@ -0,0 +1,187 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Clean up (delete) old versions of an application or container group (cf. clean() in activedeploy_common.sh).
+
+The versions are read in a single call (a snapshot), a plan is computed from the snapshot alone (plan()) and
+the plan is then executed (execute()), deleting groups concurrently. The plan keeps the currently routed
+version, the latest deployment (if it failed) and up to CONCURRENT_VERSIONS-1 other active versions.
+'''
+
+import argparse
+import collections
+import os
+import re
+import sys
+
+import ccs
+
+# A version of a group: the group name, its version number, its routes and whether it is stopped
+Version = collections.namedtuple('Version', ['name', 'version', 'routes', 'stopped'])
+
+# An entry of a plan: the group name, 'keep' or 'delete', and the reason
+Decision = collections.namedtuple('Decision', ['name', 'action', 'reason'])
+
+
+def split_name(name):
+    ''' Split a group name of the form pattern_version.
+
+    Returns
+        @rtype (string, int): pattern and version number; version is None if the name has no numeric version
+    '''
+    pattern, _, version = name.rpartition('_')
+    return (pattern, int(version)) if pattern and version.isdigit() else (name, None)
+
+
+def plan(versions, name, concurrent_versions):
+    ''' Decide which versions to keep and which to delete. Considers the versions from the most recent to the oldest:
+        - the most recent version with a route is the current version; it is kept
+        - versions more recent than that of name were deployed by a previous (or another) pipeline; they are deleted
+        - if no current version has been found yet, the most recent version is a failed deployment; it is kept
+          (for debugging) but does not count as one of the concurrent versions
+        - stopped versions are failed deployments; they are deleted
+        - once concurrent_versions versions have been kept, the rest are deleted
+
+    Parameters
+        @param versions list: Version records of all versions of the group (in any order)
+        @param name string: name of the group just deployed
+        @param concurrent_versions int: number of versions to keep
+    Returns
+        @rtype list: a Decision for each version, from the most recent to the oldest
+    '''
+    pattern, current = split_name(name)
+    decisions = []
+    current_version = None
+    most_recent = None
+    kept = 0
+    for v in sorted([v for v in versions if v.version is not None], key=lambda v: v.version, reverse=True):
+        if current_version is None and v.routes:
+            current_version = v.name
+            kept += 1
+            decisions.append(Decision(v.name, 'keep', 'current version'))
+        elif current is not None and v.version > current:
+            decisions.append(Decision(v.name, 'delete', 'from previous pipeline'))
+        elif current_version is None and most_recent is None:
+            most_recent = v.name
+            decisions.append(Decision(v.name, 'keep', 'current deployment failed; keeping for debug purposes'))
+        elif v.stopped:
+            decisions.append(Decision(v.name, 'delete', 'group is in stopped state'))
+        elif kept >= concurrent_versions:
+            decisions.append(Decision(v.name, 'delete', 'already identified sufficient versions to keep'))
+        else:
+            kept += 1
+            decisions.append(Decision(v.name, 'keep', 'active version'))
+    return decisions
+
+
+def _matching(names, pattern):
+    regex = re.compile('^{}_[0-9]+$'.format(re.escape(pattern)))
+    return [n for n in names if regex.match(n)]
+
+
+def containers_snapshot(service, pattern):
+    ''' Read all versions of a container group with (typically) a single call to the container service.
+
+    Parameters
+        @param service ContainerCloudService: container service
+        @param pattern string: group name without the version
+    Returns
+        @rtype list: Version records; None if the groups could not be listed
+    '''
+    groups = service.list_groups(prefix='{}_'.format(pattern), fields=('Name', 'Routes'), timeout=30)
+    if groups is None:
+        return None
+    groups = dict([(g.get('Name'), g) for g in groups])
+    names = _matching(groups.keys(), pattern)
+    if all('Routes' in groups[n] for n in names):
+        routes = dict([(n, groups[n].get('Routes') or []) for n in names])
+    else:
+        routes = service.routes_by_group(names, timeout=30)
+    # container groups are not stopped (cf. isStopped in Container.sh)
+    return [Version(n, split_name(n)[1], routes.get(n) or [], False) for n in names]
+
+
+def cloudfoundry_snapshot(cf, pattern):
+    ''' Read all versions of an application with a single call to the Cloud Foundry API (the space summary).
+
+    Parameters
+        @param cf CloudFoundaryService: Cloud Foundry service
+        @param pattern string: application name without the version
+    Returns
+        @rtype list: Version records; None if the applications could not be listed
+    '''
+    apps = cf.apps(timeout=30)
+    if apps is None:
+        return None
+    apps = dict([(app['name'], app) for app in apps])
+    return [Version(n, split_name(n)[1], apps[n]['routes'], 'STOPPED' == apps[n]['state']) for n in _matching(apps.keys(), pattern)]
+
+
+def execute(decisions, platform, service=None, max_parallel=4):
+    ''' Delete the groups the plan decided to delete, concurrently.
+
+    Parameters
+        @param decisions list: the plan (cf. plan())
+        @param platform string: 'Container' or 'CloudFoundry' (cf. $TARGET_PLATFORM)
+        @param service ContainerCloudService or CloudFoundaryService: service of the platform
+        @param max_parallel int: maximum number of concurrent deletions
+    Returns
+        @rtype list: names of the groups that could not be deleted
+    '''
+    names = [d.name for d in decisions if 'delete' == d.action]
+    if not names:
+        return []
+    if 'Container' == platform:
+        results = service.delete_groups(names, max_parallel=max_parallel, timeout=90)
+    else:
+        results = service.delete_apps(names, max_parallel=max_parallel, timeout=90)
+    return [n for n in names if not results[n][0]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete old versions of a group')
+    parser.add_argument('name', help='name of the group just deployed (of the form pattern_version)')
+    parser.add_argument('--concurrent-versions', type=int, default=1, help='number of versions to keep')
+    parser.add_argument('--platform', choices=['Container', 'CloudFoundry'], default=os.getenv('TARGET_PLATFORM', 'CloudFoundry'))
+    parser.add_argument('--max-parallel', type=int, default=4, help='maximum number of concurrent deletions')
+    parser.add_argument('--dry-run', action='store_true', help='print the plan without deleting anything')
+    args = parser.parse_args()
+
+    ccs.configure_logging()
+    pattern = split_name(args.name)[0]
+    cf = ccs.CloudFoundaryService(os.getenv('CF_TARGET_URL'))
+    if 'Container' == args.platform:
+        service = ccs.ContainerCloudService(cfapi=cf, base_url=ccs.ccs_url_from_env())
+        versions = containers_snapshot(service, pattern)
+    else:
+        service = cf
+        versions = cloudfoundry_snapshot(cf, pattern)
+    if versions is None:
+        print('clean(): Unable to list versions of {}'.format(pattern))
+        sys.exit(1)
+
+    decisions = plan(versions, args.name, args.concurrent_versions)
+    print('clean(): Found {} versions: {}'.format(len(versions), ' '.join(sorted(v.name for v in versions))))
+    for d in decisions:
+        print('clean(): {action} {name} ({reason})'.format(action='Keeping' if 'keep' == d.action else 'Deleting', name=d.name, reason=d.reason))
+    if args.dry_run:
+        print('clean(): Dry run; nothing deleted')
+        sys.exit(0)
+
+    failed = execute(decisions, args.platform, service, max_parallel=args.max_parallel)
+    if failed:
+        print('clean(): Unable to delete some of {}'.format(' '.join(failed)))
+    print('clean(): Summary: keeping {}'.format(' '.join(d.name for d in decisions if 'keep' == d.action)))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,529 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Local stand-in for the container service (CCS) and Active Deploy REST APIs used by ccs.py.
+
+Implements:
+    /v3/containers/groups                        GET (list), POST (create)
+    /v3/containers/groups/<name>                 GET (inspect), PATCH (resize), DELETE
+    /v3/containers/groups/<name>/maproute        POST
+    /v3/containers/groups/<name>/unmaproute      POST
+    /health_check/                               GET
+    /v1/info/                                    GET
+    /v1/<space>/update/                          GET (list), POST (create)
+    /v1/<space>/update/<id>/                     GET (show), PUT (advance, rollback, resume), DELETE
+    /v2/spaces/<space>/summary                   GET (the groups as Cloud Foundry apps)
+    /v2/apps/<guid>                              PUT (instances, state), DELETE
+    /v2/shared_domains, /v2/private_domains      GET (paged; q=name:<domain>)
+    /v2/routes                                   GET (paged; q=host:<host>, q=domain_guid:<guid>), POST
+    /v2/routes/<guid>/apps/<guid>                PUT
+Changes to groups complete asynchronously (after transition_time seconds; update phases last their declared duration).
+Latency, error (5xx) and timeout rates can be set for all requests or per endpoint, for example:
+
+    python fake_bluemix.py --port 8080 --groups 20 --latency 0.1 --config faults.json
+
+where faults.json is of the form {"groups.inspect": {"latency": 0.5, "error_rate": 0.1}, ...}. Then point
+ContainerCloudService at http://localhost:8080/v3/containers and ActiveDeployService and CloudFoundaryService at http://localhost:8080.
+'''
+
+import argparse
+import BaseHTTPServer
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+import ccs
+
+
+class FaultProfile:
+    ''' Latency and failures injected into requests to an endpoint. '''
+
+    def __init__(self, latency=0, error_rate=0, timeout_rate=0, timeout=60):
+        ''' Class initializer
+
+        Parameters
+            @param latency float: time (seconds) added to each response
+            @param error_rate float: fraction of requests that fail with a 500 (or 503) response
+            @param timeout_rate float: fraction of requests that do not respond for timeout seconds
+            @param timeout float: delay used to simulate a timeout
+        '''
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+
+
+class FakeBluemix:
+    ''' In memory model of container groups and active deploy updates. All methods are thread safe. '''
+
+    def __init__(self, groups=0, transition_time=2, space='space', cf_url='https://api.ng.bluemix.net',
+                 faults=None, default_fault=None):
+        ''' Class initializer
+
+        Parameters
+            @param groups int: number of groups (named app_1, app_2, ...) initially present; the last one is routed
+            @param transition_time float: time (seconds) for a group create/resize/delete/map/unmap to complete
+            @param space string: space guid expected in active deploy URLs
+            @param cf_url string: cloud backend reported by /v1/info/
+            @param faults dict: endpoint (e.g. 'groups.inspect') -> FaultProfile
+            @param default_fault FaultProfile: profile for endpoints not in faults
+        '''
+        self.transition_time = transition_time
+        self.space = space
+        self.cf_url = cf_url
+        self.faults = faults if faults else {}
+        self.default_fault = default_fault if default_fault else FaultProfile()
+        self.requests = {}
+        self._groups = {}
+        self._updates = {}
+        self._cf_routes = {}
+        self.domains = ['mybluemix.net']
+        self._lock = threading.Lock()
+        for i in range(1, groups + 1):
+            self._groups['app_{}'.format(i)] = {
+                'Name': 'app_{}'.format(i),
+                'Id': str(uuid.uuid4()),
+                'Status': 'CREATE_COMPLETE',
+                'NumberInstances': {'CurrentSize': 1, 'Desired': 1, 'Max': 4, 'Min': 0},
+                'Routes': ['app.mybluemix.net'] if i == groups else [],
+                '_pending': []
+            }
+
+    def fault(self, endpoint):
+        ''' Returns
+            @rtype FaultProfile: profile for the endpoint
+        '''
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        return self.faults.get(endpoint, self.default_fault)
+
+    #
+    # Container groups
+    #
+    def _settle(self, now):
+        ''' Apply any group transitions that are due. '''
+        for name in self._groups.keys():
+            group = self._groups[name]
+            while group['_pending'] and group['_pending'][0][0] <= now:
+                when, change = group['_pending'].pop(0)
+                if change(group) is False:
+                    del self._groups[name]
+                    break
+
+    def _schedule(self, group, change):
+        group['_pending'].append((time.time() + self.transition_time, change))
+
+    def _public(self, group):
+        return dict([(k, v) for k, v in group.iteritems() if not k.startswith('_')])
+
+    def list_groups(self):
+        with self._lock:
+            self._settle(time.time())
+            return 200, [self._public(g) for g in sorted(self._groups.values(), key=lambda g: g['Name'])]
+
+    def inspect_group(self, name):
+        with self._lock:
+            self._settle(time.time())
+            if name not in self._groups:
+                return 404, {'code': 'IC5043E', 'description': 'The group {} was not found'.format(name)}
+            return 200, self._public(self._groups[name])
+
+    def create_group(self, body):
+        name = body.get('Name')
+        with self._lock:
+            self._settle(time.time())
+            if name in self._groups:
+                return 409, {'description': 'Group {} already exists'.format(name)}
+            instances = body.get('NumberInstances', {})
+            group = {
+                'Name': name,
+                'Id': str(uuid.uuid4()),
+                'Image': body.get('Image'),
+                'Status': 'CREATE_IN_PROGRESS',
+                'NumberInstances': {'CurrentSize': 0, 'Desired': instances.get('Desired', 1),
+                                    'Max': instances.get('Max', 4), 'Min': instances.get('Min', 0)},
+                'Routes': [],
+                '_pending': []
+            }
+            def created(g):
+                g['Status'] = 'CREATE_COMPLETE'
+                g['NumberInstances']['CurrentSize'] = g['NumberInstances']['Desired']
+            self._schedule(group, created)
+            self._groups[name] = group
+            return 201, {'Id': group['Id']}
+
+    def resize_group(self, name, body):
+        with self._lock:
+            self._settle(time.time())
+            if name not in self._groups:
+                return 404, {}
+            group = self._groups[name]
+            desired = int(body.get('NumberInstances', {}).get('Desired', group['NumberInstances']['Desired']))
+            group['Status'] = 'UPDATE_IN_PROGRESS'
+            group['NumberInstances']['Desired'] = desired
+            def resized(g):
+                g['Status'] = 'UPDATE_COMPLETE'
+                g['NumberInstances']['CurrentSize'] = desired
+            self._schedule(group, resized)
+            return 204, None
+
+    def delete_group(self, name):
+        with self._lock:
+            self._settle(time.time())
+            if name not in self._groups:
+                return 404, {}
+            self._groups[name]['Status'] = 'DELETE_IN_PROGRESS'
+            self._schedule(self._groups[name], lambda g: False)
+            return 204, None
+
+    def map_route(self, name, body, mapped=True):
+        route = '{host}.{domain}'.format(host=body.get('host'), domain=body.get('domain'))
+        with self._lock:
+            self._settle(time.time())
+            if name not in self._groups:
+                return 404, {}
+            def change(g):
+                if mapped and route not in g['Routes']:
+                    g['Routes'].append(route)
+                elif not mapped and route in g['Routes']:
+                    g['Routes'].remove(route)
+            self._schedule(self._groups[name], change)
+            return 200, {}
+
+    #
+    # Active deploy updates
+    #
+    def _update_state(self, update, now):
+        ''' Mark the current phase complete once its duration has passed. '''
+        phase = update['phase']
+        for p in update['phases']:
+            if p['name'] == phase and 'in_progress' == p['status'] and now - update['_phase_start'] >= p['_seconds']:
+                p['status'] = 'completed'
+                if not update['_manual']:
+                    self._advance(update, now)
+        if 'rolling back' == update['status'] and now - update['_phase_start'] >= self.transition_time:
+            update['status'], update['phase'] = 'rolled back', 'initial'
+
+    def _advance(self, update, now):
+        names = [p['name'] for p in update['phases']]
+        if update['phase'] == names[-1]:
+            update['status'], update['phase'] = 'completed', 'completed'
+            return
+        update['phase'] = names[names.index(update['phase']) + 1]
+        update['_phase_start'] = now
+        for p in update['phases']:
+            if p['name'] == update['phase']:
+                p['status'] = 'in_progress'
+
+    def _public_update(self, update):
+        record = dict([(k, v) for k, v in update.iteritems() if not k.startswith('_')])
+        record['phases'] = [dict([(k, v) for k, v in p.iteritems() if not k.startswith('_')]) for p in update['phases']]
+        return record
+
+    def list_updates(self):
+        with self._lock:
+            now = time.time()
+            for update in self._updates.values():
+                self._update_state(update, now)
+            return 200, [self._public_update(u) for u in sorted(self._updates.values(), key=lambda u: u['_created'])]
+
+    def show_update(self, update_id):
+        with self._lock:
+            if update_id not in self._updates:
+                return 404, {}
+            self._update_state(self._updates[update_id], time.time())
+            return 200, self._public_update(self._updates[update_id])
+
+    def create_update(self, body):
+        with self._lock:
+            now = time.time()
+            update_id = str(uuid.uuid4())
+            self._updates[update_id] = {
+                'id': update_id,
+                'name': update_id,
+                'current_group': body.get('current_group'),
+                'new_group': body.get('new_group'),
+                'status': 'in_progress',
+                'phase': 'rampup',
+                'detailedMessage': '',
+                'phases': [{'name': name, 'duration': body.get(name, default), 'status': 'in_progress' if 'rampup' == name else 'pending',
+                            '_seconds': ccs.to_seconds(body.get(name, default))}
+                           for name, default in [('rampup', '5m'), ('test', '5m'), ('rampdown', '5m')]],
+                '_manual': body.get('manual', True),
+                '_phase_start': now,
+                '_created': now
+            }
+            return 201, {'id': update_id}
+
+    def update_action(self, update_id, body):
+        with self._lock:
+            if update_id not in self._updates:
+                return 404, {}
+            update = self._updates[update_id]
+            now = time.time()
+            self._update_state(update, now)
+            action = body.get('action')
+            if 'advance' == action and update['status'] in ['in_progress', 'paused']:
+                update['status'] = 'in_progress'
+                self._advance(update, now)
+            elif 'rollback' == action and update['status'] not in ['completed', 'rolled back']:
+                update['status'], update['_phase_start'] = 'rolling back', now
+            elif 'resume' == action and 'paused' == update['status']:
+                update['status'] = 'in_progress'
+            else:
+                return 409, {'description': "Cannot {action} an update that is {status}".format(action=action, status=update['status'])}
+            return 200, self._public_update(update)
+
+    def delete_update(self, update_id):
+        with self._lock:
+            if self._updates.pop(update_id, None) is None:
+                return 404, {}
+            return 200, {}
+
+    #
+    # Cloud Foundry (v2) view of the groups: each group is an app; changes made through it complete immediately
+    #
+    def _page(self, resources, path, query):
+        per_page = int(query.get('results-per-page', ['50'])[0])
+        page = int(query.get('page', ['1'])[0])
+        pages = max(1, (len(resources) + per_page - 1) // per_page)
+        next_url = None
+        if page < pages:
+            params = [('page', page + 1), ('results-per-page', per_page)] + [('q', q) for q in query.get('q', [])]
+            next_url = '{path}?{query}'.format(path=path, query=urllib.urlencode(params))
+        return 200, {'total_results': len(resources), 'total_pages': pages, 'next_url': next_url,
+                     'resources': resources[(page - 1) * per_page:page * per_page]}
+
+    def _filter(self, query):
+        return [tuple(q.split(':', 1)) for q in query.get('q', [])]
+
+    def _route_resources(self):
+        routes = dict(self._cf_routes)
+        for g in self._groups.values():
+            for url in g['Routes']:
+                host, domain = url.split('.', 1)
+                routes.setdefault('route-{}'.format(url), {'host': host, 'domain_guid': 'domain-{}'.format(domain)})
+        return [{'metadata': {'guid': guid}, 'entity': entity} for guid, entity in sorted(routes.iteritems())]
+
+    def _app(self, guid):
+        for g in self._groups.values():
+            if g['Id'] == guid:
+                return g
+        return None
+
+    def space_summary(self):
+        with self._lock:
+            self._settle(time.time())
+            apps = [{'guid': g['Id'], 'name': g['Name'], 'state': g.get('_state', 'STARTED'),
+                     'instances': g['NumberInstances']['Desired'],
+                     'routes': [{'guid': 'route-{}'.format(url), 'host': url.split('.', 1)[0],
+                                 'domain': {'guid': 'domain-{}'.format(url.split('.', 1)[1]), 'name': url.split('.', 1)[1]}}
+                                for url in g['Routes']]}
+                    for g in sorted(self._groups.values(), key=lambda g: g['Name'])]
+            return 200, {'guid': self.space, 'name': 'dev', 'apps': apps}
+
+    def update_app(self, guid, body):
+        with self._lock:
+            self._settle(time.time())
+            group = self._app(guid)
+            if not group:
+                return 404, {'code': 100004, 'description': 'The app could not be found: {}'.format(guid)}
+            if 'instances' in body:
+                group['NumberInstances']['Desired'] = group['NumberInstances']['CurrentSize'] = int(body['instances'])
+            if 'state' in body:
+                group['_state'] = body['state']
+            return 201, {'metadata': {'guid': guid}, 'entity': {'name': group['Name']}}
+
+    def delete_app(self, guid):
+        with self._lock:
+            self._settle(time.time())
+            group = self._app(guid)
+            if not group:
+                return 404, {'code': 100004, 'description': 'The app could not be found: {}'.format(guid)}
+            del self._groups[group['Name']]
+            return 204, None
+
+    def list_domains(self, path, query):
+        wanted = dict(self._filter(query)).get('name')
+        domains = [{'metadata': {'guid': 'domain-{}'.format(d)}, 'entity': {'name': d}}
+                   for d in self.domains if wanted in [None, d]] if 'shared' in path else []
+        return self._page(domains, path, query)
+
+    def list_routes(self, path, query):
+        with self._lock:
+            self._settle(time.time())
+            filters = self._filter(query)
+            routes = [r for r in self._route_resources() if all(r['entity'].get(k) == v for k, v in filters)]
+        return self._page(routes, path, query)
+
+    def create_route(self, body):
+        with self._lock:
+            domain = body.get('domain_guid', '')[len('domain-'):]
+            guid = 'route-{host}.{domain}'.format(host=body.get('host'), domain=domain)
+            self._cf_routes[guid] = {'host': body.get('host'), 'domain_guid': body.get('domain_guid')}
+            return 201, {'metadata': {'guid': guid}, 'entity': self._cf_routes[guid]}
+
+    def bind_route(self, route_guid, app_guid):
+        with self._lock:
+            self._settle(time.time())
+            group = self._app(app_guid)
+            route = dict([(r['metadata']['guid'], r['entity']) for r in self._route_resources()]).get(route_guid)
+            if not group or not route:
+                return 404, {'description': 'The route or app could not be found'}
+            url = '{host}.{domain}'.format(host=route['host'], domain=route['domain_guid'][len('domain-'):])
+            if url not in group['Routes']:
+                group['Routes'].append(url)
+            return 201, {'metadata': {'guid': route_guid}, 'entity': route}
+
+    def info(self):
+        return 200, {'cloud_backends': [self.cf_url], 'update_gui_url': 'http://localhost/ui', 'version': 'fake'}
+
+
+# (method, pattern, endpoint, handler) where handler is called with the model, the path match, the parsed body and the
+# parsed query (a dict of lists)
+ROUTES = [
+    ('GET', r'^/v3/containers/groups/?$', 'groups.list', lambda m, match, body, query: m.list_groups()),
+    ('POST', r'^/v3/containers/groups/?$', 'groups.create', lambda m, match, body, query: m.create_group(body)),
+    ('GET', r'^/v3/containers/groups/([^/]+)$', 'groups.inspect', lambda m, match, body, query: m.inspect_group(match.group(1))),
+    ('PATCH', r'^/v3/containers/groups/([^/]+)$', 'groups.resize', lambda m, match, body, query: m.resize_group(match.group(1), body)),
+    ('DELETE', r'^/v3/containers/groups/([^/]+)$', 'groups.delete', lambda m, match, body, query: m.delete_group(match.group(1))),
+    ('POST', r'^/v3/containers/groups/([^/]+)/maproute$', 'groups.map', lambda m, match, body, query: m.map_route(match.group(1), body)),
+    ('POST', r'^/v3/containers/groups/([^/]+)/unmaproute$', 'groups.unmap', lambda m, match, body, query: m.map_route(match.group(1), body, mapped=False)),
+    ('GET', r'^/health_check/?$', 'health', lambda m, match, body, query: (200, {'status': 'up'})),
+    ('GET', r'^/v1/info/?$', 'info', lambda m, match, body, query: m.info()),
+    ('GET', r'^/v1/[^/]+/update/?$', 'update.list', lambda m, match, body, query: m.list_updates()),
+    ('POST', r'^/v1/[^/]+/update/?$', 'update.create', lambda m, match, body, query: m.create_update(body)),
+    ('GET', r'^/v1/[^/]+/update/([^/]+)/?$', 'update.show', lambda m, match, body, query: m.show_update(match.group(1))),
+    ('PUT', r'^/v1/[^/]+/update/([^/]+)/?$', 'update.action', lambda m, match, body, query: m.update_action(match.group(1), body)),
+    ('DELETE', r'^/v1/[^/]+/update/([^/]+)/?$', 'update.delete', lambda m, match, body, query: m.delete_update(match.group(1))),
+    ('GET', r'^/v2/spaces/[^/]+/summary$', 'cf.summary', lambda m, match, body, query: m.space_summary()),
+    ('PUT', r'^/v2/apps/([^/]+)$', 'cf.app.update', lambda m, match, body, query: m.update_app(match.group(1), body)),
+    ('DELETE', r'^/v2/apps/([^/]+)$', 'cf.app.delete', lambda m, match, body, query: m.delete_app(match.group(1))),
+    ('GET', r'^/v2/(shared|private)_domains$', 'cf.domains', lambda m, match, body, query: m.list_domains(match.group(0), query)),
+    ('GET', r'^/v2/routes$', 'cf.routes', lambda m, match, body, query: m.list_routes(match.group(0), query)),
+    ('POST', r'^/v2/routes$', 'cf.route.create', lambda m, match, body, query: m.create_route(body)),
+    ('PUT', r'^/v2/routes/([^/]+)/apps/([^/]+)$', 'cf.route.bind', lambda m, match, body, query: m.bind_route(match.group(1), match.group(2))),
+]
+
+
+class FakeBluemixHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self, method):
+        url = urlparse.urlparse(self.path)
+        path, query = url.path, urlparse.parse_qs(url.query)
+        length = int(self.headers.getheader('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else ''
+        for route_method, pattern, endpoint, handler in ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return self._respond(404, {'description': 'No such resource {}'.format(path)})
+
+        fault = self.server.model.fault(endpoint)
+        if fault.latency:
+            time.sleep(fault.latency)
+        roll = random.random()
+        if roll < fault.timeout_rate:
+            time.sleep(fault.timeout)
+        elif roll < fault.timeout_rate + fault.error_rate:
+            code = random.choice([500, 503])
+            # like a real service, ask clients to back off when unavailable
+            return self._respond(code, {'description': 'Injected failure'}, {'Retry-After': '1'} if 503 == code else {})
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            return self._respond(400, {'description': 'Invalid JSON body'})
+        code, response = handler(self.server.model, match, body, query)
+        self._respond(code, response)
+
+    def _respond(self, code, body, headers={}):
+        text = json.dumps(body) if body is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBluemixServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' HTTP server for a FakeBluemix model. Use port 0 to pick a free port. '''
+    daemon_threads = True
+
+    def __init__(self, model, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeBluemixHandler)
+        self.model = model
+
+    def url(self):
+        return 'http://{host}:{port}'.format(host=self.server_address[0], port=self.server_address[1])
+
+    def ccs_url(self):
+        ''' URL to use as the base_url of a ContainerCloudService '''
+        return '{}/v3/containers'.format(self.url())
+
+    def start(self):
+        ''' Serve requests on a background thread. '''
+        thread = threading.Thread(target=self.serve_forever, name='fake-bluemix')
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the container service and Active Deploy APIs')
+    parser.add_argument('--port', type=int, default=8080, help='port on which to listen')
+    parser.add_argument('--groups', type=int, default=3, help='number of groups initially present')
+    parser.add_argument('--transition-time', type=float, default=2, help='time (seconds) for group changes to complete')
+    parser.add_argument('--latency', type=float, default=0, help='latency (seconds) added to every request')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with a 5xx response')
+    parser.add_argument('--timeout-rate', type=float, default=0, help='fraction of requests that time out')
+    parser.add_argument('--config', help='JSON file of per endpoint fault profiles (cf. ROUTES for endpoint names)')
+    args = parser.parse_args()
+
+    faults = {}
+    if args.config:
+        faults = dict([(endpoint, FaultProfile(**profile)) for endpoint, profile in json.loads(open(args.config).read()).iteritems()])
+    model = FakeBluemix(groups=args.groups, transition_time=args.transition_time, faults=faults,
+                        default_fault=FaultProfile(latency=args.latency, error_rate=args.error_rate, timeout_rate=args.timeout_rate))
+    server = FakeBluemixServer(model, port=args.port)
+    print('Serving on {url} (CCS base_url {ccs})'.format(url=server.url(), ccs=server.ccs_url()))
+    server.serve_forever()
@@ -0,0 +1,270 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Drive active deploys of many groups, in several regions, concurrently.
+
+The manifest is a JSON document of the form:
+    {
+      "regions": {
+        "ng": {"ccs_url": "https://containers-api.ng.bluemix.net/v3/containers",
+               "ad_url": "https://activedeployapi.ng.bluemix.net",
+               "max_parallel": 4}
+      },
+      "deploys": [
+        {"name": "app_12", "region": "ng", "group_size": 2, "rampup": "5m", "rampdown": "5m",
+         "hostname": "app", "domain": "mybluemix.net", "priority": 0}
+      ]
+    }
+Deploys with a lower priority value are started first (ties in manifest order). Only the 'Containers'
+platform (the default) is supported.
+'''
+
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+import ccs
+
+PHASES = ['rampup', 'test', 'rampdown']
+
+
+class Deploy:
+    ''' A single entry of the manifest and the outcome of deploying it. '''
+
+    def __init__(self, index, entry):
+        self.index = index
+        self.name = entry['name']
+        self.platform = entry.get('platform', 'Containers')
+        self.region = entry.get('region', 'default')
+        self.group_size = int(entry.get('group_size', 1))
+        self.rampup = entry.get('rampup', '5m')
+        self.test = entry.get('test', '1s')
+        self.rampdown = entry.get('rampdown', '5m')
+        # by default the route is derived from the name as check_and_set_env.sh does
+        self.pattern = self.name.rsplit('_', 1)[0]
+        self.hostname = entry.get('hostname', self.pattern.replace('_', '-'))
+        self.domain = entry['domain']
+        self.priority = entry.get('priority', 0)
+
+        self.outcome = 'pending'
+        self.update_id = None
+        self.original = None
+        self.reason = ''
+        self.start_time = None
+        self.end_time = None
+
+    def duration(self):
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+
+class Region:
+    ''' Services used to deploy to one region. '''
+
+    def __init__(self, name, spec, session=None):
+        self.name = name
+        self.max_parallel = int(spec.get('max_parallel', 4))
+        self.ccs = ccs.ContainerCloudService(cfapi=ccs.CloudFoundaryService(spec.get('cf_url')),
+                                             base_url=spec['ccs_url'],
+                                             session=session)
+        # a single poll of the region's groups serves the waits of all of its deploys
+        self.ccs.watcher = ccs.GroupWatcher(self.ccs, max_parallel=self.max_parallel)
+        self.ads = ccs.ActiveDeployService(spec['ad_url'], ccs=self.ccs)
+        self.active = 0
+
+
+class FleetScheduler:
+    ''' Hands out deploys in priority order while respecting a global limit (the number of workers)
+    and a per-region limit on the number of concurrent deploys.
+    '''
+
+    def __init__(self, deploys, regions):
+        self._pending = sorted(deploys, key=lambda d: (d.priority, d.index))
+        self._regions = regions
+        self._condition = threading.Condition()
+
+    def next(self):
+        ''' Wait for a deploy that can be started now.
+
+        Returns
+            @rtype Deploy: the next deploy to run; None if there are none left
+        '''
+        with self._condition:
+            while self._pending:
+                for deploy in self._pending:
+                    region = self._regions[deploy.region]
+                    if region.active < region.max_parallel:
+                        self._pending.remove(deploy)
+                        region.active += 1
+                        return deploy
+                self._condition.wait()
+            return None
+
+    def done(self, deploy):
+        ''' Record that a deploy has finished, freeing a slot in its region. '''
+        with self._condition:
+            self._regions[deploy.region].active -= 1
+            self._condition.notify_all()
+
+
+class FleetDriver:
+
+    def __init__(self, manifest, max_parallel=8):
+        ''' Class initializer
+
+        Parameters
+            @param manifest dict: fleet manifest (cf. module documentation)
+            @param max_parallel int: maximum number of deploys run concurrently (across all regions)
+        '''
+        self._max_parallel = max_parallel
+        session = ccs.http_session(pool_connections=len(manifest['regions']) * 2, pool_maxsize=max_parallel)
+        self.regions = dict([(name, Region(name, spec, session)) for name, spec in manifest['regions'].iteritems()])
+        self.deploys = [Deploy(i, entry) for i, entry in enumerate(manifest['deploys'])]
+        for deploy in self.deploys:
+            if deploy.region not in self.regions:
+                raise ValueError("Deploy '{name}' refers to unknown region '{region}'".format(name=deploy.name, region=deploy.region))
+
+    def run(self):
+        ''' Run all deploys, at most max_parallel at a time.
+
+        Returns
+            @rtype list: the deploys (with their outcomes)
+        '''
+        scheduler = FleetScheduler(self.deploys, self.regions)
+
+        def worker():
+            deploy = scheduler.next()
+            while deploy:
+                try:
+                    self.deploy(deploy)
+                except:
+                    logging.getLogger(__name__).debug('Exception deploying {}'.format(deploy.name), exc_info=True)
+                    deploy.outcome, deploy.reason = 'failed', 'Exception: {}'.format(sys.exc_info()[1])
+                finally:
+                    deploy.end_time = time.time()
+                    scheduler.done(deploy)
+                deploy = scheduler.next()
+
+        workers = [threading.Thread(target=worker, name='fleet-{}'.format(i)) for i in range(max(1, self._max_parallel))]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            while w.is_alive():
+                w.join(1)
+        return self.deploys
+
+    def deploy(self, deploy):
+        ''' Deploy a single group: identify the routed original, then create the update and advance it
+        through each phase (or, for an initial version, scale the group and map the route).
+        '''
+        deploy.start_time = time.time()
+        if 'Containers' != deploy.platform:
+            deploy.outcome, deploy.reason = 'skipped', 'Unsupported platform {}'.format(deploy.platform)
+            return
+        region = self.regions[deploy.region]
+        route = '{host}.{domain}'.format(host=deploy.hostname, domain=deploy.domain)
+
+        # an original that cannot be read must not be taken for an initial version (whose route would be mapped directly)
+        groups = region.ccs.list_groups(prefix='{}_'.format(deploy.pattern), fields=('Name',), timeout=30)
+        if groups is None:
+            deploy.outcome, deploy.reason = 'failed', 'Unable to list groups'
+            return
+        candidates = [g['Name'] for g in groups if g['Name'] != deploy.name and g['Name'].rsplit('_', 1)[0] == deploy.pattern]
+        routes = region.ccs.routes_by_group(candidates, timeout=30)
+        unread = [n for n in candidates if routes.get(n) is None]
+        if unread:
+            deploy.outcome, deploy.reason = 'failed', 'Unable to read routes of {}'.format(', '.join(unread))
+            return
+        routed = [n for n in candidates if route in routes[n]]
+
+        if not routed:
+            logging.getLogger(__name__).info('{}: initial version, scaling and mapping route'.format(deploy.name))
+            success, group, outcome = region.ccs.converge(deploy.name, deploy.group_size, [route], timeout=90)
+            reason = '; '.join(['{}: {}'.format(label, explanation) for label, explanation in outcome.iteritems() if explanation])
+            deploy.outcome, deploy.reason = ('initial', '') if success else ('failed', reason)
+            return
+
+        deploy.original = routed[0]
+        deploy.update_id, reason = region.ads.create(deploy.original, deploy.name,
+                                                     rampup=deploy.rampup, test=deploy.test, rampdown=deploy.rampdown)
+        if not deploy.update_id:
+            deploy.outcome, deploy.reason = 'failed', reason
+            return
+
+        # wait for each phase to complete, then advance to the next
+        for phase in PHASES:
+            rc = region.ads.wait_phase(deploy.update_id, on_paused=region.ads.resume, from_start=True)
+            if 1 == rc:
+                deploy.outcome = 'completed'
+                return
+            if 0 != rc:
+                deploy.outcome = 'rolled back' if 2 == rc else 'failed'
+                deploy.reason = 'Waiting for {phase}: {comment}'.format(phase=phase, comment=WAIT_COMMENTS.get(rc, rc))
+                if rc in [5, 9]:
+                    region.ads.rollback(deploy.update_id)
+                return
+            advanced, reason = region.ads.advance(deploy.update_id)
+            if not advanced:
+                deploy.outcome, deploy.reason = 'failed', reason
+                region.ads.rollback(deploy.update_id)
+                return
+        rc = region.ads.wait_phase(deploy.update_id, on_paused=region.ads.resume, from_start=True)
+        deploy.outcome = 'completed' if rc in [0, 1] else 'failed'
+        deploy.reason = '' if rc in [0, 1] else WAIT_COMMENTS.get(rc, rc)
+
+
+# Explanations of the return codes of ActiveDeployService.wait_phase() (cf. wait_comment in activedeploy_common.sh)
+WAIT_COMMENTS = {
+    0: 'phase already complete',
+    1: 'update already complete',
+    2: 'update already rolled back',
+    3: 'update failed',
+    5: 'unknown update',
+    9: 'took too long'
+}
+
+
+def summarize(deploys):
+    ''' Format the outcome of each deploy as a table.
+
+    Parameters
+        @param deploys list: Deploy objects
+    Returns
+        @rtype string: the table
+    '''
+    rows = [('NAME', 'REGION', 'OUTCOME', 'ORIGINAL', 'UPDATE', 'TIME', 'REASON')]
+    for d in sorted(deploys, key=lambda d: d.index):
+        rows.append((d.name, d.region, d.outcome, d.original or '-', d.update_id or '-',
+                     '{:.0f}s'.format(d.duration()), d.reason or ''))
+    widths = [max(len('{}'.format(row[i])) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join(['  '.join(['{}'.format(value).ljust(width) for value, width in zip(row, widths)]).rstrip() for row in rows])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run active deploys of many groups concurrently')
+    parser.add_argument('manifest', help='path of the fleet manifest (JSON)')
+    parser.add_argument('--max-parallel', type=int, default=8, help='maximum number of concurrent deploys (all regions)')
+    args = parser.parse_args()
+
+    ccs.configure_logging()
+    driver = FleetDriver(json.loads(open(args.manifest).read()), max_parallel=args.max_parallel)
+    deploys = driver.run()
+    print(summarize(deploys))
+    sys.exit(0 if all(d.outcome in ['completed', 'initial'] for d in deploys) else 1)
@@ -0,0 +1,299 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Local history of deploys (a SQLite database): how long each phase and each container service operation
+took, the number of retries and the outcomes. It is written when $AD_HISTORY_DB is set (cf. ccs.Metrics):
+
+    - phase:   actual duration of each phase of an update, when waited for from its start (cf. ccs.ActiveDeployService.wait_phase())
+    - ccs:     time waited for each container group operation ('resized', 'mapped', 'deleted', 'created', ...)
+    - retries: number of retried REST calls per operation (recorded when a process exits)
+    - deploy:  outcome of each update (cf. activedeploy_step_2.sh)
+
+Samples are recorded per app (the group name without its version) and region ($AD_HISTORY_REGION, or the
+host of $CF_TARGET_URL). If $AD_HISTORY_DEADLINES is set (and not 0), waits use the history: the deadline is
+a margin times the 95th percentile of past (successful) waits of the same app and region and the first poll
+is made at the 10th percentile. Without enough samples the usual deadlines are used.
+
+    python history.py report [--app APP] [--region REGION] [--days DAYS]
+    python history.py record --name NAME --kind deploy --activity update --outcome completed
+'''
+
+import argparse
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import urlparse
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS samples (
+    time REAL NOT NULL,
+    app TEXT NOT NULL,
+    region TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    seconds REAL,
+    polls INTEGER,
+    retries INTEGER,
+    outcome TEXT
+)'''
+
+INDEX = 'CREATE INDEX IF NOT EXISTS samples_key ON samples (app, region, kind, activity, time)'
+
+# Outcomes of successful waits (ccs waits record True; phase waits record the return code of wait_phase(), 0 when
+# the phase completed)
+SUCCESSES = ['True', '0', 'completed']
+
+
+def app_of(name):
+    ''' Returns
+        @rtype string: the app of a group name of the form app_version (the name itself if it has no version)
+    '''
+    app, _, version = (name or '').rpartition('_')
+    return app if app and version.isdigit() else name
+
+
+def percentile(values, p):
+    ''' Returns
+        @rtype float: the p-th percentile (nearest rank) of values; None if there are none
+    '''
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(p * len(values) / 100.0)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+
+class History:
+    ''' Records samples in, and computes statistics from, a SQLite database. Errors are logged and otherwise
+    ignored: the history never causes a deploy to fail.
+    '''
+
+    def __init__(self, path, region=None, app=None, adaptive=False, min_samples=5, margin=1.5, window=100):
+        ''' Class initializer
+
+        Parameters
+            @param path string: path of the database (created if necessary)
+            @param region string: region recorded with each sample; defaults to 'default'
+            @param app string: app recorded when a sample has no group name
+            @param adaptive boolean: if True, deadline() and first_poll() use the history
+            @param min_samples int: minimum number of samples needed before the history is used for a wait
+            @param margin float: factor applied to the 95th percentile to obtain a deadline
+            @param window int: number of most recent samples from which percentiles are computed
+        '''
+        self.path = path
+        self.region = region or 'default'
+        self.app = app
+        self.adaptive = adaptive
+        self.min_samples = min_samples
+        self.margin = margin
+        self.window = window
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            connection.execute(SCHEMA)
+            connection.execute(INDEX)
+            connection.commit()
+            self._initialized = True
+        return connection
+
+    def record(self, kind, activity, seconds=None, name=None, polls=None, retries=None, outcome=None):
+        ''' Record a sample.
+
+        Parameters
+            @param kind string: 'phase', 'ccs', 'retries' or 'deploy'
+            @param activity string: phase, operation or what was waited for
+            @param seconds float: duration (None if not applicable)
+            @param name string: name of the group (the app is derived from it); defaults to the app of the history
+            @param polls int: number of polls made
+            @param retries int: number of retries
+            @param outcome: outcome (e.g. True/False or a return code)
+        '''
+        app = app_of(name) if name else self.app
+        if not app:
+            return
+        try:
+            with self._lock:
+                connection = self._connect()
+                try:
+                    connection.execute('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                       (time.time(), app, self.region, kind, activity, seconds, polls, retries,
+                                        None if outcome is None else '{}'.format(outcome)))
+                    connection.commit()
+                finally:
+                    connection.close()
+        except sqlite3.Error:
+            logging.getLogger(__name__).debug('Unable to record sample in {}'.format(self.path), exc_info=True)
+
+    def durations(self, kind, activity, name=None):
+        ''' Returns
+            @rtype list: durations of the most recent successful samples of the app of name (in this region)
+        '''
+        app = app_of(name) if name else self.app
+        try:
+            with self._lock:
+                connection = self._connect()
+                try:
+                    rows = connection.execute('SELECT seconds FROM samples WHERE app = ? AND region = ? AND kind = ? AND activity = ? '
+                                              'AND seconds IS NOT NULL AND outcome IN ({}) ORDER BY time DESC LIMIT ?'.format(', '.join('?' * len(SUCCESSES))),
+                                              [app, self.region, kind, activity] + SUCCESSES + [self.window]).fetchall()
+                finally:
+                    connection.close()
+        except sqlite3.Error:
+            logging.getLogger(__name__).debug('Unable to read samples from {}'.format(self.path), exc_info=True)
+            return []
+        return [row[0] for row in rows]
+
+    def estimate(self, kind, activity, name=None):
+        ''' Returns
+            @rtype dict: number of samples and the 10th, 50th and 95th percentiles of the durations of successful
+                waits (cf. durations()); None if there are fewer than min_samples samples
+        '''
+        durations = self.durations(kind, activity, name)
+        if len(durations) < self.min_samples:
+            return None
+        return {'count': len(durations), 'p10': percentile(durations, 10), 'p50': percentile(durations, 50), 'p95': percentile(durations, 95)}
+
+    def deadline(self, kind, activity, name, default, floor=0):
+        ''' Returns
+            @rtype float: the time to wait for an activity: margin times the 95th percentile of past waits (but at
+                least floor); default if the history is not adaptive or has too few samples
+        '''
+        estimate = self.estimate(kind, activity, name) if self.adaptive else None
+        if not estimate:
+            return default
+        return max(floor, self.margin * estimate['p95'])
+
+    def first_poll(self, kind, activity, name):
+        ''' Returns
+            @rtype float: time before which an activity rarely completes (the 10th percentile of past waits), so need
+                not be polled; 0 if the history is not adaptive or has too few samples
+        '''
+        estimate = self.estimate(kind, activity, name) if self.adaptive else None
+        return estimate['p10'] if estimate else 0
+
+    def report(self, app=None, region=None, since=None):
+        ''' Summarize the history.
+
+        Parameters
+            @param app string: if set, only samples of this app
+            @param region string: if set, only samples of this region
+            @param since float: if set, only samples recorded after this time
+        Returns
+            @rtype list: a dict for each (app, region, kind, activity): count, failures, retries, p50 and p95 (of successful samples)
+        '''
+        conditions, values = [], []
+        for column, value in [('app = ?', app), ('region = ?', region), ('time >= ?', since)]:
+            if value is not None:
+                conditions.append(column)
+                values.append(value)
+        with self._lock:
+            connection = self._connect()
+            try:
+                rows = connection.execute('SELECT app, region, kind, activity, seconds, retries, outcome FROM samples {} ORDER BY time'.format(
+                    'WHERE ' + ' AND '.join(conditions) if conditions else ''), values).fetchall()
+            finally:
+                connection.close()
+        groups = {}
+        for app_, region_, kind, activity, seconds, retries, outcome in rows:
+            entry = groups.setdefault((app_, region_, kind, activity), {'count': 0, 'failures': 0, 'retries': 0, 'durations': []})
+            entry['count'] += 1
+            entry['retries'] += retries or 0
+            if outcome is not None and outcome not in SUCCESSES:
+                entry['failures'] += 1
+            elif seconds is not None:
+                entry['durations'].append(seconds)
+        result = []
+        for (app_, region_, kind, activity), entry in sorted(groups.iteritems()):
+            durations = entry['durations'][-self.window:]
+            result.append({'app': app_, 'region': region_, 'kind': kind, 'activity': activity, 'count': entry['count'],
+                           'failures': entry['failures'], 'retries': entry['retries'],
+                           'p50': percentile(durations, 50), 'p95': percentile(durations, 95)})
+        return result
+
+
+def default_region():
+    ''' Returns
+        @rtype string: $AD_HISTORY_REGION, or the host of $CF_TARGET_URL, or 'default'
+    '''
+    return os.getenv('AD_HISTORY_REGION') or urlparse.urlparse(os.getenv('CF_TARGET_URL') or '').netloc or 'default'
+
+
+def from_env():
+    ''' Returns
+        @rtype History: the history at $AD_HISTORY_DB (adaptive if $AD_HISTORY_DEADLINES is set); None if it is not set
+    '''
+    path = os.getenv('AD_HISTORY_DB')
+    if not path:
+        return None
+    return History(path, region=default_region(), app=app_of(os.getenv('NAME')) if os.getenv('NAME') else None,
+                   adaptive=os.getenv('AD_HISTORY_DEADLINES', '0') not in ['', '0'],
+                   min_samples=int(os.getenv('AD_HISTORY_MIN_SAMPLES', 5)),
+                   margin=float(os.getenv('AD_HISTORY_MARGIN', 1.5)))
+
+
+def summarize(rows):
+    ''' Format a report (cf. History.report()) as a table. '''
+    def seconds(value):
+        return '-' if value is None else '{:.1f}s'.format(value)
+    table = [('APP', 'REGION', 'KIND', 'ACTIVITY', 'COUNT', 'FAILED', 'RETRIES', 'P50', 'P95')]
+    for row in rows:
+        table.append((row['app'], row['region'], row['kind'], row['activity'], row['count'], row['failures'], row['retries'],
+                      seconds(row['p50']), seconds(row['p95'])))
+    widths = [max(len('{}'.format(row[i])) for row in table) for i in range(len(table[0]))]
+    return '\n'.join(['  '.join(['{}'.format(value).ljust(width) for value, width in zip(row, widths)]).rstrip() for row in table])
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+    import ccs
+
+    parser = argparse.ArgumentParser(description='Record in, or report on, the local deploy history')
+    parser.add_argument('--db', default=os.getenv('AD_HISTORY_DB'), help='path of the history database')
+    parser.add_argument('--region', default=default_region(), help='region (cf. $AD_HISTORY_REGION)')
+    subparsers = parser.add_subparsers(dest='command')
+    report_parser = subparsers.add_parser('report', help='print the p50 and p95 of each activity per app and region')
+    report_parser.add_argument('--app', help='report only this app')
+    report_parser.add_argument('--all-regions', action='store_true', help='report all regions (not only --region)')
+    report_parser.add_argument('--days', type=float, help='report only samples of the last DAYS days')
+    report_parser.add_argument('--format', choices=['table', 'json'], default='table', help='format of the report')
+    record_parser = subparsers.add_parser('record', help='record a sample')
+    record_parser.add_argument('--name', required=True, help='name of the group (or the app)')
+    record_parser.add_argument('--kind', default='deploy', help='kind of sample')
+    record_parser.add_argument('--activity', default='update', help='activity')
+    record_parser.add_argument('--seconds', type=float, help='duration')
+    record_parser.add_argument('--outcome', help='outcome')
+    args = parser.parse_args()
+
+    ccs.configure_logging()
+    if not args.db:
+        if 'record' == args.command:
+            # the history is optional; nothing to record without it
+            sys.exit(0)
+        parser.error('no history database (use --db or set $AD_HISTORY_DB)')
+    h = History(args.db, region=args.region)
+
+    if 'report' == args.command:
+        rows = h.report(app=args.app, region=None if args.all_regions else args.region,
+                        since=time.time() - args.days * 24 * 60 * 60 if args.days else None)
+        print(json.dumps(rows, indent=2) if 'json' == args.format else summarize(rows))
+
+    elif 'record' == args.command:
+        h.record(args.kind, args.activity, args.seconds, name=args.name, outcome=args.outcome)
@@ -0,0 +1,182 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Preflight checks of the Active Deploy service and the toolchain (cf. check_and_set_env.sh).
+
+The health of the Active Deploy service, its /v1/info/ document and the availability of the toolchain are
+probed concurrently. The result is cached on disk (per endpoint) for a time so that later steps do not
+repeat the probes:
+
+    eval "$(python preflight.py --ad-url URL --cf-url URL [--toolchain-url URL])"
+
+sets AD_HEALTHY, AD_SUPPORTS_TARGET and TOOLCHAIN_AVAILABLE (1 or 0), AD_BACKENDS and UPDATE_GUI_URL.
+The toolchain token is read from $TOOLCHAIN_TOKEN.
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import pipes
+import tempfile
+import time
+
+import ccs
+
+# Number of seconds for which a probe is reused (cf. $PREFLIGHT_TTL)
+DEFAULT_TTL = 300
+
+
+def _health(session, ad_url, timeout):
+    r = session.get('{}/health_check/'.format(ad_url), timeout=timeout)
+    return 'up' == r.json().get('status')
+
+
+def _info(session, ad_url, timeout):
+    r = session.get('{}/v1/info/'.format(ad_url), timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+
+def _toolchain(session, toolchain_url, token, timeout):
+    r = session.head(toolchain_url, headers={'Authorization': token}, timeout=timeout, allow_redirects=False)
+    return 200 <= r.status_code < 400
+
+
+def probe(ad_url, cf_url, toolchain_url=None, token=None, session=None, timeout=10):
+    ''' Probe the Active Deploy service and the toolchain concurrently.
+
+    Parameters
+        @param ad_url string: URL of the Active Deploy service
+        @param cf_url string: URL of the CF API of the target environment
+        @param toolchain_url string: if set, URL of the toolchain (HEAD is expected to succeed if it is available)
+        @param token string: toolchain token
+        @param session requests.Session: HTTP session to use; cf. ccs.http_session()
+        @param timeout int: number of seconds to wait for each call to return
+    Returns
+        @rtype dict: healthy, supports_target and toolchain (booleans), backends (list), update_gui_url, time
+            and complete (False if a probe of the Active Deploy service failed or the toolchain was not found available)
+    '''
+    session = session if session else ccs.http_session(pool_connections=2, pool_maxsize=3)
+    calls = [lambda: _health(session, ad_url, timeout), lambda: _info(session, ad_url, timeout)]
+    if toolchain_url:
+        calls.append(lambda: _toolchain(session, toolchain_url, token, timeout))
+
+    def call(function):
+        try:
+            return True, function()
+        except:
+            logging.getLogger(__name__).debug('Preflight probe failed', exc_info=True)
+            return False, None
+
+    pool = ThreadPool(len(calls))
+    try:
+        results = pool.map(call, calls)
+    finally:
+        pool.close()
+    (health_ok, healthy), (info_ok, info) = results[:2]
+    toolchain = bool(results[2][1]) if toolchain_url else False
+    info = info if info_ok and isinstance(info, dict) else {}
+    backends = info.get('cloud_backends') or []
+    return {
+        'healthy': bool(healthy),
+        'backends': backends,
+        'supports_target': cf_url in backends,
+        'update_gui_url': info.get('update_gui_url') or '',
+        'toolchain': bool(toolchain),
+        # a toolchain that is not available may only be so briefly; such a probe is not complete (so is not cached)
+        'complete': health_ok and info_ok and (toolchain or not toolchain_url),
+        'time': time.time()
+    }
+
+
+def cache_path(ad_url, toolchain_url=None, token=None, directory=None):
+    ''' Returns
+        @rtype string: path of the file caching the probe of the endpoints (the token is only hashed)
+    '''
+    key = hashlib.sha1('\n'.join([ad_url or '', toolchain_url or '', token or ''])).hexdigest()
+    directory = directory if directory else os.getenv('PREFLIGHT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'activedeploy-preflight'))
+    return os.path.join(directory, '{}.json'.format(key))
+
+
+def cached_probe(ad_url, cf_url, toolchain_url=None, token=None, ttl=DEFAULT_TTL, refresh=False, directory=None, **kwargs):
+    ''' Probe the endpoints (cf. probe()) unless they were probed less than ttl seconds ago. Only complete
+    probes of a healthy service are cached; anything else is probed again next time.
+
+    Parameters
+        @param ttl float: number of seconds for which a probe is reused
+        @param refresh boolean: if True, the cached probe (if any) is not used
+        @param directory string: where probes are cached; defaults to $PREFLIGHT_CACHE_DIR or a temporary directory
+    Returns
+        @rtype dict: the probe (cf. probe()), with 'cached' set if it was read from the cache
+    '''
+    path = cache_path(ad_url, toolchain_url, token, directory)
+    if not refresh:
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            if 0 <= time.time() - result['time'] < ttl:
+                # the probe does not depend on the target; whether it is supported is decided on each use
+                result['supports_target'] = cf_url in result['backends']
+                result['cached'] = True
+                return result
+        except (IOError, ValueError, KeyError):
+            pass
+
+    result = probe(ad_url, cf_url, toolchain_url, token, **kwargs)
+    result['cached'] = False
+    if result['complete'] and result['healthy']:
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0700)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(result, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            logging.getLogger(__name__).debug('Unable to cache preflight probe in {}'.format(path), exc_info=True)
+    return result
+
+
+def shell_assignments(result):
+    ''' Returns
+        @rtype string: the probe as shell variable assignments (one per line)
+    '''
+    values = [
+        ('AD_HEALTHY', 1 if result['healthy'] else 0),
+        ('AD_SUPPORTS_TARGET', 1 if result['supports_target'] else 0),
+        ('AD_BACKENDS', ' '.join(result['backends'])),
+        ('UPDATE_GUI_URL', result['update_gui_url']),
+        ('TOOLCHAIN_AVAILABLE', 1 if result['toolchain'] else 0)
+    ]
+    return '\n'.join(['{0}={1}'.format(name, pipes.quote(u'{}'.format(value).encode('utf-8'))) for name, value in values])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Probe the Active Deploy service and the toolchain; print shell assignments')
+    parser.add_argument('--ad-url', required=True, help='URL of the Active Deploy service')
+    parser.add_argument('--cf-url', default=os.getenv('CF_TARGET_URL', ''), help='URL of the CF API of the target environment')
+    parser.add_argument('--toolchain-url', help='URL of the toolchain; the token is read from $TOOLCHAIN_TOKEN')
+    parser.add_argument('--ttl', type=float, default=float(os.getenv('PREFLIGHT_TTL', DEFAULT_TTL)), help='seconds for which a probe is reused')
+    parser.add_argument('--refresh', action='store_true', help='ignore any cached probe')
+    parser.add_argument('--timeout', type=int, default=10, help='seconds to wait for each probe')
+    args = parser.parse_args()
+
+    ccs.configure_logging()
+    result = cached_probe(args.ad_url.rstrip('/'), args.cf_url, args.toolchain_url, os.getenv('TOOLCHAIN_TOKEN'),
+                          ttl=args.ttl, refresh=args.refresh, timeout=args.timeout)
+    logging.getLogger(__name__).debug('Preflight ({}): {}'.format('cached' if result['cached'] else 'probed', result))
+    print(shell_assignments(result))
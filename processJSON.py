@@ -1,31 +1,77 @@
 #!/usr/bin/python
 
-import requests
-import sys
+''' Extract the active deploy details from a toolchain (as returned by the toolchain API with include=everything).
+
+    python processJSON.py [--file toolchain.json] [--pipeline-id id]
+        prints shell assignments of SERVICE_ID, AD_API_URL and PIPELINE_NAME; use with eval
+    python processJSON.py [--file toolchain.json] (sid | ad-url | pipeline-id)
+        prints the single value (as earlier versions did)
+
+The toolchain is read from the file, from stdin if the file is '-' (the default), or from $TC_API_RES if it is set
+and no file is given.
+'''
+
+import argparse
 import json
-import time
 import os
+import pipes
+import sys
+
+
+def extract(toolchain, pipeline_id=None):
+    ''' Extract the active deploy service instance, broker URL and the name of the pipeline.
+
+    Parameters
+        @param toolchain dict: the toolchain
+        @param pipeline_id string: identifier of the pipeline (service instance) whose name is wanted
+    Returns
+        @rtype dict: SERVICE_ID, AD_API_URL, PIPELINE_NAME ('' if not found)
+    '''
+    services = toolchain['items'][0]['services']
+    by_id = dict([(service.get('instance_id'), service) for service in services])
+
+    values = {'SERVICE_ID': '', 'AD_API_URL': '', 'PIPELINE_NAME': ''}
+    for service in services:
+        if 'activedeploy' in (service.get('service_id') or ''):
+            values['SERVICE_ID'] = service.get('instance_id') or ''
+            values['AD_API_URL'] = service.get('url') or ''
+    if pipeline_id and pipeline_id in by_id:
+        values['PIPELINE_NAME'] = (by_id[pipeline_id].get('parameters') or {}).get('name') or ''
+    return values
 
-api_res = os.environ.get('TC_API_RES')
 
-api_res_json = json.loads(api_res)
+def shell_assignments(values):
+    ''' Returns
+        @rtype string: the values extracted from a toolchain (cf. extract()) as shell variable assignments
+    '''
+    return '\n'.join(['{0}={1}'.format(name, pipes.quote(values[name].encode('utf-8'))) for name in ['SERVICE_ID', 'AD_API_URL', 'PIPELINE_NAME']])
 
-service_id = 0
-ad_broker_url = 0
-pipeline_name = 0
 
-for i in range(len(api_res_json['items'][0]['services'])):
-  if "activedeploy" in api_res_json['items'][0]['services'][i]['service_id']:
-    service_id = api_res_json['items'][0]['services'][i]['instance_id']
-    ad_broker_url = api_res_json['items'][0]['services'][i]['url']
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract active deploy details from a toolchain')
+    parser.add_argument('--file', help="file containing the toolchain; '-' for stdin")
+    parser.add_argument('--pipeline-id', help='identifier of the pipeline whose name is wanted')
+    parser.add_argument('field', nargs='?', help="print only one value: 'sid', 'ad-url' or a pipeline id")
+    args = parser.parse_args()
 
-if sys.argv[1] == 'sid':
-  print service_id
+    if args.file is None and os.environ.get('TC_API_RES'):
+        toolchain = json.loads(os.environ.get('TC_API_RES'))
+    elif args.file in [None, '-']:
+        toolchain = json.load(sys.stdin)
+    else:
+        with open(args.file) as f:
+            toolchain = json.load(f)
 
-if sys.argv[1] == "ad-url":
-  print ad_broker_url
+    if args.field in [None, 'sid', 'ad-url']:
+        values = extract(toolchain, args.pipeline_id)
+    else:
+        values = extract(toolchain, args.field)
 
-if len(sys.argv[1]) == 36:
-  for i in range(len(api_res_json['items'][0]['services'])):
-  	if sys.argv[1] in api_res_json['items'][0]['services'][i]['instance_id']:
-  		print api_res_json['items'][0]['services'][i]['parameters']['name']
\ No newline at end of file
+    if args.field is None:
+        print shell_assignments(values)
+    elif 'sid' == args.field:
+        print values['SERVICE_ID'].encode('utf-8')
+    elif 'ad-url' == args.field:
+        print values['AD_API_URL'].encode('utf-8')
+    else:
+        print values['PIPELINE_NAME'].encode('utf-8')
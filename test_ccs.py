@@ -0,0 +1,397 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Tests of ccs.py.
+
+    python -m unittest test_ccs
+'''
+
+from email.utils import formatdate
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import requests
+
+import ccs
+import fake_bluemix
+
+
+class StubResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+
+class StubSession:
+    ''' Answers each PATCH with the next of a list of status codes (the last is repeated). '''
+
+    def __init__(self, status_codes):
+        self.status_codes = list(status_codes)
+        self.calls = 0
+
+    def patch(self, url, body, headers=None, timeout=None):
+        self.calls += 1
+        return StubResponse(self.status_codes.pop(0) if len(self.status_codes) > 1 else self.status_codes[0])
+
+
+class StatusReporterTest(unittest.TestCase):
+
+    def reporter(self, session):
+        return ccs.StatusReporter('http://broker', 'sid', 'token', session=session, max_attempts=2, retry_delay=0.01)
+
+    def test_reports_changes_only(self):
+        session = StubSession([200])
+        reporter = self.reporter(session)
+        reporter.report('u', 'in_progress')
+        self.assertTrue(reporter.flush(5))
+        reporter.report('u', 'in_progress')
+        reporter.report('u', 'completed')
+        self.assertTrue(reporter.close(5))
+        self.assertEqual(2, session.calls)
+
+    def test_failed_report_is_retried_and_fails_close(self):
+        session = StubSession([503])
+        reporter = self.reporter(session)
+        reporter.report('u', 'in_progress')
+        self.assertFalse(reporter.flush(5))
+        self.assertEqual(2, session.calls)
+        # the same status is sent again; once it is sent, nothing has failed
+        session.status_codes = [200]
+        reporter.report('u', 'in_progress')
+        self.assertTrue(reporter.close(5))
+        self.assertEqual(3, session.calls)
+
+    def test_close_fails_if_a_report_failed(self):
+        reporter = self.reporter(StubSession([500]))
+        reporter.report('u', 'completed')
+        self.assertFalse(reporter.close(5))
+
+
+class StubRest:
+    ''' REST function returning (or raising) each of a list of outcomes in turn; the last is repeated. '''
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.__name__ = '_stub'
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def policy(self, **kwargs):
+        options = {'max_attempts': 3, 'initial_delay': 0.001, 'jitter': 0}
+        options.update(kwargs)
+        return ccs.RetryPolicy(**options)
+
+    def test_client_error_is_not_retried(self):
+        rest = StubRest([StubResponse(403)])
+        success, r = self.policy().call(rest, [], {}, [200])
+        self.assertEqual((False, 403, 1), (success, r.status_code, rest.calls))
+
+    def test_server_errors_and_429_are_retried(self):
+        rest = StubRest([StubResponse(503), StubResponse(429), StubResponse(200)])
+        success, r = self.policy().call(rest, [], {}, [200])
+        self.assertEqual((True, 200, 3), (success, r.status_code, rest.calls))
+
+    def test_request_exceptions_are_retried(self):
+        rest = StubRest([requests.exceptions.ConnectionError(), requests.exceptions.ChunkedEncodingError(), StubResponse(200)])
+        self.assertTrue(self.policy().call(rest, [], {}, [200])[0])
+        self.assertEqual(3, rest.calls)
+
+    def test_invalid_url_is_not_retried(self):
+        rest = StubRest([requests.exceptions.MissingSchema()])
+        self.assertEqual((False, None), self.policy().call(rest, [], {}, [200]))
+        self.assertEqual(1, rest.calls)
+
+    def test_programming_errors_are_raised(self):
+        breaker = ccs.CircuitBreaker(failure_threshold=1)
+        rest = StubRest([TypeError('bug')])
+        self.assertRaises(TypeError, self.policy().call, rest, [], {}, [200], breaker=breaker)
+        self.assertFalse(breaker.is_open())
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(7, self.policy(max_delay=30).delay(0, StubResponse(503, {'Retry-After': '7'})))
+        self.assertEqual(30, self.policy(max_delay=30).delay(0, StubResponse(503, {'Retry-After': '120'})))
+
+    def test_retry_after_date(self):
+        delay = self.policy(max_delay=30).delay(0, StubResponse(503, {'Retry-After': formatdate(time.time() + 10, usegmt=True)}))
+        self.assertTrue(8 <= delay <= 10, delay)
+        past = self.policy().delay(0, StubResponse(503, {'Retry-After': formatdate(time.time() - 60, usegmt=True)}))
+        self.assertEqual(0, past)
+
+    def test_budget_limits_retries(self):
+        rest = StubRest([StubResponse(503, {'Retry-After': '0.2'})])
+        start_time = time.time()
+        success, r = self.policy(max_attempts=10, budget=0.5).call(rest, [], {}, [200])
+        self.assertFalse(success)
+        self.assertEqual(3, rest.calls)
+        self.assertTrue(time.time() - start_time < 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_and_fails_fast(self):
+        breaker = ccs.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        policy = ccs.RetryPolicy(max_attempts=2, initial_delay=0.001, jitter=0)
+        rest = StubRest([requests.exceptions.ConnectionError()])
+        self.assertFalse(policy.call(rest, [], {}, [200], breaker=breaker)[0])
+        self.assertTrue(breaker.is_open())
+        calls = rest.calls
+        self.assertFalse(policy.call(rest, [], {}, [200], breaker=breaker)[0])
+        self.assertEqual(calls, rest.calls)
+
+    def test_half_open_trial(self):
+        breaker = ccs.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        # a single trial call is allowed
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertTrue(breaker.is_open())
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.allow())
+
+    def test_permanent_error_closes(self):
+        breaker = ccs.CircuitBreaker(failure_threshold=2)
+        policy = ccs.RetryPolicy(max_attempts=1)
+        policy.call(StubRest([StubResponse(500)]), [], {}, [200], breaker=breaker)
+        policy.call(StubRest([StubResponse(404)]), [], {}, [200], breaker=breaker)
+        policy.call(StubRest([StubResponse(500)]), [], {}, [200], breaker=breaker)
+        self.assertFalse(breaker.is_open())
+
+
+class FakeBluemixTestCase(unittest.TestCase):
+    ''' Runs the services against a fake_bluemix server; subclasses may set faults (endpoint -> FaultProfile). '''
+
+    groups = 3
+    faults = None
+    default_fault = None
+
+    def setUp(self):
+        self.model = fake_bluemix.FakeBluemix(groups=self.groups, transition_time=0.1, faults=self.faults, default_fault=self.default_fault)
+        self.server = fake_bluemix.FakeBluemixServer(self.model).start()
+        self.home = tempfile.mkdtemp()
+        config = os.path.join(self.home, 'config.json')
+        with open(config, 'w') as f:
+            json.dump({'SpaceFields': {'Guid': 'space'}, 'AccessToken': 'bearer token'}, f)
+        policy = ccs.RetryPolicy(max_attempts=10, initial_delay=0.01, max_delay=0.05, jitter=0)
+        self.cf = ccs.CloudFoundaryService(self.server.url(), config=ccs.CFConfig(config), retry_policy=policy)
+        self.ccs = ccs.ContainerCloudService(cfapi=self.cf, base_url=self.server.ccs_url(), retry_policy=policy)
+        self.ads = ccs.ActiveDeployService(self.server.url(), ccs=self.ccs, retry_policy=policy)
+        self.polling = ccs.PollingStrategy(0.05)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.home)
+
+    def group(self, name):
+        return dict([(g['Name'], g) for g in self.model.list_groups()[1]]).get(name)
+
+
+class ContainerCloudServiceTest(FakeBluemixTestCase):
+
+    def test_resize(self):
+        success, group, reason = self.ccs.resize('app_1', 3, polling=self.polling)
+        self.assertTrue(success, reason)
+        self.assertEqual(3, self.group('app_1')['NumberInstances']['CurrentSize'])
+
+    def test_resize_unknown_group(self):
+        success, group, reason = self.ccs.resize('other_1', 3, polling=self.polling)
+        self.assertFalse(success)
+        self.assertIn('no group named other_1', reason)
+
+    def test_map(self):
+        success, group, reason = self.ccs.map('www', 'mybluemix.net', 'app_1', polling=self.polling)
+        self.assertTrue(success, reason)
+        self.assertEqual(['www.mybluemix.net'], self.group('app_1')['Routes'])
+
+    def test_converge(self):
+        success, group, outcome = self.ccs.converge('app_2', 2, ['app.mybluemix.net', 'www.mybluemix.net'], polling=self.polling, max_wait=10)
+        self.assertTrue(success, outcome)
+        self.assertEqual(['resize', 'map (app.mybluemix.net)', 'map (www.mybluemix.net)'], outcome.keys())
+        self.assertEqual(2, self.group('app_2')['NumberInstances']['CurrentSize'])
+        self.assertEqual(['app.mybluemix.net', 'www.mybluemix.net'], sorted(self.group('app_2')['Routes']))
+
+    def test_converge_invalid_route(self):
+        success, group, outcome = self.ccs.converge('app_2', 2, ['localhost', ('www', 'mybluemix.net')], polling=self.polling, max_wait=10)
+        self.assertFalse(success)
+        self.assertEqual("Invalid route 'localhost'; expected hostname.domain", outcome['map (localhost)'])
+        # only the valid changes are requested
+        self.assertEqual((1, 1), (self.model.requests['groups.resize'], self.model.requests['groups.map']))
+
+    def test_converge_route_pairs(self):
+        success, group, outcome = self.ccs.converge('app_2', None, [('www', 'mybluemix.net')], polling=self.polling, max_wait=10)
+        self.assertTrue(success, outcome)
+        self.assertEqual(['map (www.mybluemix.net)'], outcome.keys())
+        self.assertEqual(['www.mybluemix.net'], self.group('app_2')['Routes'])
+
+    def test_delete_groups(self):
+        results = self.ccs.delete_groups(['app_1', 'app_2', 'other_1'], polling=self.polling)
+        self.assertEqual(['app_1', 'app_2', 'other_1'], sorted(results.keys()))
+        self.assertTrue(all(success for success, group, reason in results.values()), results)
+        self.assertEqual(['app_3'], [g['Name'] for g in self.model.list_groups()[1]])
+
+
+class GroupCacheTest(FakeBluemixTestCase):
+
+    def setUp(self):
+        FakeBluemixTestCase.setUp(self)
+        self.ccs.cache = ccs.GroupCache(ttl=60)
+
+    def test_inspections_are_cached(self):
+        self.assertEqual(self.ccs.inspect_group('app_1'), self.ccs.inspect_group('app_1'))
+        self.assertEqual(1, self.model.requests['groups.inspect'])
+        self.assertEqual({'hits': 1, 'misses': 1, 'entries': 1}, self.ccs.cache.stats())
+
+    def test_resize_invalidates(self):
+        self.assertEqual(1, self.ccs.inspect_group('app_1')[0]['NumberInstances']['Desired'])
+        success, group, reason = self.ccs.resize('app_1', 3, polling=self.polling)
+        self.assertTrue(success, reason)
+        self.assertEqual(3, self.ccs.inspect_group('app_1')[0]['NumberInstances']['CurrentSize'])
+        # the request itself invalidates the entry, before any wait refreshes it
+        self.ccs._resize_group('app_1', 2)
+        self.assertEqual(2, self.ccs.inspect_group('app_1')[0]['NumberInstances']['Desired'])
+
+
+class GroupWatcherTest(FakeBluemixTestCase):
+
+    groups = 6
+
+    def setUp(self):
+        FakeBluemixTestCase.setUp(self)
+        self.ccs.watcher = ccs.GroupWatcher(self.ccs, interval=0.05)
+
+    def tearDown(self):
+        self.ccs.watcher.close()
+        FakeBluemixTestCase.tearDown(self)
+
+    def test_one_list_per_tick(self):
+        names = ['app_{}'.format(i) for i in range(1, 7)]
+        pool = ThreadPool(len(names))
+        try:
+            results = pool.map(lambda name: self.ccs.resize(name, 2), names)
+        finally:
+            pool.close()
+        self.assertTrue(all(success for success, group, reason in results), results)
+        self.assertTrue(self.ccs.watcher.ticks > 1)
+        self.assertEqual(self.ccs.watcher.ticks, self.model.requests['groups.list'])
+        # the groups are inspected only by resize() itself (to check that they exist), never to wait
+        self.assertEqual(len(names), self.model.requests['groups.inspect'])
+
+    def test_waits_time_out(self):
+        self.model.transition_time = 60
+        success, group, outcome = self.ccs.converge('app_1', 2, max_wait=0.2)
+        self.assertFalse(success)
+        self.assertEqual('did not complete within 0.2s', outcome['resize'])
+
+
+class ActiveDeployServiceTest(FakeBluemixTestCase):
+
+    def test_update(self):
+        update_id, reason = self.ads.create('app_3', 'app_2', rampup='1s', test='0s', rampdown='0s')
+        self.assertTrue(update_id, reason)
+        statuses = []
+        self.assertEqual(0, self.ads.wait_phase(update_id, on_status=lambda u, status: statuses.append(status), from_start=True))
+        self.assertIn('in_progress', statuses)
+        for phase in ['test', 'rampdown']:
+            self.assertEqual((True, ''), self.ads.advance(update_id))
+            self.assertEqual(phase, self.ads.update_record(update_id)[0].phase)
+            self.assertEqual(0, self.ads.wait_phase(update_id))
+        self.assertEqual((True, ''), self.ads.advance(update_id))
+        self.assertEqual(0, self.ads.wait_phase(update_id))
+        record = self.ads.update_record(update_id)[0]
+        self.assertEqual(('completed', 'completed'), (record.status, record.phase))
+
+    def test_unknown_update(self):
+        self.assertEqual(5, self.ads.wait_phase('none'))
+        self.assertEqual((None, 'No such update'), self.ads.show('none'))
+
+    def test_paused_update_is_resumed(self):
+        update_id, reason = self.ads.create('app_3', 'app_2', rampup='0s')
+        self.model._updates[update_id]['status'] = 'paused'
+        self.assertEqual(0, self.ads.wait_phase(update_id, on_paused=self.ads.resume))
+        self.assertEqual('in_progress', self.model.show_update(update_id)[1]['status'])
+
+
+class CloudFoundaryServiceTest(FakeBluemixTestCase):
+
+    def test_apps(self):
+        self.assertEqual(['app_1', 'app_2', 'app_3'], [app['name'] for app in self.cf.apps()])
+        self.assertEqual(['app.mybluemix.net'], self.cf.app('app_3')['routes'])
+        self.assertIsNone(self.cf.app('other_1'))
+
+    def test_scale_and_map_route(self):
+        self.assertEqual((True, ''), self.cf.scale('app_1', 2))
+        self.assertEqual((True, ''), self.cf.map_route('app_1', 'mybluemix.net', 'www'))
+        app = self.cf.app('app_1')
+        self.assertEqual((2, ['www.mybluemix.net']), (app['instances'], app['routes']))
+        self.assertEqual((False, "Domain 'example.com' does not exist"), self.cf.map_route('app_1', 'example.com', 'www'))
+
+    def test_delete_apps(self):
+        results = self.cf.delete_apps(['app_1', 'app_2', 'other_1'])
+        self.assertEqual({'app_1': (True, ''), 'app_2': (True, ''), 'other_1': (True, '')}, results)
+        # the apps are identified from a single read of the space summary
+        self.assertEqual(1, self.model.requests['cf.summary'])
+        self.assertEqual(['app_3'], [app['name'] for app in self.cf.apps()])
+
+
+class FaultyServicesTest(FakeBluemixTestCase):
+    ''' Failures and latency injected in the services are overcome by retries and polling. '''
+
+    faults = {
+        'groups.resize': fake_bluemix.FaultProfile(error_rate=0.3),
+        'groups.map': fake_bluemix.FaultProfile(error_rate=0.3),
+        'update.create': fake_bluemix.FaultProfile(error_rate=0.3),
+        'update.action': fake_bluemix.FaultProfile(error_rate=0.3),
+    }
+    default_fault = fake_bluemix.FaultProfile(latency=0.01, error_rate=0.05)
+
+    def test_converge(self):
+        success, group, outcome = self.ccs.converge('app_1', 2, ['www.mybluemix.net'], polling=self.polling, max_wait=10)
+        self.assertTrue(success, outcome)
+        self.assertEqual(2, self.group('app_1')['NumberInstances']['CurrentSize'])
+
+    def test_update(self):
+        update_id, reason = self.ads.create('app_3', 'app_2', rampup='0s', test='0s', rampdown='0s')
+        self.assertTrue(update_id, reason)
+        for phase in ['rampup', 'test', 'rampdown']:
+            self.assertEqual(0, self.ads.wait_phase(update_id))
+            self.assertEqual((True, ''), self.ads.advance(update_id))
+        self.assertEqual(0, self.ads.wait_phase(update_id))
+        self.assertEqual('completed', self.ads.update_record(update_id)[0].status)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Tests of checkpoint.py.
+
+    python -m unittest test_checkpoint
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import ccs
+import checkpoint
+
+
+class StubActiveDeployService:
+    ''' Answers update_record() from a dict of update id -> Update. '''
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.calls = 0
+
+    def update_record(self, name):
+        self.calls += 1
+        if name not in self.updates:
+            return None, 'No such update'
+        return self.updates[name], ''
+
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {'format': checkpoint.FORMAT, 'name': 'app_2', 'update_id': 'u1', 'original': 'app_1',
+                      'route': 'app.mybluemix.net', 'ad_url': 'https://ad/', 'updated': time.time()}
+        self.ads = StubActiveDeployService({'u1': ccs.Update('u1', 'app_1', 'app_2', 'in_progress', 'rampup')})
+
+    def test_valid(self):
+        record, reason, stale = checkpoint.validate(self.state, 'app_2', self.ads, 'https://ad', 60)
+        self.assertEqual(('u1', '', False), (record.id, reason, stale))
+        self.assertEqual(1, self.ads.calls)
+
+    def test_stale_age(self):
+        self.state['updated'] = time.time() - 120
+        self.assertEqual((None, 'Checkpoint is older than 60 seconds', True), checkpoint.validate(self.state, 'app_2', self.ads, 'https://ad', 60))
+        self.assertEqual(0, self.ads.calls)
+
+    def test_other_endpoint(self):
+        record, reason, stale = checkpoint.validate(self.state, 'app_2', self.ads, 'https://other', 60)
+        self.assertEqual((None, True), (record, stale))
+        self.assertIn('https://ad/', reason)
+        self.assertEqual(0, self.ads.calls)
+
+    def test_other_group(self):
+        self.assertEqual((None, 'Checkpoint is for app_2', True), checkpoint.validate(self.state, 'app_3', self.ads, 'https://ad', 60))
+        self.ads.updates['u1'] = ccs.Update('u1', 'app_1', 'app_3', 'in_progress', 'rampup')
+        self.assertEqual((None, 'Update u1 is of app_3', True), checkpoint.validate(self.state, 'app_2', self.ads, 'https://ad', 60))
+
+    def test_missing_update(self):
+        self.ads.updates = {}
+        self.assertEqual((None, 'Update u1 could not be read: No such update', True), checkpoint.validate(self.state, 'app_2', self.ads, None, 60))
+
+    def test_unreadable_update_is_not_stale(self):
+        self.ads.update_record = lambda name: (None, 'Unable to read request')
+        record, reason, stale = checkpoint.validate(self.state, 'app_2', self.ads, None, 60)
+        self.assertEqual((None, False), (record, stale))
+
+
+class CheckpointPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def test_default_is_archive_dir(self):
+        os.environ.pop('AD_CHECKPOINT_DIR', None)
+        os.environ['ARCHIVE_DIR'] = self.directory
+        self.assertEqual((os.path.join(self.directory, '.activedeploy-checkpoint'), True), checkpoint.checkpoint_dir())
+        os.environ.pop('ARCHIVE_DIR')
+        self.assertEqual((os.path.join(os.getcwd(), '.activedeploy-checkpoint'), False), checkpoint.checkpoint_dir())
+
+    def test_store_and_load(self):
+        path = checkpoint.checkpoint_path('app_2', 'my space', self.directory)
+        self.assertEqual(os.path.join(self.directory, 'my_space_app_2.json'), path)
+        checkpoint.store(path, {'name': 'app_2'})
+        self.assertEqual('app_2', checkpoint.load(path)['name'])
+        checkpoint.clear(path)
+        self.assertIsNone(checkpoint.load(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
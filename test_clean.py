@@ -0,0 +1,94 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Tests of clean.py, run as clean() in activedeploy_common.sh runs it, against fake_bluemix.
+
+    python -m unittest test_clean
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import clean
+import fake_bluemix
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_keeps_current_and_concurrent_versions(self):
+        versions = [clean.Version('app_{}'.format(i), i, ['app.mybluemix.net'] if 4 == i else [], False) for i in range(1, 6)]
+        decisions = dict([(d.name, d.action) for d in clean.plan(versions, 'app_4', 2)])
+        self.assertEqual({'app_5': 'delete', 'app_4': 'keep', 'app_3': 'keep', 'app_2': 'delete', 'app_1': 'delete'}, decisions)
+
+
+class CleanScriptTest(unittest.TestCase):
+    ''' Calls clean() of activedeploy_common.sh with the environment of the container platform. '''
+
+    def setUp(self):
+        self.model = fake_bluemix.FakeBluemix(groups=5, transition_time=0.1)
+        self.server = fake_bluemix.FakeBluemixServer(self.model).start()
+        self.home = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.home, '.cf'))
+        with open(os.path.join(self.home, '.cf', 'config.json'), 'w') as f:
+            json.dump({'SpaceFields': {'Guid': 'space'}, 'AccessToken': 'bearer token'}, f)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.home)
+
+    def clean(self, dry_run):
+        env = dict(os.environ)
+        env.update({'HOME': self.home, 'SCRIPTDIR': SCRIPTDIR, 'TARGET_PLATFORM': 'Container', 'NAME': 'app_5',
+                    'CONCURRENT_VERSIONS': '2', 'CCS_API_HOST': self.server.url(), 'CCS_LOG_LEVEL': 'WARNING',
+                    'PATH': os.pathsep.join([os.path.dirname(sys.executable), os.getenv('PATH', '')])})
+        if dry_run:
+            env['CLEAN_DRY_RUN'] = '1'
+        else:
+            env.pop('CLEAN_DRY_RUN', None)
+        p = subprocess.Popen(['bash', '-c', 'source "${SCRIPTDIR}/activedeploy_common.sh"; clean'], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        return p.returncode, output
+
+    def groups(self):
+        return sorted(g['Name'] for g in self.model.list_groups()[1])
+
+    def test_dry_run(self):
+        rc, output = self.clean(dry_run=True)
+        self.assertEqual(0, rc, output)
+        self.assertIn('Dry run; nothing deleted', output)
+        self.assertIn('Deleting app_1', output)
+        self.assertEqual(['app_1', 'app_2', 'app_3', 'app_4', 'app_5'], self.groups())
+
+    def test_deletes_old_versions(self):
+        rc, output = self.clean(dry_run=False)
+        self.assertEqual(0, rc, output)
+        deadline = time.time() + 5
+        while len(self.groups()) > 2 and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(['app_4', 'app_5'], self.groups())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Tests of history.py.
+
+    python -m unittest test_history
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import history
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_no_samples(self):
+        self.assertIsNone(history.percentile([], 50))
+
+    def test_one_sample(self):
+        for p in [0, 10, 50, 95, 100]:
+            self.assertEqual(7, history.percentile([7], p))
+
+    def test_nearest_rank(self):
+        values = range(20, 0, -1)
+        self.assertEqual(1, history.percentile(values, 0))
+        self.assertEqual(2, history.percentile(values, 10))
+        self.assertEqual(10, history.percentile(values, 50))
+        self.assertEqual(19, history.percentile(values, 95))
+        self.assertEqual(20, history.percentile(values, 100))
+        self.assertEqual(2, history.percentile([1, 2, 3, 4], 50))
+        self.assertEqual(3, history.percentile([1, 2, 3, 4], 51))
+
+
+class FromEnvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.directory = tempfile.mkdtemp()
+        for name in ['AD_HISTORY_DEADLINES', 'AD_HISTORY_MIN_SAMPLES', 'AD_HISTORY_MARGIN', 'AD_HISTORY_REGION', 'CF_TARGET_URL']:
+            os.environ.pop(name, None)
+        os.environ['AD_HISTORY_DB'] = os.path.join(self.directory, 'history.db')
+        os.environ['NAME'] = 'app_3'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def record(self, h, durations):
+        for seconds in durations:
+            h.record('phase', 'rampup', seconds, name='app_2', outcome=0)
+
+    def test_not_configured(self):
+        os.environ.pop('AD_HISTORY_DB')
+        self.assertIsNone(history.from_env())
+
+    def test_deadline_without_adaptive_history(self):
+        h = history.from_env()
+        self.record(h, [10] * 10)
+        self.assertFalse(h.adaptive)
+        self.assertEqual(90, h.deadline('phase', 'rampup', 'app_4', 90))
+        self.assertEqual(0, h.first_poll('phase', 'rampup', 'app_4'))
+
+    def test_deadline_with_too_few_samples(self):
+        os.environ['AD_HISTORY_DEADLINES'] = '1'
+        os.environ['AD_HISTORY_MIN_SAMPLES'] = '3'
+        h = history.from_env()
+        self.record(h, [10, 20])
+        self.assertEqual(90, h.deadline('phase', 'rampup', 'app_4', 90))
+        self.assertEqual(0, h.first_poll('phase', 'rampup', 'app_4'))
+
+    def test_deadline_from_history(self):
+        os.environ.update({'AD_HISTORY_DEADLINES': '1', 'AD_HISTORY_MIN_SAMPLES': '3', 'AD_HISTORY_MARGIN': '2',
+                           'CF_TARGET_URL': 'https://api.eu-gb.bluemix.net'})
+        h = history.from_env()
+        self.assertEqual(('app', 'api.eu-gb.bluemix.net'), (h.app, h.region))
+        self.record(h, [10, 20, 30])
+        h.record('phase', 'rampup', 1000, name='app_2', outcome=9)
+        self.assertEqual(60, h.deadline('phase', 'rampup', 'app_4', 90))
+        self.assertEqual(75, h.deadline('phase', 'rampup', 'app_4', 90, floor=75))
+        self.assertEqual(10, h.first_poll('phase', 'rampup', 'app_4'))
+        # samples are per app and region
+        self.assertEqual(90, h.deadline('phase', 'rampup', 'other_1', 90))
+        os.environ['AD_HISTORY_REGION'] = 'ng'
+        self.assertEqual(90, history.from_env().deadline('phase', 'rampup', 'app_4', 90))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#********************************************************************************
+# Copyright 2016 IBM
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#********************************************************************************
+
+''' Tests of processJSON.py.
+
+    python -m unittest test_processJSON
+'''
+
+import subprocess
+import unittest
+
+import processJSON
+
+
+def toolchain(*services):
+    return {'items': [{'services': list(services)}]}
+
+
+class ExtractTest(unittest.TestCase):
+
+    def test_missing_service(self):
+        values = processJSON.extract(toolchain({'service_id': 'pipeline', 'instance_id': 'p1', 'parameters': {'name': 'build'}},
+                                               {'service_id': 'github'}))
+        self.assertEqual({'SERVICE_ID': '', 'AD_API_URL': '', 'PIPELINE_NAME': ''}, values)
+
+    def test_exact_instance_id(self):
+        services = [{'service_id': 'pipeline', 'instance_id': 'p1', 'parameters': {'name': 'build'}},
+                    {'service_id': 'pipeline', 'instance_id': 'p12', 'parameters': {'name': 'deploy'}},
+                    {'service_id': 'activedeploy', 'instance_id': 'ad1', 'url': 'https://ad'}]
+        self.assertEqual({'SERVICE_ID': 'ad1', 'AD_API_URL': 'https://ad', 'PIPELINE_NAME': 'build'}, processJSON.extract(toolchain(*services), 'p1'))
+        self.assertEqual('deploy', processJSON.extract(toolchain(*services), 'p12')['PIPELINE_NAME'])
+        self.assertEqual('', processJSON.extract(toolchain(*services), 'p')['PIPELINE_NAME'])
+
+    def test_no_pipeline_id(self):
+        values = processJSON.extract(toolchain({'service_id': 'github', 'parameters': {'name': 'repo'}}))
+        self.assertEqual('', values['PIPELINE_NAME'])
+
+    def test_shell_quoting(self):
+        values = {'SERVICE_ID': 'ad1', 'AD_API_URL': 'https://ad', 'PIPELINE_NAME': u'it\'s a "pipeline" $HOME `x` \xe9'}
+        script = '{}\nprintf "%s|%s|%s" "$SERVICE_ID" "$AD_API_URL" "$PIPELINE_NAME"'.format(processJSON.shell_assignments(values))
+        output = subprocess.check_output(['bash', '-c', script])
+        self.assertEqual(u'ad1|https://ad|it\'s a "pipeline" $HOME `x` \xe9'.encode('utf-8'), output)
+
+
+if __name__ == '__main__':
+    unittest.main()